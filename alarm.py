@@ -1,3 +1,332 @@
+import bisect
+import collections
+import time
+
+
+# Incremental triggers keep O(1) state that is updated with each new event (instead of rescanning the events).
+# Add them to an AlarmClock with add_alarm(trigger, alarm).
+
+
+class EventLogged:
+    """Trigger met once a specific event has been logged"""
+
+    def __init__(self, event):
+        """
+        :param event: the event to check
+        """
+        self.event = event
+        self.seen = False
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the event has been logged, otherwise false
+        """
+        if event == self.event:
+            self.seen = True
+        return self.seen
+
+
+class LastEventGreater:
+    """Trigger met when the last event is greater than a specified value"""
+
+    def __init__(self, gt):
+        """
+        :param gt: the threshold to return true
+        """
+        self.gt = gt
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the event is greater than gt, otherwise false
+        """
+        return event > self.gt
+
+
+class LastEventLess:
+    """Trigger met when the last event is less than a specified value"""
+
+    def __init__(self, lt):
+        """
+        :param lt: the threshold to return true
+        """
+        self.lt = lt
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the event is less than lt, otherwise false
+        """
+        return event < self.lt
+
+
+class EventCount:
+    """Trigger met once a specific event has been logged a number of times"""
+
+    def __init__(self, event, count):
+        """
+        :param event: the event to count
+        :param count: the number of times the event must be logged
+        """
+        self.event = event
+        self.count = count
+        self.seen = 0
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the event has been logged at least count times, otherwise false
+        """
+        if event == self.event:
+            self.seen += 1
+        return self.seen >= self.count
+
+
+class DistinctEvents:
+    """Trigger met once a number of different events have been logged"""
+
+    def __init__(self, count):
+        """
+        :param count: the number of different events that must be logged
+        """
+        self.count = count
+        self.seen = set()
+
+    def update(self, event):
+        """
+        :param event: the new event (must be hashable)
+        :return: true if at least count different events have been logged, otherwise false
+        """
+        self.seen.add(event)
+        return len(self.seen) >= self.count
+
+
+def field_value(event, field):
+    """Get a field from an event (events may be single values or lists of fields)"""
+    return event[field] if isinstance(event, (list, tuple)) else event
+
+
+class EventRate:
+    """
+    Trigger met when an event is logged more than max_count times within a sliding time window
+    (e.g. more than 4 PUMP_ON events in 60 mins). Timestamps are kept in a deque, so each event costs O(1) amortized.
+    """
+
+    def __init__(self, event, max_count, window, field=0, clock=time.monotonic):
+        """
+        :param event: the event to count (e.g. PUMP_ON)
+        :param max_count: the trigger is met when the event occurs more than max_count times...
+        :param window: ...within window secs
+        :param field: index of the field to check when events are lists of fields
+        :param clock: function returning the current time (in secs)
+        """
+        self.event = event
+        self.max_count = max_count
+        self.window = window
+        self.field = field
+        self.clock = clock
+        self.times = collections.deque()
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the event pushed the count in the window above max_count, otherwise false
+        """
+        now = self.clock()
+        while self.times and now - self.times[0] >= self.window:
+            self.times.popleft()
+
+        if field_value(event, self.field) != self.event:
+            return False
+        self.times.append(now)
+        return len(self.times) > self.max_count
+
+
+class StateDuration:
+    """
+    Trigger met when a state lasts longer than max_duration (e.g. PUMP_ON for more than 30 mins).
+    Checked on each event, and with poll() so it is met while the state is still active.
+    Met once per occurrence of the state.
+    """
+
+    def __init__(self, state, max_duration, field=0, clock=time.monotonic):
+        """
+        :param state: the state to time (e.g. PUMP_ON)
+        :param max_duration: max time (in secs) the state may last
+        :param field: index of the field to check when events are lists of fields
+        :param clock: function returning the current time (in secs)
+        """
+        self.state = state
+        self.max_duration = max_duration
+        self.field = field
+        self.clock = clock
+        self.since = None  # time the state started (None if not in the state)
+        self.reported = False
+
+    def update(self, event):
+        """
+        :param event: the new event
+        :return: true if the state has lasted longer than max_duration (and was not already reported)
+        """
+        exceeded = self.poll()
+        value = field_value(event, self.field)
+        if value is None:  # event from another input
+            return exceeded
+        if value == self.state:
+            if self.since is None:
+                self.since = self.clock()
+                self.reported = False
+        else:
+            self.since = None
+        return exceeded
+
+    def poll(self):
+        """
+        :return: true if the state has lasted longer than max_duration (and was not already reported)
+        """
+        if self.since is None or self.reported or self.clock() - self.since <= self.max_duration:
+            return False
+        self.reported = True
+        return True
+
+
+class ThresholdRules:
+    """
+    A set of threshold alarms (value above/below a threshold) evaluated together.
+    The rule boundaries are kept sorted, so each new value only touches the rules whose boundaries it crossed since
+    the previous value. Each rule fires once per crossing: it only re-arms after the value moves back past the
+    threshold by the hysteresis band, and it will not fire again until the cooldown has passed.
+
+    Can be used as a logger (e.g. for pump or water depth readings) or as a trigger in an AlarmClock.
+    """
+
+    def __init__(self, field=0, clock=time.monotonic):
+        """
+        Setup an empty set of rules
+
+        :param field: index of the field to check when events are lists of fields
+        :param clock: function returning the current time (in secs), used for cooldowns
+        """
+        self.field = field
+        self.clock = clock
+        self.rules = []
+        # boundaries crossed when the value rises (fire "above" rules, re-arm "below" rules) and when it falls
+        self.up_keys, self.up_actions = [], []
+        self.down_keys, self.down_actions = [], []
+        self.last = None
+        self.evaluated = 0  # number of boundaries checked (to show how few rules each value touches)
+
+    def add_above(self, threshold, alarm, hysteresis=0, cooldown=0):
+        """
+        Add an alarm fired when the value rises above threshold
+
+        :param threshold: the alarm fires when the value is > threshold
+        :param alarm: a function invoked when the rule fires
+        :param hysteresis: the rule re-arms when the value is < threshold - hysteresis
+        :param cooldown: min time (in secs) between 2 firings of the rule
+        """
+        rule = self.add_rule(lambda v: v > threshold, alarm, cooldown)
+        self.insert(self.up_keys, self.up_actions, threshold, rule, True)
+        self.insert(self.down_keys, self.down_actions, threshold - hysteresis, rule, False)
+
+    def add_below(self, threshold, alarm, hysteresis=0, cooldown=0):
+        """
+        Add an alarm fired when the value falls below threshold
+
+        :param threshold: the alarm fires when the value is < threshold
+        :param alarm: a function invoked when the rule fires
+        :param hysteresis: the rule re-arms when the value is > threshold + hysteresis
+        :param cooldown: min time (in secs) between 2 firings of the rule
+        """
+        rule = self.add_rule(lambda v: v < threshold, alarm, cooldown)
+        self.insert(self.down_keys, self.down_actions, threshold, rule, True)
+        self.insert(self.up_keys, self.up_actions, threshold + hysteresis, rule, False)
+
+    def add_rule(self, condition, alarm, cooldown):
+        """Register a rule. The rule starts disarmed if the current value already meets the condition."""
+        rule = {"condition": condition, "alarm": alarm, "cooldown": cooldown, "armed": True, "last_fired": None}
+        self.rules.append(rule)
+
+        # apply the rule to the current value
+        if self.last is not None and condition(self.last):
+            rule["armed"] = False
+        return rule
+
+    @staticmethod
+    def insert(keys, actions, boundary, rule, fire):
+        """Insert a boundary (keeping the boundaries sorted)"""
+        i = bisect.bisect_right(keys, boundary)
+        keys.insert(i, boundary)
+        actions.insert(i, (rule, fire))
+
+    def fire(self, rule):
+        """
+        Fire a rule (unless it is cooling down). The rule is disarmed either way.
+
+        :return: true if the alarm was invoked
+        """
+        rule["armed"] = False
+        now = self.clock()
+        if rule["last_fired"] is not None and now - rule["last_fired"] < rule["cooldown"]:
+            return False
+        rule["last_fired"] = now
+        rule["alarm"]()
+        return True
+
+    def update(self, event):
+        """
+        Check the rules against a new value
+
+        :param event: the new value (or a list of fields)
+        :return: the number of alarms fired
+        """
+        value = field_value(event, self.field)
+        if value is None:
+            return 0
+
+        last, self.last = self.last, value
+        fired = 0
+
+        if last is None:
+            # first value --> check every rule
+            for rule in self.rules:
+                self.evaluated += 1
+                if rule["condition"](value):
+                    fired += self.fire(rule)
+            return fired
+
+        if value > last:
+            # boundaries b with last <= b < value
+            start = bisect.bisect_left(self.up_keys, last)
+            end = bisect.bisect_left(self.up_keys, value)
+            actions = self.up_actions[start:end]
+        elif value < last:
+            # boundaries b with value < b <= last (nearest first)
+            start = bisect.bisect_right(self.down_keys, value)
+            end = bisect.bisect_right(self.down_keys, last)
+            actions = reversed(self.down_actions[start:end])
+        else:
+            return 0
+
+        for rule, fire in actions:
+            self.evaluated += 1
+            if fire:
+                if rule["armed"]:
+                    fired += self.fire(rule)
+            else:
+                rule["armed"] = True
+
+        return fired
+
+    def log(self, event):
+        """Check the rules against the event (allows the rules to be used as a logger)"""
+        self.update(event)
+
+
+# Functions below check the list of recent events each time (O(n) for is_event_logged). Kept for compatibility.
+
+
 def is_event_logged(event, events):
     """
     Check if an event was logged in events
@@ -0,0 +1,121 @@
+# Persistent cache of a parsed ThingSpeak export and the series derived from it (durations, cleaned values, daily
+# totals...), so the plot scripts only parse and process the rows appended since their last run.
+import json
+import os
+import zipfile
+
+import numpy as np
+
+import thingspeak_csv
+
+VERSION = 1
+TAIL_LENGTH = 64  # bytes before the offset that must still match for the cache to be used
+
+
+class AnalysisCache:
+    """
+    Rows of a ThingSpeak export (keyed on entry_id) plus named derived series, saved to a .npz file.
+    update() reads the rows after the last cached entry_id. The caller then extends each derived series by processing
+    the new rows (plus whatever overlap its windows need), and calls save().
+    If the export no longer matches the cache (e.g. it was replaced), the cache is rebuilt from scratch.
+    """
+
+    def __init__(self, path):
+        """
+        Load the cache (if it exists)
+
+        :param path: the cache file
+        """
+        self.path = path
+        self.reset()
+        if os.path.exists(path):
+            try:
+                self.load()
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                print("Ignoring unreadable cache %s: %s" % (path, e))
+                self.reset()
+
+    def reset(self):
+        """Empty the cache"""
+        self.data = None  # structured array of the rows (see thingspeak_csv.dtype)
+        self.series = {}  # name -> array
+        self.meta = {"version": VERSION, "columns": None, "offset": 0, "tail": "", "last_entry_id": 0}
+
+    def load(self):
+        with np.load(self.path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta.get("version") != VERSION:
+                raise ValueError("version %s (expected %s)" % (meta.get("version"), VERSION))
+            self.data = npz["data"]
+            self.series = {name[len("series_"):]: npz[name] for name in npz.files if name.startswith("series_")}
+            self.meta = meta
+
+    def save(self):
+        """Write the cache (replaced atomically)"""
+        arrays = {"series_" + name: values for name, values in self.series.items()}
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(self.meta)), data=self.data, **arrays)
+        os.replace(tmp, self.path)
+
+    def matches(self, filename, columns):
+        """
+        :return: True if the cached rows are still the start of the export
+        """
+        if self.data is None or self.meta["columns"] != columns:
+            return False
+        offset = self.meta["offset"]
+        tail = self.meta["tail"].encode("latin-1")
+        if os.path.getsize(filename) < offset:
+            return False
+        with open(filename, "rb") as f:
+            f.seek(offset - len(tail))
+            return f.read(len(tail)) == tail
+
+    def update(self, filename, columns=None):
+        """
+        Add the rows appended to an export since the last update
+
+        :param filename: the CSV export
+        :param columns: list of the names of the columns to cache (entry_id is always cached). None caches all columns.
+        :return: index (in data) of the 1st new row. 0 if the cache was (re)built from scratch.
+        """
+        columns = thingspeak_csv.select_columns(thingspeak_csv.read_header(filename),
+                                                None if columns is None else list(columns) + ["entry_id"])
+        if not self.matches(filename, columns):
+            if self.data is not None:
+                print("Export %s does not match the cache. Rebuilding %s..." % (filename, self.path))
+            self.reset()
+            self.meta["columns"] = columns
+
+        rows, end = thingspeak_csv.read_from(filename, self.meta["offset"], columns)
+        rows = rows[rows["entry_id"] > self.meta["last_entry_id"]]  # in case rows were exported again
+        start = 0 if self.data is None else len(self.data)
+        self.data = rows if self.data is None else np.concatenate((self.data, rows))
+
+        with open(filename, "rb") as f:
+            f.seek(max(0, end - TAIL_LENGTH))
+            self.meta["tail"] = f.read(end - f.tell()).decode("latin-1")
+        self.meta["offset"] = end
+        if len(self.data):
+            self.meta["last_entry_id"] = int(self.data["entry_id"][-1])
+        print("Read %d new rows from %s (%d cached)" % (len(rows), filename, start))
+        return start
+
+    def append(self, name, values):
+        """
+        Extend a derived series
+
+        :param name: name of the series
+        :param values: array of the new values
+        """
+        values = np.asarray(values)
+        old = self.series.get(name)
+        self.series[name] = values if old is None else np.concatenate((old, values.astype(old.dtype)))
+
+
+def default_path(filename):
+    """
+    :return: the cache file used for an export unless another is given
+    """
+    return filename + ".cache.npz"
@@ -0,0 +1,55 @@
+"""
+Benchmark the AlarmClock with incremental triggers against the original list-scanning trigger functions.
+
+Run from the top-level directory: python3 -m benchmarks.bench_alarms
+"""
+import argparse
+import random
+import resource
+import time
+from functools import partial
+
+import alarm
+import loggers
+
+
+def bench(alarm_clock, triggers, events):
+    """
+    Log events to an alarm clock
+
+    :param alarm_clock: the alarm clock
+    :param triggers: list of triggers to add (each with a no-op alarm)
+    :param events: the events to log
+    :return: time taken (in secs) per event
+    """
+    for trigger in triggers:
+        alarm_clock.add_alarm(trigger, lambda: None)
+
+    start = time.perf_counter()
+    for event in events:
+        alarm_clock.log(event)
+    return (time.perf_counter() - start) / len(events)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the AlarmClock triggers")
+    parser.add_argument("--events", type=int, default=1000000, help="number of events for the incremental triggers")
+    parser.add_argument("--legacy-events", dest="legacy_events", type=int, default=20000,
+                        help="number of events for the original functions (O(n) per event, so keep this small)")
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    events = [rnd.randint(0, 200) for _i in range(args.events)]
+
+    # the original AlarmClock kept every event
+    legacy = [partial(alarm.is_event_logged, -1), partial(alarm.is_last_event_greater, 190),
+              partial(alarm.is_last_event_less, 10)]
+    per_event = bench(loggers.AlarmClock(capacity=None), legacy, events[:args.legacy_events])
+    print("functions, unbounded history: %d events %.2f us/event" % (args.legacy_events, per_event * 1e6))
+
+    incremental = [alarm.EventLogged(-1), alarm.LastEventGreater(190), alarm.LastEventLess(10)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    per_event = bench(loggers.AlarmClock(), incremental, events)
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    print("incremental, ring buffer:     %d events %.2f us/event (max RSS grew %d KB)" % (
+        args.events, per_event * 1e6, rss_growth))
@@ -0,0 +1,74 @@
+"""
+Send synthetic edge storms (bouncing contacts) to the pump monitor and count how many spurious events and logger
+calls the debounce suppresses, for a range of settle times.
+
+Run from the top-level directory: python3 -m benchmarks.bench_debounce
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+import pump_watcher
+from fake_gpio import FakeGPIO
+
+PIN = 22
+
+
+class FakeGpioPump(pump_watcher.AbstractPump):
+    """Pump monitor connected to a fake GPIO pin. Counts the logger calls."""
+
+    def __init__(self, gpio, **kwargs):
+        super(FakeGpioPump, self).__init__(PIN, **kwargs)
+        self.gpio = gpio
+        self.logger_calls = 0
+        gpio.setup(PIN, gpio.IN)
+        gpio.add_event_detect(PIN, gpio.BOTH, callback=self.event)
+        self.add_listener(self)
+
+    def get_status(self, pin):
+        return self.gpio.input(pin)
+
+    def log(self, _event):
+        self.logger_calls += 1
+
+
+def storm(settle_time, confirm_reads, cycles, bounces, glitch_rate, seed):
+    """
+    Switch the pump on/off repeatedly with bouncing edges, plus some spurious bursts
+
+    :return: tuple of the form (edges, real transitions, pump). The 1st status read is also logged (as a transition).
+    """
+    rng = random.Random(seed)
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, settle_time=settle_time, confirm_reads=confirm_reads, confirm_interval=0.001)
+    edges = real = 0
+    level = 0
+    for _i in range(cycles):
+        if rng.random() >= glitch_rate:
+            level = 1 - level
+            real += 1
+        edges += gpio.bounce(PIN, level, bounces=rng.randint(0, bounces), rng=rng)
+        time.sleep(settle_time + confirm_reads * 0.001 + 0.02)
+    return edges, real, pump
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pump debounce")
+    parser.add_argument("--cycles", type=int, default=50, help="number of bursts of edges")
+    parser.add_argument("--bounces", type=int, default=20, help="max number of extra edges per burst")
+    parser.add_argument("--glitch-rate", dest="glitch_rate", type=float, default=0.2,
+                        help="fraction of bursts that do not change the status")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-10s %-6s %8s %8s %8s %8s %10s" % ("settle ms", "reads", "edges", "real", "logged", "glitches",
+                                                 "suppressed"))
+    for settle_time, confirm_reads in ((0, 0), (0.01, 0), (0.05, 0), (0.05, 2)):
+        with contextlib.redirect_stdout(io.StringIO()):  # hide the messages printed for each event
+            edges, real, pump = storm(settle_time, confirm_reads, args.cycles, args.bounces, args.glitch_rate,
+                                      args.seed)
+        print("%-10g %-6d %8d %8d %8d %8d %9.1f%%" % (settle_time * 1000, confirm_reads, edges, real,
+                                                      pump.logger_calls, pump.glitches,
+                                                      100 * pump.suppressed() / edges))
@@ -0,0 +1,37 @@
+"""
+Measure how the pump on/off duration pairing (plot_pump.create_durations_for_event_pair) scales with the number of
+events, using synthetic events from pump_samples.
+
+Run from the top-level directory: python3 -m benchmarks.bench_durations
+"""
+import argparse
+import time
+
+import plot_pump as pp
+import pump_samples
+import pump_watcher as pw
+
+
+def bench(data):
+    """
+    Calculate the ON/OFF and OFF/ON durations
+
+    :return: tuple of the form (time taken in secs, number of durations)
+    """
+    start = time.perf_counter()
+    on_off = pp.create_durations_for_event_pair(data, pw.PUMP_ON, pw.PUMP_OFF, "on_duration")
+    off_on = pp.create_durations_for_event_pair(data, pw.PUMP_OFF, pw.PUMP_ON, "off_duration")
+    return time.perf_counter() - start, len(on_off) + len(off_on)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pump duration pairing")
+    parser.add_argument("--events", type=int, nargs="+", default=[10000, 100000, 1000000, 5000000],
+                        help="numbers of events to time")
+    args = parser.parse_args()
+
+    print("%10s %10s %10s %12s" % ("events", "durations", "secs", "ns/event"))
+    for length in args.events:
+        data = pump_samples.generate(length, seed=1)
+        secs, durations = bench(data)
+        print("%10d %10d %10.3f %12.0f" % (length, durations, secs, secs / length * 1e9))
@@ -0,0 +1,49 @@
+"""
+Benchmark the CPU usage and jitter of the echo timers using the fake GPIO backend.
+
+Run from the top-level directory: python3 -m benchmarks.bench_echo_timer
+"""
+import argparse
+import statistics
+import time
+
+import tank_watcher
+from fake_gpio import FakeGPIO
+
+
+def bench(echo_timer, pings, distance):
+    """
+    Take a series of measurements with an echo timer
+
+    :param echo_timer: the echo timer class to benchmark
+    :param pings: number of measurements to take
+    :param distance: distance (in cm) simulated by the fake sensor
+    :return: tuple of the form (cpu time, wall time, list of measurements)
+    """
+    gpio = FakeGPIO()
+    gpio.attach_sensor(23, 24, distance)
+    sensor = tank_watcher.Hcsr04Sensor(23, 24, gpio, echo_timer=echo_timer, settle_time=0)
+
+    samples = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _i in range(pings):
+        samples.append(sensor.distance())
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    sensor.cleanup()
+
+    return cpu, wall, [s for s in samples if s is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the HC-SR04 echo timers")
+    parser.add_argument("--pings", type=int, default=200, help="number of measurements per timer")
+    parser.add_argument("--distance", type=float, default=150, help="simulated distance (cm)")
+    args = parser.parse_args()
+
+    for name, timer in sorted(tank_watcher.ECHO_TIMERS.items()):
+        cpu, wall, samples = bench(timer, args.pings, args.distance)
+        print("%-5s cpu=%.3fs wall=%.3fs cpu/wall=%3.0f%% mean=%.2fcm jitter(stdev)=%.3fcm lost=%d" % (
+            name, cpu, wall, 100 * cpu / wall, statistics.mean(samples), statistics.stdev(samples),
+            args.pings - len(samples)))
@@ -0,0 +1,47 @@
+"""
+Measure the overhead of the metrics instrumentation on a hot path (disabled vs enabled).
+
+Run from the top-level directory: python3 -m benchmarks.bench_metrics
+"""
+import argparse
+import time
+
+import metrics
+
+
+def plain():
+    return 1
+
+
+@metrics.timed("bench_seconds")
+def instrumented():
+    metrics.inc("bench_total")
+    return 1
+
+
+def bench(fn, calls):
+    """
+    Call a function repeatedly
+
+    :return: time taken (in secs) per call
+    """
+    start = time.perf_counter()
+    for _i in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the metrics overhead")
+    parser.add_argument("--calls", type=int, default=1000000, help="number of calls to time")
+    args = parser.parse_args()
+
+    baseline = bench(plain, args.calls)
+    disabled = bench(instrumented, args.calls)
+    metrics.enable()
+    enabled = bench(instrumented, args.calls)
+    metrics.disable()
+
+    print("%-10s %12s %12s" % ("metrics", "ns/call", "overhead ns"))
+    for name, t in (("none", baseline), ("disabled", disabled), ("enabled", enabled)):
+        print("%-10s %12.0f %12.0f" % (name, t * 1e9, (t - baseline) * 1e9))
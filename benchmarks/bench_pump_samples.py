@@ -0,0 +1,47 @@
+"""
+Compare the time taken to generate synthetic pump events: pump_watcher.gen_random_samples (1 event at a time) vs
+pump_samples (numpy), and to write them as CSV and binary files.
+
+Run from the top-level directory: python3 -m benchmarks.bench_pump_samples
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import pump_samples
+import pump_watcher as pw
+
+
+def bench(fn, *args):
+    """
+    Call a function once
+
+    :return: time taken (in secs)
+    """
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pump event generators")
+    parser.add_argument("--events", type=int, default=1000000, help="number of events to generate")
+    parser.add_argument("--legacy-events", type=int, default=100000,
+                        help="number of events to generate with gen_random_samples (it is much slower)")
+    args = parser.parse_args()
+
+    legacy = bench(pw.gen_random_samples, args.legacy_events)
+    vectorized = bench(pump_samples.generate, args.events, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_file = os.path.join(tmp, "pump.csv")
+        npy_file = os.path.join(tmp, "pump.npy")
+        csv = bench(pump_samples.write_csv, csv_file, args.events, 100000, 1)
+        binary = bench(pump_samples.write_binary, npy_file, args.events, 1000000, 1)
+        sizes = os.path.getsize(csv_file), os.path.getsize(npy_file)
+
+    print("%-20s %10s %14s %10s" % ("generator", "events", "events/sec", "MB"))
+    print("%-20s %10d %14.0f %10s" % ("gen_random_samples", args.legacy_events, args.legacy_events / legacy, "-"))
+    print("%-20s %10d %14.0f %10s" % ("pump_samples", args.events, args.events / vectorized, "-"))
+    print("%-20s %10d %14.0f %10.1f" % ("write_csv", args.events, args.events / csv, sizes[0] / 1e6))
+    print("%-20s %10d %14.0f %10.1f" % ("write_binary", args.events, args.events / binary, sizes[1] / 1e6))
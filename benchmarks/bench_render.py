@@ -0,0 +1,49 @@
+"""
+Compare the time taken to render all the graphs (pump, water depth and weather) in this process vs a pool of worker
+processes. Uses the example exports in the top-level directory.
+
+Run from the top-level directory: python3 -m benchmarks.bench_render
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import matplotlib
+
+import plot_pump
+import plot_waterdepth
+import plot_weather
+import render
+
+
+def bench(jobs, workers):
+    """
+    Render the graphs
+
+    :return: time taken (in secs)
+    """
+    start = time.perf_counter()
+    render.render_all(jobs, workers=workers)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parallel rendering of the graphs")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count()],
+                        help="numbers of worker processes to time")
+    args = parser.parse_args()
+
+    matplotlib.use("Agg")
+    jobs = plot_pump.graph_jobs(plot_pump.read_data("pump.csv"), 100)
+    jobs += plot_waterdepth.graph_jobs(plot_waterdepth.read_data("waterdepth.csv"))
+    jobs += plot_weather.graph_jobs(plot_weather.read_data("weather.csv"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = [job._replace(filename=os.path.join(tmp, os.path.basename(job.filename))) for job in jobs]
+        print("%8s %10s %10s" % ("workers", "secs", "speedup"))
+        baseline = None
+        for workers in sorted(set(args.workers)):
+            secs = bench(jobs, workers)
+            baseline = baseline or secs
+            print("%8d %10.2f %10.1f" % (workers, secs, baseline / secs))
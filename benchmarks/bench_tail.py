@@ -0,0 +1,50 @@
+"""
+Compare the time taken to get the data for the pump graphs (last 100 events and durations) by reading the whole
+export vs only its end, for exports of different sizes. Uses synthetic pump events (see pump_samples).
+
+Run from the top-level directory: python3 -m benchmarks.bench_tail
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import plot_pump as pp
+import pump_samples
+
+
+def read_all(filename, truncate):
+    data = pp.read_data(filename)
+    times, states = pp.event_columns(data)
+    return data, {col: pp.find_durations(times, states, event1, event2) for col, event1, event2 in pp.DURATIONS}
+
+
+def bench(fn, *args):
+    """
+    Call a function once
+
+    :return: time taken (in secs)
+    """
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark reading the end of pump exports")
+    parser.add_argument("--events", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="numbers of events in the exports")
+    parser.add_argument("--truncate", type=int, default=100, help="number of recent events/durations needed")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for length in args.events:
+            filename = os.path.join(tmp, "pump%d.csv" % length)
+            pump_samples.write_csv(filename, length, seed=1)
+            results.append((length, bench(read_all, filename, args.truncate),
+                            bench(pp.read_recent, filename, args.truncate)))
+
+    print("%10s %12s %12s" % ("events", "whole secs", "tail secs"))
+    for length, whole, tail in results:
+        print("%10d %12.4f %12.4f" % (length, whole, tail))
@@ -0,0 +1,53 @@
+"""
+Compare the time taken to load a ThingSpeak CSV export: numpy.genfromtxt with a strptime converter (as the plot scripts
+used to) vs thingspeak_csv. Uses a synthetic pump export (see pump_samples).
+
+Run from the top-level directory: python3 -m benchmarks.bench_thingspeak_csv
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from numpy import genfromtxt
+
+import pump_samples
+import thingspeak_csv
+
+
+def read_genfromtxt(filename):
+    def str2date(x):
+        return datetime.strptime(x.decode("utf-8"), thingspeak_csv.DATE_FORMAT)
+
+    return genfromtxt(filename, delimiter=",", dtype=None, names=True, converters={0: str2date}, encoding="bytes")
+
+
+def bench(fn, *args):
+    """
+    Call a function once
+
+    :return: time taken (in secs)
+    """
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ThingSpeak CSV loaders")
+    parser.add_argument("--rows", type=int, default=500000, help="number of rows in the export")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "pump.csv")
+        pump_samples.write_csv(filename, args.rows, seed=1)
+
+        old = bench(read_genfromtxt, filename)
+        new = bench(thingspeak_csv.read, filename)
+        columns = bench(thingspeak_csv.read, filename, ["created_at", "field1"])
+
+    print("%-30s %10s %10s" % ("loader", "secs", "speedup"))
+    print("%-30s %10.3f %10s" % ("genfromtxt + strptime", old, "-"))
+    print("%-30s %10.3f %10.1f" % ("thingspeak_csv.read", new, old / new))
+    print("%-30s %10.3f %10.1f" % ("thingspeak_csv.read (2 cols)", columns, old / columns))
@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+
+
+class FakeGPIO:
+    """
+    Stand-in for the RPi.GPIO module that simulates HC-SR04 sensors.
+    Allows the echo timing code to be tested (and benchmarked) on a machine without GPIO pins.
+    """
+
+    # constants use the same values as RPi.GPIO
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, latency=0.0005):
+        """
+        Setup a fake GPIO backend
+
+        :param latency: delay (in secs) between the trigger pulse and the start of the echo pulse
+        """
+        self.latency = latency
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.callbacks = {}
+        self.sensors = {}  # trigger pin -> [echo pin, distance]
+        self.pulses = {}  # echo pin -> (rise time, fall time) in ns
+
+    def attach_sensor(self, gpio_trigger, gpio_echo, distance):
+        """
+        Simulate a sensor connected to the trigger/echo pins
+
+        :param gpio_trigger: the pin used to trigger the sensor
+        :param gpio_echo: the pin where the sensor sends the echo pulse
+        :param distance: the distance (in cm) measured by the sensor. None simulates a lost echo.
+        """
+        self.sensors[gpio_trigger] = [gpio_echo, distance]
+
+    def set_distance(self, gpio_trigger, distance):
+        """Change the distance measured by a sensor attached to gpio_trigger"""
+        self.sensors[gpio_trigger][1] = distance
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, **_kwargs):
+        self.directions[pin] = direction
+        self.levels.setdefault(pin, self.LOW)
+
+    def input(self, pin):
+        # echo levels are derived from the clock so polling is not distorted by the callback thread
+        pulse = self.pulses.get(pin)
+        if pulse:
+            rise, fall = pulse
+            return self.HIGH if rise <= time.monotonic_ns() < fall else self.LOW
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        prev = self.levels.get(pin, self.LOW)
+        self.levels[pin] = self.HIGH if value else self.LOW
+
+        # the sensor sends a pulse on the falling edge of the trigger
+        if prev and not value and pin in self.sensors:
+            echo_pin, distance = self.sensors[pin]
+            if distance is None:
+                self.pulses.pop(echo_pin, None)
+                return
+            rise = time.monotonic_ns() + int(self.latency * 1e9)
+            fall = rise + int(distance * 2 / 34300 * 1e9)
+            self.pulses[echo_pin] = (rise, fall)
+            if echo_pin in self.callbacks:
+                threading.Thread(target=self._echo, args=(echo_pin, rise, fall), daemon=True).start()
+
+    def add_event_detect(self, pin, _edge, callback=None, **_kwargs):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+        self.levels.clear()
+        self.directions.clear()
+        self.pulses.clear()
+
+    def bounce(self, pin, level, bounces=10, max_gap=0.002, rng=random):
+        """
+        Simulate a noisy change of level on an input pin (e.g. a relay contact bouncing): the level toggles several
+        times before it settles at the new level. The edge callback is fired (on the calling thread) for each edge.
+
+        :param pin: the input pin
+        :param level: the final level
+        :param bounces: number of extra edges before the pin settles
+        :param max_gap: max time (in secs) between edges. Each gap is random.
+        :param rng: random number generator used for the gaps
+        :return: the number of edges fired
+        """
+        edges = bounces + 1
+        for i in range(edges):
+            # count back from the final level so the last edge leaves the pin at that level
+            self.levels[pin] = level if (edges - 1 - i) % 2 == 0 else 1 - level
+            callback = self.callbacks.get(pin)
+            if callback:
+                callback(pin)
+            if i < edges - 1:
+                time.sleep(rng.uniform(0, max_gap))
+        return edges
+
+    def _echo(self, pin, rise, fall):
+        """Fire the edge callbacks at the start/end of the echo pulse"""
+        for edge in (rise, fall):
+            time.sleep(max(0, edge - time.monotonic_ns()) / 1e9)
+            callback = self.callbacks.get(pin)
+            if callback:
+                callback(pin)
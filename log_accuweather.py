@@ -6,6 +6,8 @@
 import argparse
 import requests
 
+import loggers
+
 if __name__ == '__main__':
     # read command-line args
     parser = argparse.ArgumentParser(
@@ -13,6 +15,7 @@ if __name__ == '__main__':
     parser.add_argument("thing_speak_api", help="API key to write new sensor readings to thingspeak.com channel")
     parser.add_argument("accuweather_api", help="API key to read weather data from accuweather")
     parser.add_argument("location_key", help="Accuweather location to retrieve weather data")
+    parser.add_argument("--store", help="also record the readings in a local database file (see plot_weather.py --store)")
     args = parser.parse_args()
     print(args)
 
@@ -32,3 +35,8 @@ if __name__ == '__main__':
     requests.get(
         "https://api.thingspeak.com/update?api_key=%s&field1=%d&field2=%d&field3=%d&field4=%d" % (
             args.thing_speak_api, temperature, humidity, pressure, rain))
+
+    if args.store:
+        store = loggers.LocalStore(args.store, "weather")
+        store.log([temperature, humidity, pressure, rain])
+        store.close()
@@ -1,17 +1,185 @@
-from urllib.request import urlopen
+import collections
+import concurrent.futures
+import datetime
+import http.client
+import json
+import math
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+import metrics
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections shared by the loggers. Idle connections are kept per host, so each event does not
+    pay for a new TCP connection and TLS handshake.
+    """
+
+    def __init__(self, max_idle=2):
+        """
+        Setup an empty pool
+
+        :param max_idle: max number of idle connections kept for each host
+        """
+        self.max_idle = max_idle
+        self.idle = {}  # (scheme, host, port) -> list of connections
+        self.lock = threading.Lock()
+        self.connections = 0  # new connections opened
+        self.reconnects = 0  # requests retried on a new connection after a kept-alive connection failed
+        self.requests = 0
+        self.connect_time = 0.0  # total time (secs) spent connecting (TCP + TLS handshake)
+        self.request_time = 0.0  # total time (secs) spent sending requests and reading responses
+
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        """
+        Send a request, re-using an idle connection to the host if there is one
+
+        :param method: HTTP method (e.g. GET)
+        :param url: the URL
+        :param body: request body (bytes)
+        :param headers: dict of request headers
+        :param timeout: max time (in secs) to wait for the host
+        :return: the response body (bytes)
+        :raises HTTPError: if the host returns an error status
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+        while True:
+            conn, reused = self.get_connection(key, timeout)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # the host closed the kept-alive connection --> try again on a new connection
+                with self.lock:
+                    self.reconnects += 1
+                continue
+            except Exception:
+                conn.close()
+                raise
+
+            with self.lock:
+                self.requests += 1
+                self.request_time += time.perf_counter() - start
+            self.put_connection(key, conn, response.will_close)
+
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return data
+
+    def get_connection(self, key, timeout):
+        """
+        Take an idle connection to the host, or open a new one
+
+        :return: tuple of the form (connection, true if the connection was idle)
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+
+        scheme, host, port = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+        start = time.perf_counter()
+        conn.connect()
+        with self.lock:
+            self.connections += 1
+            self.connect_time += time.perf_counter() - start
+        return conn, False
+
+    def put_connection(self, key, conn, will_close):
+        """Return a connection to the pool (or close it if the host will close it, or there are enough idle)"""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if not will_close and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def stats(self):
+        """
+        Timings of the connections/requests sent through the pool
+
+        :return: dict of counters and average connect (handshake) vs request times (in secs)
+        """
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "reconnects": self.reconnects,
+                "requests": self.requests,
+                "avg_connect_time": self.connect_time / self.connections if self.connections else 0.0,
+                "avg_request_time": self.request_time / self.requests if self.requests else 0.0,
+            }
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+# pool shared by all loggers (unless given their own)
+default_pool = ConnectionPool()
+
+
+class Event(list):
+    """List of fields to log, stamped with the time the event was captured"""
+
+    def __init__(self, fields=(), created_at=None, monotonic_ns=None):
+        """
+        Create an event
+
+        :param fields: the fields to log
+        :param created_at: time (UTC datetime) the event was captured. Defaults to now.
+        :param monotonic_ns: time.monotonic_ns() when the event was captured (if known). Use to measure the time
+        between events precisely (unaffected by changes to the wall clock).
+        """
+        super(Event, self).__init__(fields)
+        self.created_at = created_at if created_at else datetime.datetime.now(datetime.timezone.utc)
+        self.monotonic_ns = monotonic_ns
+
 
 class HealthChecks:
     """Ping a HealthChecks.io URL for each event"""
 
-    def __init__(self, url, test_mode=False):
+    def __init__(self, url, test_mode=False, timeout=10, pool=None):
         """
         Setup a logger with the specified URL
 
         :param url: the URL to log to on each event
+        :param timeout: max time (in secs) to wait for the URL to respond
+        :param pool: the ConnectionPool used to send requests (defaults to a pool shared by all loggers)
         """
         self.url = url
         self.test_mode = test_mode
+        self.timeout = timeout
+        self.pool = pool if pool else default_pool
 
+    @metrics.timed("logger_log_seconds", logger="HealthChecks")
     def log(self, event):
         """
         Log the event to the specified URL via GET method
@@ -22,67 +190,719 @@ class HealthChecks:
         print("Event: %s" % event)
 
         if not self.test_mode:
-            urlopen(self.url)
+            self.pool.request("GET", self.url, timeout=self.timeout)
+
 
 class ThingSpeak:
     """ThingSpeak channel used to log pump on/off events"""
 
-    def __init__(self, api_key, test_mode=False):
+    # ThingSpeak accepts 1 update every 15 secs per channel (free accounts). Updates sent sooner are rejected.
+    MIN_INTERVAL = 15
+
+    def __init__(self, api_key, test_mode=False, timeout=10, pool=None, url="https://api.thingspeak.com"):
         """
         Setup a ThingSpeak channel with the specified API key
 
         Args:
             api_key - write API key to update the channel
             test_mode - enable/disable logging to the remote service
+            timeout - max time (in secs) to wait for ThingSpeak to respond
+            pool - the ConnectionPool used to send requests (defaults to a pool shared by all loggers)
+            url - base URL of the ThingSpeak API
         """
         self.api_key = api_key
+        self.url = url
         self.test_mode = test_mode
+        self.timeout = timeout
+        self.pool = pool if pool else default_pool
 
+    @metrics.timed("logger_log_seconds", logger="ThingSpeak")
     def log(self, event):
         """
-        Log the event to the ThingSpeak channel (timestamp is inferred by ThingSpeak)
+        Log the event to the ThingSpeak channel, with the time it was captured if it is an Event (otherwise the
+        timestamp is inferred by ThingSpeak when the request arrives)
 
         :arg
-            event - a list of fields to log. Can be empty.
-        :return url used to log to ThingSpeak (includes API key and list of fields)
+            event - a list of fields to log. Can be empty. Fields set to None are not sent.
+        :return url used to log to ThingSpeak (includes API key, list of fields and capture time)
         """
 
-        url = "https://api.thingspeak.com/update?api_key=" + self.api_key
+        url = self.url + "/update?api_key=" + self.api_key
         for i, field in enumerate(event):
-            url += "&field%d=%s" % (i + 1, field)
+            if field is not None:
+                url += "&field%d=%s" % (i + 1, field)
+        created_at = getattr(event, "created_at", None)
+        if created_at:
+            url += "&created_at=" + created_at.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
         if not self.test_mode:
-            urlopen(url)
+            # ThingSpeak answers 200 with the entry ID, or "0" if the update was rejected (e.g. rate limited)
+            if self.pool.request("GET", url, timeout=self.timeout).strip() == b"0":
+                raise IOError("ThingSpeak rejected the update (rate limited?)")
 
         return url
 
 
+class BatchingThingSpeak:
+    """
+    ThingSpeak channel that buffers events and sends them as a single bulk update.
+    Each event keeps the time it was captured (instead of ThingSpeak inferring the time when the request arrives).
+    """
+
+    # ThingSpeak accepts at most 960 updates per bulk request, and 1 bulk request every 15 secs (free accounts)
+    MAX_BATCH_SIZE = 960
+    MIN_INTERVAL = 15
+
+    def __init__(self, api_key, channel_id, batch_size=50, max_delay=60, test_mode=False, timeout=10,
+                 url="https://api.thingspeak.com", pool=None, max_buffered=MAX_BATCH_SIZE * 10):
+        """
+        Setup a ThingSpeak channel with the specified API key
+
+        :param api_key: write API key to update the channel
+        :param channel_id: ID of the channel (needed by the bulk update endpoint)
+        :param batch_size: send the buffered events when this many events are waiting
+        :param max_delay: send the buffered events at least every max_delay secs (None to only flush on size/close)
+        :param test_mode: enable/disable logging to the remote service
+        :param timeout: max time (in secs) to wait for ThingSpeak to respond
+        :param url: base URL of the ThingSpeak API
+        :param pool: the ConnectionPool used to send requests (defaults to a pool shared by all loggers)
+        :param max_buffered: max number of events kept while ThingSpeak cannot be reached. The oldest events are
+        dropped beyond this (wrap the logger in a SpooledLogger to keep every event).
+        """
+        self.api_key = api_key
+        self.pool = pool if pool else default_pool
+        self.url = "%s/channels/%s/bulk_update.json" % (url, channel_id)
+        self.max_buffered = max_buffered
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.test_mode = test_mode
+        self.timeout = timeout
+        self.updates = []
+        self.lock = threading.Lock()
+        self.failed_flushes = 0  # flushes (triggered by a full buffer or the timer) that failed
+        self.dropped = 0  # events dropped because the buffer was full
+
+        self.stopped = threading.Event()
+        self.timer = None
+        if max_delay:
+            self.timer = threading.Thread(target=self.flush_periodically, args=(max_delay,), daemon=True)
+            self.timer.start()
+
+    @metrics.timed("logger_log_seconds", logger="BatchingThingSpeak")
+    def log(self, event):
+        """
+        Add the event to the buffer. Sends the buffer if it is full.
+        Does not raise if sending fails: the event is buffered, and is sent by a later flush (raising would make
+        the caller log it again).
+
+        :param event: a list of fields to log. Uses the capture time of the event if it is an Event.
+        """
+        with self.lock:
+            self.updates.append(self.make_update(event))
+            self.trim()
+            full = len(self.updates) >= self.batch_size
+        if full:
+            self.try_flush()
+
+    def trim(self):
+        """Drop the oldest events beyond max_buffered (called with the lock held)"""
+        excess = len(self.updates) - self.max_buffered
+        if excess > 0:
+            del self.updates[:excess]
+            self.dropped += excess
+            metrics.inc("queue_dropped_total", excess)
+            print("Bulk update buffer full. Dropped %d events (%d dropped)" % (excess, self.dropped))
+
+    def try_flush(self):
+        """Send the buffered events, reporting (not raising) a failure. The events are kept for the next flush."""
+        try:
+            self.flush()
+        except Exception as e:
+            with self.lock:
+                self.failed_flushes += 1
+                buffered = len(self.updates)
+            metrics.inc("logger_errors_total", logger="BatchingThingSpeak")
+            print("Bulk update failed (%d events kept): %s" % (buffered, e))
+
+    @staticmethod
+    def make_update(event):
+        """
+        :param event: a list of fields to log. Uses the capture time of the event if it is an Event.
+        :return: the event as an update of the bulk update request
+        """
+        created_at = getattr(event, "created_at", None) or datetime.datetime.now(datetime.timezone.utc)
+        update = {"created_at": created_at.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S +0000")}
+        for i, field in enumerate(event):
+            if field is not None:
+                update["field%d" % (i + 1)] = field
+        return update
+
+    def bulk_update(self, events):
+        """
+        Send events in a single request now (they are not buffered, and are not kept if the request fails)
+
+        :param events: list of events (at most MAX_BATCH_SIZE)
+        :return: the JSON body sent to ThingSpeak
+        """
+        return self.send([self.make_update(event) for event in events])
+
+    def send(self, updates):
+        """
+        Send a bulk update request
+
+        :param updates: list of updates (see make_update)
+        :return: the JSON body sent to ThingSpeak
+        """
+        body = json.dumps({"write_api_key": self.api_key, "updates": updates})
+        if not self.test_mode:
+            self.pool.request("POST", self.url, body.encode("utf-8"), {"Content-Type": "application/json"},
+                              self.timeout)
+        return body
+
+    def flush(self):
+        """
+        Send all buffered events, in requests of at most MAX_BATCH_SIZE events. If a request fails, the events not
+        sent yet are kept for the next flush.
+
+        :return: the JSON body of the last request sent to ThingSpeak (or None if there was nothing to send)
+        """
+        with self.lock:
+            updates, self.updates = self.updates, []
+        body = None
+        for start in range(0, len(updates), self.MAX_BATCH_SIZE):
+            try:
+                body = self.send(updates[start:start + self.MAX_BATCH_SIZE])
+            except Exception:
+                with self.lock:
+                    self.updates[:0] = updates[start:]
+                    self.trim()
+                raise
+        return body
+
+    def flush_periodically(self, interval):
+        """Timer thread. Send the buffered events every interval secs."""
+        while not self.stopped.wait(interval):
+            self.try_flush()
+
+    def close(self):
+        """Stop the timer and send any remaining events (events that cannot be sent are reported, not raised)"""
+        self.stopped.set()
+        if self.timer:
+            self.timer.join()
+        try:
+            self.flush()
+        except Exception as e:
+            print("Bulk update failed on close (%d events not sent): %s" % (len(self.updates), e))
+
+
+def retry_delay(logger, attempt, backoff=1.0):
+    """
+    :param logger: the logger
+    :param attempt: number of the attempt that failed (0 for the 1st)
+    :param backoff: time (in secs) to wait before the 1st retry. Doubled for each retry.
+    :return: time (in secs) to wait before retrying the logger
+    """
+    return max(backoff * 2 ** attempt, getattr(logger, "MIN_INTERVAL", 0))
+
+
+def log_with_retry(logger, event, retries=0, backoff=1.0):
+    """
+    Log an event, retrying with exponential backoff if the logger raises an exception.
+    The wait before a retry is at least the MIN_INTERVAL of the logger (if it has one), e.g. so ThingSpeak does not
+    reject the retry as rate limited.
+
+    :param logger: the logger
+    :param event: the event to log
+    :param retries: max number of times to retry
+    :param backoff: time (in secs) to wait before the 1st retry. Doubled for each retry.
+    :return: true if the event was logged, false if every attempt failed
+    """
+    for attempt in range(retries + 1):
+        try:
+            logger.log(event)
+            return True
+        except Exception as e:
+            print("Logging to %s failed (attempt %d): %s" % (type(logger).__name__, attempt + 1, e))
+            metrics.inc("logger_errors_total", logger=type(logger).__name__)
+            if attempt < retries:
+                time.sleep(retry_delay(logger, attempt, backoff))
+    return False
+
+
+class FanOutLogger:
+    """
+    Logger that sends each event to several loggers at the same time (via a thread pool shared by all FanOutLoggers),
+    so the time to log an event is the time of the slowest logger rather than the sum of all of them.
+    Each logger has its own deadline, and a logger that fails or hangs does not stop the others.
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, loggers, timeout=10, retries=0, backoff=1.0, executor=None):
+        """
+        Setup the fan-out
+
+        :param loggers: single logger or a list of loggers to send the events to
+        :param timeout: max time (in secs) to wait for each logger (incl. retries). A single value, or a list with
+        1 value per logger.
+        :param retries: max number of times to retry each logger if it fails
+        :param backoff: time (in secs) to wait before the 1st retry. Doubled for each retry.
+        :param executor: thread pool used to call the loggers. Defaults to a pool shared by all FanOutLoggers.
+        """
+        if type(loggers) is not list:
+            loggers = [loggers]
+        self.loggers = loggers
+        self.timeouts = list(timeout) if isinstance(timeout, (list, tuple)) else [timeout] * len(loggers)
+        if len(self.timeouts) != len(loggers):
+            raise ValueError("Need 1 timeout per logger")
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = executor if executor else self.shared_executor()
+
+        self.lock = threading.Lock()
+        self.pending = [None] * len(loggers)  # calls still running after their deadline
+        self.counters = [{"calls": 0, "failures": 0, "timeouts": 0, "skipped": 0, "total_time": 0.0,
+                          "max_time": 0.0, "last_time": 0.0} for _l in loggers]
+
+    @classmethod
+    def shared_executor(cls):
+        """The thread pool shared by all FanOutLoggers (created on first use)"""
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="fan-out")
+            return cls._executor
+
+    @metrics.timed("logger_log_seconds", logger="FanOutLogger")
+    def log(self, event):
+        """
+        Send the event to all the loggers and wait until they are done (or their deadline has passed).
+        A logger still busy with an earlier event (after its deadline) is skipped, so a hung logger cannot tie up
+        the thread pool.
+
+        :param event: the event to log
+        :raises IOError: if any logger failed, timed out or was skipped (after the other loggers are done)
+        """
+        start = time.monotonic()
+        futures = {}
+        failed = []
+        for i, logger in enumerate(self.loggers):
+            pending = self.pending[i]
+            if pending is not None and not pending.done():
+                with self.lock:
+                    self.counters[i]["skipped"] += 1
+                failed.append("%s (busy)" % type(logger).__name__)
+                continue
+            self.pending[i] = None
+            futures[i] = self.executor.submit(self._log_child, i, event)
+
+        for i, future in futures.items():
+            try:
+                if not future.result(timeout=max(0.0, start + self.timeouts[i] - time.monotonic())):
+                    failed.append(type(self.loggers[i]).__name__)
+            except concurrent.futures.TimeoutError:
+                self.pending[i] = future
+                with self.lock:
+                    self.counters[i]["timeouts"] += 1
+                failed.append("%s (timeout)" % type(self.loggers[i]).__name__)
+
+        if failed:
+            raise IOError("Could not log to %s" % ", ".join(failed))
+
+    def _log_child(self, i, event):
+        """Pool thread. Log the event to 1 logger and record how long it took."""
+        start = time.monotonic()
+        ok = log_with_retry(self.loggers[i], event, self.retries, self.backoff)
+        elapsed = time.monotonic() - start
+        with self.lock:
+            counters = self.counters[i]
+            counters["calls"] += 1
+            counters["failures"] += 0 if ok else 1
+            counters["total_time"] += elapsed
+            counters["max_time"] = max(counters["max_time"], elapsed)
+            counters["last_time"] = elapsed
+        return ok
+
+    def stats(self):
+        """
+        Latency of each logger
+
+        :return: list of dicts (1 per logger) of counters and the average/max/last time (in secs) to log an event
+        """
+        with self.lock:
+            return [{
+                "logger": type(logger).__name__,
+                "calls": counters["calls"],
+                "failures": counters["failures"],
+                "timeouts": counters["timeouts"],
+                "skipped": counters["skipped"],
+                "avg_time": counters["total_time"] / counters["calls"] if counters["calls"] else 0.0,
+                "max_time": counters["max_time"],
+                "last_time": counters["last_time"],
+            } for logger, counters in zip(self.loggers, self.counters)]
+
+    def close(self):
+        """Close the loggers"""
+        for logger in self.loggers:
+            if hasattr(logger, "close"):
+                logger.close()
+
+
+class SpooledLogger:
+    """
+    Logger that writes every event to an on-disk spool before it is sent, so events survive network outages and
+    restarts. A background thread sends the spooled events (in order) to the wrapped logger, retrying until it
+    succeeds. Events are delivered at least once.
+
+    The spool is an append-only file of fixed-size records. A cursor file holds the offset of the first unsent
+    record, so recovery after a crash only reads the unsent records.
+
+    Requests to the logger are paced (e.g. ThingSpeak rejects updates sent less than 15 secs apart), so a backlog is
+    not replayed faster than the service accepts it. If the logger can send several events in one request (see
+    BatchingThingSpeak.bulk_update), the backlog is sent in batches.
+    """
+
+    # magic, number of fields, capture time (epoch secs), 8 fields (NaN if not set), CRC32 of the preceding bytes
+    RECORD = struct.Struct("<HBd8dI")
+    MAGIC = 0x5350
+    MAX_FIELDS = 8
+
+    def __init__(self, logger, path, sync_every=10, sync_interval=5.0, retry_interval=1.0, max_retry_interval=300,
+                 send_interval=None):
+        """
+        Open (or create) the spool and start sending any unsent events
+
+        :param logger: the logger to send the events to
+        :param path: the spool file. The cursor is stored in path + ".cursor".
+        :param sync_every: fsync the spool after this many events...
+        :param sync_interval: ...or when the last fsync was more than sync_interval secs ago
+        :param retry_interval: time (in secs) to wait before retrying after the logger fails. Doubled on each failure.
+        :param max_retry_interval: max time (in secs) between retries
+        :param send_interval: min time (in secs) between requests to the logger. Defaults to the MIN_INTERVAL of the
+        logger (if it has one), otherwise 0.
+        """
+        self.logger = logger
+        self.send_interval = getattr(logger, "MIN_INTERVAL", 0) if send_interval is None else send_interval
+        self.batch_size = getattr(logger, "MAX_BATCH_SIZE", 1) if hasattr(logger, "bulk_update") else 1
+        self.path = path
+        self.cursor_path = path + ".cursor"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.lock = threading.Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+        # drop a partially written record at the end (e.g. power cut during a write)
+        self.end = os.fstat(self.fd).st_size
+        self.end -= self.end % self.RECORD.size
+        os.ftruncate(self.fd, self.end)
+
+        self.cursor = self.read_cursor()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+        self.pending = threading.Event()
+        self.stopped = threading.Event()
+        self.sender = threading.Thread(target=self.drain, daemon=True)
+        self.sender.start()
+        if self.backlog():
+            print("Spool %s: %d unsent events" % (path, self.backlog()))
+            self.pending.set()
+
+    def read_cursor(self):
+        """Read the offset of the first unsent record (0 if there is no cursor)"""
+        try:
+            with open(self.cursor_path, "rb") as f:
+                cursor = struct.unpack("<Q", f.read(8))[0]
+        except (OSError, struct.error):
+            return 0
+        return min(cursor - cursor % self.RECORD.size, self.end)
+
+    def write_cursor(self, cursor):
+        """Atomically replace the cursor file"""
+        tmp_path = self.cursor_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<Q", cursor))
+        os.replace(tmp_path, self.cursor_path)
+
+    def backlog(self):
+        """Number of events waiting to be sent"""
+        return (self.end - self.cursor) // self.RECORD.size
+
+    @metrics.timed("logger_log_seconds", logger="SpooledLogger")
+    def log(self, event):
+        """
+        Append the event to the spool. It is sent in the background.
+
+        :param event: a list of (numeric) fields to log. Uses the capture time of the event if it is an Event.
+        """
+        if len(event) > self.MAX_FIELDS:
+            raise ValueError("Cannot spool more than %d fields" % self.MAX_FIELDS)
+        created_at = getattr(event, "created_at", None) or datetime.datetime.now(datetime.timezone.utc)
+        fields = [math.nan if f is None else float(f) for f in event]
+        fields += [math.nan] * (self.MAX_FIELDS - len(fields))
+
+        record = self.RECORD.pack(self.MAGIC, len(event), created_at.timestamp(), *fields, 0)
+        record = record[:-4] + struct.pack("<I", zlib.crc32(record[:-4]))
+
+        with self.lock:
+            os.write(self.fd, record)
+            self.end += len(record)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync()
+        self.pending.set()
+
+    def sync(self):
+        """Flush the spool to disk"""
+        os.fsync(self.fd)
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def read_record(self, offset):
+        """
+        Read the event stored at offset
+
+        :return: the Event, or None if the record is corrupt
+        """
+        record = os.pread(self.fd, self.RECORD.size, offset)
+        magic, num_fields, timestamp, *fields, crc = self.RECORD.unpack(record)
+        if magic != self.MAGIC or crc != zlib.crc32(record[:-4]):
+            return None
+        # fields are stored as doubles: restore whole numbers as ints (e.g. pump status 1, not 1.0) so a replayed
+        # event is sent the same as a live one
+        fields = [None if math.isnan(f) else int(f) if f.is_integer() else f for f in fields[:num_fields]]
+        return Event(fields, datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc))
+
+    def read_records(self, offset, count):
+        """
+        Read the events stored from offset (skipping corrupt records)
+
+        :param offset: offset of the first record to read
+        :param count: max number of events to read
+        :return: tuple of the form (list of Events, offset of the record after the last one read)
+        """
+        events = []
+        while offset < self.end and len(events) < count:
+            event = self.read_record(offset)
+            if event is None:
+                print("Spool %s: skipping corrupt record at %d" % (self.path, offset))
+            else:
+                events.append(event)
+            offset += self.RECORD.size
+        return events, offset
+
+    def drain(self):
+        """Sender thread. Send spooled events to the logger (in order, paced or in batches) until stopped."""
+        retry_interval = self.retry_interval
+        last_sent = None
+        while not self.stopped.is_set():
+            self.pending.wait()
+            self.pending.clear()
+
+            while self.cursor < self.end and not self.stopped.is_set():
+                if last_sent is not None and self.send_interval:
+                    # also lets events logged meanwhile join the next batch
+                    if self.stopped.wait(last_sent + self.send_interval - time.monotonic()):
+                        break
+
+                events, end = self.read_records(self.cursor, self.batch_size)
+                if events:
+                    last_sent = time.monotonic()
+                    try:
+                        if self.batch_size > 1:
+                            self.logger.bulk_update(events)
+                        else:
+                            self.logger.log(events[0])
+                    except Exception as e:
+                        print("Spool %s: sending failed (%d unsent): %s" % (self.path, self.backlog(), e))
+                        self.stopped.wait(retry_interval)
+                        retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                        continue
+                    retry_interval = self.retry_interval
+
+                self.cursor = end
+                self.write_cursor(self.cursor)
+
+            # everything sent --> reclaim the space
+            with self.lock:
+                if self.cursor == self.end and self.end:
+                    os.ftruncate(self.fd, 0)
+                    self.end = self.cursor = 0
+                    self.write_cursor(0)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all spooled events have been sent
+
+        :param timeout: max time (in secs) to wait
+        :return: true if all events were sent, otherwise false
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.backlog():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self):
+        """
+        Stop sending and flush the spool to disk (also closes the wrapped logger).
+        Unsent events are sent the next time the spool is opened.
+        """
+        self.stopped.set()
+        self.pending.set()
+        self.sender.join()
+        with self.lock:
+            self.sync()
+        os.close(self.fd)
+        if hasattr(self.logger, "close"):
+            self.logger.close()
+
+
+class LocalStore:
+    """
+    Logger that records every event in a local SQLite database (WAL mode), indexed by channel and time.
+    Allows the history to be queried (e.g. by the plot scripts) without exporting CSV files from ThingSpeak.
+    """
+
+    MAX_FIELDS = 8
+
+    def __init__(self, path, channel):
+        """
+        Open (or create) the database
+
+        :param path: the database file
+        :param channel: name of the channel events are logged to (e.g. "pump", "waterdepth", "weather")
+        """
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS readings (channel TEXT NOT NULL, created_at REAL NOT NULL, "
+                          "entry_id INTEGER NOT NULL, %s)" %
+                          ", ".join("field%d" % (i + 1) for i in range(self.MAX_FIELDS)))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS readings_channel_time ON readings (channel, created_at)")
+        self.conn.commit()
+
+        # entry ids are numbered per channel (like ThingSpeak)
+        self.entry_id = self.conn.execute("SELECT MAX(entry_id) FROM readings WHERE channel = ?",
+                                          (channel,)).fetchone()[0] or 0
+
+    @metrics.timed("logger_log_seconds", logger="LocalStore")
+    def log(self, event):
+        """
+        Record the event
+
+        :param event: a list of fields to log. Uses the capture time of the event if it is an Event.
+        """
+        if len(event) > self.MAX_FIELDS:
+            raise ValueError("Cannot store more than %d fields" % self.MAX_FIELDS)
+        created_at = getattr(event, "created_at", None) or datetime.datetime.now(datetime.timezone.utc)
+        fields = list(event) + [None] * (self.MAX_FIELDS - len(event))
+
+        with self.lock:
+            self.entry_id += 1
+            self.conn.execute("INSERT INTO readings VALUES (?, ?, ?, %s)" % ", ".join("?" * self.MAX_FIELDS),
+                              [self.channel, created_at.timestamp(), self.entry_id] + fields)
+            self.conn.commit()
+
+    def query(self, channel=None, start=None, end=None, num_fields=1):
+        """
+        Get the events logged to a channel within a time range (uses the channel/time index)
+
+        :param channel: the channel to read (defaults to the channel of this logger)
+        :param start: earliest time (UTC datetime) to include. None reads from the first event.
+        :param end: latest time (UTC datetime) to exclude. None reads to the last event.
+        :param num_fields: number of fields to return
+        :return: list of tuples of the form (created_at, entry_id, field1, ...) ordered by time. created_at is a
+        (naive) UTC datetime, like the times read from ThingSpeak exports.
+        """
+        sql = "SELECT created_at, entry_id, %s FROM readings WHERE channel = ?" % ", ".join(
+            "field%d" % (i + 1) for i in range(num_fields))
+        params = [channel if channel else self.channel]
+        if start is not None:
+            sql += " AND created_at >= ?"
+            params.append(start.replace(tzinfo=datetime.timezone.utc).timestamp())
+        if end is not None:
+            sql += " AND created_at < ?"
+            params.append(end.replace(tzinfo=datetime.timezone.utc).timestamp())
+        sql += " ORDER BY created_at, entry_id"
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [(datetime.datetime.fromtimestamp(row[0], datetime.timezone.utc).replace(tzinfo=None),) + tuple(row[1:])
+                for row in rows]
+
+    def query_array(self, channel=None, start=None, end=None, num_fields=1):
+        """
+        Same as query, but returns a numpy structured array with the same columns as a ThingSpeak export read with
+        numpy.genfromtxt (created_at, entry_id, field1, ...)
+        """
+        import numpy as np
+
+        dtype = [("created_at", "O"), ("entry_id", "i8")] + [("field%d" % (i + 1), "f8") for i in range(num_fields)]
+        rows = [tuple(np.nan if f is None else f for f in row) for row in self.query(channel, start, end, num_fields)]
+        return np.array(rows, dtype=dtype)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
 class ConsoleLogger:
     def log(self, event):
         print("Event: %s" % event)
 
 
 class AlarmClock:
-    """Logger that allows alarms to be attached for specific events"""
+    """
+    Logger that allows alarms to be attached for specific events.
+    log and poll may be called from different threads: the triggers are checked under a lock (they are not
+    thread-safe), and the alarms that fired are called after it is released (so a slow alarm does not block them).
+    """
 
-    def __init__(self):
+    def __init__(self, capacity=1000):
         """
         Initialise an AlarmClock
+
+        :param capacity: max number of recent events kept (older events are discarded). None keeps every event.
         """
-        self.events = []
+        self.events = collections.deque(maxlen=capacity)
         self.alarms = []
+        self.polled = []
+        self.lock = threading.Lock()
 
     def add_alarm(self, trigger, alarm):
         """
         Add an an alarm and trigger to the alarm clock.
 
-        :param trigger: a function that takes a list of events, and returns True or False
+        :param trigger: an incremental trigger (see alarm.py) with an update(event) method returning True or False,
+        or a function that takes the list of recent events, and returns True or False
         :param alarm: a function invoked if the trigger is met
         """
-        self.alarms.append((trigger, alarm))
+        with self.lock:
+            if hasattr(trigger, "update"):
+                self.alarms.append((trigger.update, alarm, True))
+            else:
+                self.alarms.append((trigger, alarm, False))
+
+            # time-based triggers also need checking when no events arrive
+            if hasattr(trigger, "poll"):
+                self.polled.append((trigger.poll, alarm))
 
     def log(self, event):
-        self.events.append(event)
+        with self.lock:
+            self.events.append(event)
+            fired = [alarm for trigger, alarm, incremental in self.alarms
+                     if trigger(event if incremental else self.events)]
+        for alarm in fired:
+            alarm()
 
-        for trigger, alarm in self.alarms:
-            if trigger(self.events):
-                alarm()
+    def poll(self):
+        """Check the time-based triggers (call periodically, e.g. to detect the pump running too long)"""
+        with self.lock:
+            fired = [alarm for trigger, alarm in self.polled if trigger()]
+        for alarm in fired:
+            alarm()
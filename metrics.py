@@ -0,0 +1,369 @@
+import functools
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# number of linear sub-buckets per power of 2 in a histogram (precision of about 1.5%)
+SUB_BUCKETS = 128
+
+
+class Counter:
+    """Value that only goes up (e.g. number of events logged)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """Value that can go up and down (e.g. number of events waiting in a queue)"""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Latency histogram in the style of HdrHistogram. Values are recorded (in microsecs) into buckets that are linear
+    within each power of 2, so recording is O(1), memory does not grow with the number of values, and percentiles are
+    accurate to about 1.5% over the whole range.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def bucket(value):
+        """Index of the bucket for a value (in microsecs)"""
+        if value < SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BUCKETS.bit_length() + 1
+        return SUB_BUCKETS + (shift - 1) * (SUB_BUCKETS // 2) + (value >> shift) - SUB_BUCKETS // 2
+
+    @staticmethod
+    def bucket_value(index):
+        """Middle of the range of values (in microsecs) counted by a bucket"""
+        if index < SUB_BUCKETS:
+            return index
+        shift, sub = divmod(index - SUB_BUCKETS, SUB_BUCKETS // 2)
+        shift += 1
+        return ((sub + SUB_BUCKETS // 2) << shift) + (1 << shift) / 2
+
+    def record(self, seconds):
+        """
+        Record a value
+
+        :param seconds: the value (e.g. a duration in secs)
+        """
+        index = self.bucket(max(0, int(seconds * 1e6)))
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """
+        Estimate a percentile of the recorded values
+
+        :param q: the percentile (0-100)
+        :return: the value (in secs), or 0 if no values were recorded
+        """
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, q / 100 * self.count)
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    return min(self.bucket_value(index) / 1e6, self.max)
+        return self.max
+
+
+class _Timer:
+    """Context manager that records the time taken by a block of code into a histogram"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    """Timer used when metrics are disabled. Does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Registry:
+    """Named counters, gauges and latency histograms. Metrics are created on first use."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # (name, labels) -> metric
+        self.server = None
+        self.stop_snapshots = threading.Event()
+        self.snapshot_thread = None
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls())
+        if not isinstance(metric, cls):
+            raise ValueError("%s is already registered as a %s" % (name, type(metric).__name__))
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def timer(self, name, **labels):
+        return _Timer(self.histogram(name, **labels))
+
+    def render(self):
+        """
+        The metrics in the Prometheus text format. Histograms are reported as summaries (quantiles, sum and count).
+
+        :return: the text
+        """
+        lines = []
+        typed = set()
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        for (name, labels), metric in metrics:
+            kind = "summary" if isinstance(metric, Histogram) else type(metric).__name__.lower()
+            if name not in typed:
+                lines.append("# TYPE %s %s" % (name, kind))
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                for q in (50, 90, 99):
+                    lines.append("%s%s %g" % (name, _format_labels(labels + (("quantile", str(q / 100)),)),
+                                              metric.percentile(q)))
+                lines.append("%s_sum%s %g" % (name, _format_labels(labels), metric.sum))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels), metric.count))
+            else:
+                lines.append("%s%s %g" % (name, _format_labels(labels), metric.value))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Current value of each metric
+
+        :return: dict of metric name (with labels) -> value. Histograms are dicts of count/sum/max/percentiles.
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        snapshot = {"time": time.time()}
+        for (name, labels), metric in metrics:
+            key = name + _format_labels(labels)
+            if isinstance(metric, Histogram):
+                snapshot[key] = {"count": metric.count, "sum": metric.sum, "max": metric.max,
+                                 "p50": metric.percentile(50), "p90": metric.percentile(90),
+                                 "p99": metric.percentile(99)}
+            else:
+                snapshot[key] = metric.value
+        return snapshot
+
+    def write_snapshot(self, path):
+        """Write a snapshot of the metrics to a JSON file (replaced atomically)"""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    def snapshot_periodically(self, path, interval=60):
+        """
+        Start a background thread that writes a snapshot to a file every interval secs (until closed)
+
+        :param path: the JSON file
+        :param interval: time between snapshots (in secs)
+        """
+
+        def run():
+            stopped = False
+            while not stopped:
+                stopped = self.stop_snapshots.wait(interval)  # write the final values when stopped
+                try:
+                    self.write_snapshot(path)
+                except OSError as e:
+                    print("Could not write metrics to %s: %s" % (path, e))
+
+        self.snapshot_thread = threading.Thread(target=run, daemon=True)
+        self.snapshot_thread.start()
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics (Prometheus text format) at http://host:port/metrics from a background thread
+
+        :param port: the port to listen on. 0 picks a free port.
+        :param host: the address to listen on (local only by default)
+        :return: the port the server is listening on
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass  # do not print every scrape
+
+        self.server = _ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        """Stop the metrics server and snapshot thread (writing a final snapshot)"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.stop_snapshots.set()
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, v) for k, v in labels)
+
+
+# --- module-level API used by the watchers/loggers. Does nothing (and costs almost nothing) until enable() is called.
+
+registry = None
+
+
+def enable():
+    """
+    Start collecting metrics
+
+    :return: the registry holding the metrics
+    """
+    global registry
+    if registry is None:
+        registry = Registry()
+    return registry
+
+
+def disable():
+    """Stop collecting metrics (and stop serving/snapshotting them)"""
+    global registry
+    if registry is not None:
+        registry.close()
+    registry = None
+
+
+def start(port=None, path=None, interval=60):
+    """
+    Enable metrics if they are to be served and/or written to a file (used by the command-line options)
+
+    :param port: serve the metrics at http://127.0.0.1:port/metrics. None does not serve them.
+    :param path: write a snapshot of the metrics to this JSON file every interval secs. None does not write them.
+    :param interval: time between snapshots (in secs)
+    :return: the registry, or None if metrics stay disabled
+    """
+    if port is None and not path:
+        return None
+    metrics = enable()
+    if port is not None:
+        print("Serving metrics at http://127.0.0.1:%d/metrics" % metrics.serve(port))
+    if path:
+        print("Writing metrics to %s every %s secs" % (path, interval))
+        metrics.snapshot_periodically(path, interval)
+    return metrics
+
+
+def inc(name, amount=1, **labels):
+    """Increment a counter (if metrics are enabled)"""
+    if registry is not None:
+        registry.counter(name, **labels).inc(amount)
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge (if metrics are enabled)"""
+    if registry is not None:
+        registry.gauge(name, **labels).set(value)
+
+
+def timer(name, **labels):
+    """
+    Time a block of code (if metrics are enabled), e.g. with metrics.timer("sensor_ping_seconds"): ...
+
+    :return: context manager recording the elapsed time into the histogram called name
+    """
+    if registry is None:
+        return NULL_TIMER
+    return registry.timer(name, **labels)
+
+
+def timed(name, **labels):
+    """Decorator version of timer"""
+
+    def decorator(fn):
+        cache = [None, None]  # registry, histogram (looked up once per registry)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if registry is None:
+                return fn(*args, **kwargs)
+            if cache[0] is not registry:
+                cache[:] = [registry, registry.histogram(name, **labels)]
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                cache[1].record(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
@@ -1,13 +1,18 @@
 import numpy as np
 import pandas as pd
+import analysis_cache
 import pump_watcher as pw
-import csv
-from numpy import genfromtxt
+import pump_samples
+import render
+import thingspeak_csv
 from datetime import datetime
 from datetime import timedelta
 import argparse
 import matplotlib
 
+# duration column, event that starts the duration, event that ends it
+DURATIONS = [("on_duration", pw.PUMP_ON, pw.PUMP_OFF), ("off_duration", pw.PUMP_OFF, pw.PUMP_ON)]
+
 
 def count_pump_on(data):
     """
@@ -31,68 +36,96 @@ def count_pump_off(data):
     return len([d for d in data if int(d[2]) == pw.PUMP_OFF])
 
 
-def find_next_event(data, event_type):
+def event_columns(data):
     """
-    Find the next sequence within data starting with event_type
+    Get the timestamps and on/off states of the events as arrays
 
-    :param data: list of tuples, of the form (datetime, int)
-    :return: subset of data starting with event_type
+    :param data: list of tuples, of the form (datetime, int, int), or a structured array with the same columns as a
+    ThingSpeak export (created_at, entry_id, field1)
+    :return: tuple of the form (times, states). times is a datetime64 array. states is a float array (the states may be
+    strings, or NaN where the event was for another input).
     """
-    for i, event in enumerate(data):
-        if int(event[2]) == event_type:
-            return data[i:]
-    return None
-
-
-def find_next_duration(data, event1, event2):
+    if getattr(data, "dtype", None) is not None and data.dtype.names:
+        times, states = data[data.dtype.names[0]], data[data.dtype.names[2]]
+    elif len(data):
+        times, _ids, states = zip(*data)
+    else:
+        times, states = [], []
+    times = np.asarray(times)
+    if times.dtype.kind != "M":
+        times = times.astype("M8[us]")
+    return times, np.asarray(states).astype(float)
+
+
+def find_event_pairs(states, event1, event2):
     """
-    Get the duration of the next event1/event2 combination.
+    Find each event1 that is followed by an event2. Repeated events are paired up the same way as stepping through
+    the events: the first event1 of a run of event1s is paired with the first event2 of the run that follows it. Other
+    events (e.g. NaN) are skipped.
 
-    :param data: list of tuples, of the form (datetime, int)
+    :param states: array of event types (in time order)
     :param event1: the event that starts the matching of the pattern
     :param event2: the event that ends the matching of the pattern
-    :return tuple of the form (datetime, float, data) where datetime is the timestamp when event1 occurred, float is the duration between the next event1/event2 (in secs), and the remaining data with event1/event2 removed
+    :return: tuple of the form (starts, ends), arrays of the indexes in states of each event1 and its event2
     """
-    data = find_next_event(data, event1)
-    if data is None:  # could not find event
-        return None, None, None
-    on_event_ts = data[0][0]
-    # print("next event %s @ %s" % (event1, on_event_ts))
+    index = np.flatnonzero((states == event1) | (states == event2))
+    if not len(index):
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    matched = states[index]
+    runs = np.flatnonzero(np.concatenate(([True], matched[1:] != matched[:-1])))  # index (in matched) of each run
+    run_states = matched[runs]
+    pairs = np.flatnonzero((run_states[:-1] == event1) & (run_states[1:] == event2))
+    return index[runs[pairs]], index[runs[pairs + 1]]
 
-    data = find_next_event(data[1:], event2)
-    if data is None:  # could not find event
-        return None, None, None
-    off_event_ts = data[0][0]
-    # print("next event %s @ %s" % (event2, off_event_ts))
 
-    return on_event_ts, off_event_ts - on_event_ts, data
+def find_durations(times, states, event1, event2, start=0):
+    """
+    Find the event1/event2 pairs with a non-zero duration (events logged in the same second are ignored)
+
+    :param times: datetime64 array of the time of each event
+    :param states: array of event types
+    :param event1: event type to start the duration
+    :param event2: event type to end the duration
+    :param start: index of the 1st event to look at, e.g. the end of the last pair found by a previous call
+    :return: tuple of the form (starts, ends), arrays of the indexes of each event1 and its event2
+    """
+    starts, ends = find_event_pairs(states[start:], event1, event2)
+    starts += start
+    ends += start
+    non_zero = times[ends] != times[starts]
+    return starts[non_zero], ends[non_zero]
+
+
+def durations_frame(times, starts, ends, col):
+    """
+    :param times: datetime64 array of the time of each event
+    :param starts: array of the indexes of each event1
+    :param ends: array of the indexes of the matching event2s
+    :param col: label for the durations column
+    :return: dataframe containing time of each event1 and the duration (in secs) for the event1-event2 pair
+    """
+    if len(starts):
+        # convert to seconds - gives clearer graphs
+        durations = (times[ends] - times[starts]) / np.timedelta64(1, "s")
+        df = pd.DataFrame({"time": pd.to_datetime(times[starts]), col: durations})
+    else:
+        df = pd.DataFrame(columns=["time", col])
+    return df.set_index('time')
 
 
 def create_durations_for_event_pair(data, event1, event2, col, strip_outliers=False):
     """
     Calculate durations of pump on/off.
 
-    :param data: list of tuples, of the form (datetime, int)
+    :param data: list of tuples, of the form (datetime, int, int), or a structured array of events
     :param event1: event type to start the duration
     :param event2: event type to end the duration
     :param col: label for the durations column to use in the returned dataframe
     :param strip_outliers: if true then ignore values +/- 1 std dev from the arithmetic mean
     :return: dataframe containing time of each event1 and the duration for the event1-event2 pair
     """
-    durations = []
-
-    while data is not None:
-        event_ts, pump_duration, data = find_next_duration(data, event1, event2)
-        if pump_duration:
-            pump_duration = pump_duration.total_seconds()  # convert to seconds - gives clearer graphs
-            durations.append({'time': event_ts, col: pump_duration})
-
-    df = pd.DataFrame(columns=["time", col])
-    # df = pd.DataFrame(durations)
-    if durations:  # raises exception if try to append empty list
-        df = df.append(durations)
-
-    df.set_index('time', inplace=True)
+    times, states = event_columns(data)
+    df = durations_frame(times, *find_durations(times, states, event1, event2), col)
 
     # drop values > +/- 1 std dev
     if strip_outliers:
@@ -104,24 +137,56 @@ def create_durations_for_event_pair(data, event1, event2, col, strip_outliers=Fa
     return df
 
 
-def thingspeak_str2date(x):
+def update_cache(cache):
+    """
+    Extend the ON/OFF and OFF/ON pairs in an analysis cache with the pairs in the new events.
+    Only the events after the end of the last cached pair are looked at.
+
+    :param cache: analysis_cache.AnalysisCache, already updated with the new events
+    :return: dict of duration column -> tuple of the form (starts, ends), the indexes of all the pairs
+    (see graph_jobs)
+    """
+    pairs = {}
+    for col, event1, event2 in DURATIONS:
+        ends = cache.series.get(col + "_ends")
+        resume = int(ends[-1]) if ends is not None and len(ends) else 0
+        times, states = event_columns(cache.data[resume:])
+        starts, ends = find_durations(times, states, event1, event2)
+        cache.append(col + "_starts", starts + resume)
+        cache.append(col + "_ends", ends + resume)
+        pairs[col] = cache.series[col + "_starts"], cache.series[col + "_ends"]
+    return pairs
+
+
+def read_store(path, channel="pump", days=None):
     """
-    Convert string in ThingSpeak files to datetime
+    Read pump events from a local store (see loggers.LocalStore)
 
-    :param x: the string to convert to a data of the form %Y-%m-%d %H:%M:%S UTC
-    :return a datetime representing x
+    :param path: the database file
+    :param channel: the channel the pump events were logged to
+    :param days: only read the events of the last n days (uses the time index). None reads all events.
+    :return: structured array with the same columns as a ThingSpeak export (created_at, entry_id, field1)
     """
-    return datetime.strptime(x.decode("utf-8"), "%Y-%m-%d %H:%M:%S UTC")
+    import loggers
 
+    start = datetime.utcnow() - timedelta(days=days) if days else None
+    store = loggers.LocalStore(path, channel)
+    try:
+        return store.query_array(start=start)
+    finally:
+        store.close()
 
-def plot_durations(df):
+
+def plot_durations(df, ax=None):
     """
     Plot a graph of durations (can be ON-OFF or OFF-ON)
 
     :param df: dataframe containing time of each event1 and the duration for the event1-event2 pair
+    :param ax: the axes to plot on. None plots on a new pyplot figure.
+    :return: the axes
     """
     # print(df)
-    ax = df.plot(kind="bar", linewidth=0, logy=False, legend=False)
+    ax = df.plot(kind="bar", linewidth=0, logy=False, legend=False, ax=ax)
     ax.get_xaxis().set_ticks([])  # need to clear xticks here (cannot set in .plot function)
     ax.set_xlabel("t")
     ax.set_ylabel("duration")
@@ -136,81 +201,132 @@ def plot_durations(df):
     last_duration = last_row.iat[0]
     last_ts = last_row.name
     ax.axhline(last_duration, color='r')
-    ax.text(0, last_duration, "last = %s @ %s" % (str(timedelta(seconds=int(last_duration))), last_ts))
+    ax.text(0, last_duration, "last = %s @ %s" % (str(timedelta(seconds=int(last_duration))), last_ts))
+    return ax
 
 
-def build_graphs(filename, truncate, show_graphs=False):
+def draw_activity(fig, df):
+    """Draw the pump on/off events"""
+    ax = df.plot(x="time", y="pump", legend=False, ax=fig.add_subplot(111))
+    ax.set_ylabel("on/off")
+    ax.set_title("Pump activity")
+
+
+def draw_durations(fig, df, title):
+    """Draw a graph of durations (see plot_durations)"""
+    ax = plot_durations(df, fig.add_subplot(111))
+    ax.set_title(title)
+
+
+def read_data(filename):
     """
-    Generate graphs for pump data and save files as .PNG
+    Read pump events from a ThingSpeak export
 
-    :param show_graphs if true then show each graph interactively (as well as saving as PNG)
+    :return: structured array (see thingspeak_csv)
     """
     print("Reading data from %s..." % filename)
+    return thingspeak_csv.read(filename, ["created_at", "entry_id", "field1"])
 
-    data = genfromtxt(filename, delimiter=",", dtype=None, names=True, converters={0: thingspeak_str2date})
-    print("Read %d entries" % len(data))
-    print(data.dtype.names)
 
-    print("Generating graphs...")
+def read_recent(filename, truncate):
+    """
+    Read only the end of a pump export: enough events for the last truncate events and the last truncate durations of
+    each type. The number of rows read from the end of the file is doubled until there are enough.
+    A pair that starts in the 1st run of ONs (or OFFs) read may really start before it (with an event that was not read),
+    so those pairs are dropped unless the whole file was read.
+
+    :param filename: the export
+    :param truncate: number of most recent events (and durations) needed
+    :return: tuple of the form (data, pairs) (see graph_jobs)
+    """
+    rows = 4 * truncate + 1
+    while True:
+        data, complete = thingspeak_csv.read_tail(filename, rows, ["created_at", "entry_id", "field1"])
+        times, states = event_columns(data)
+        first = np.flatnonzero(np.isin(states, [pw.PUMP_ON, pw.PUMP_OFF]))[:1]  # start of the 1st run
+        pairs = {}
+        for col, event1, event2 in DURATIONS:
+            starts, ends = find_durations(times, states, event1, event2)
+            exact = starts != (first[0] if len(first) and not complete else -1)
+            pairs[col] = starts[exact], ends[exact]
+        if complete or min(len(starts) for starts, _ends in pairs.values()) >= truncate:
+            print("Read the last %d entries of %s" % (len(data), filename))
+            return data, pairs
+        rows *= 2
+
+
+def graph_jobs(data, truncate, pairs=None):
+    """
+    The graphs of pump data (see render.render_all)
 
-    if not show_graphs:
-        matplotlib.use("Agg")  # allows figures to be generated on headless server
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    sns.set(style="dark")
+    :param data: pump events
+    :param truncate: number of most recent events (and durations) to plot
+    :param pairs: the ON/OFF and OFF/ON pairs already found (see update_cache). If None then they are found in data.
+    :return: list of render.Job
+    """
+    if pairs is None:
+        times, states = event_columns(data)
+        pairs = {col: find_durations(times, states, event1, event2) for col, event1, event2 in DURATIONS}
+    else:
+        times = data["created_at"]
 
-    time, _sample_id, event = zip(*data)  # unpack to positional args --> unzip
+    time, _sample_id, event = zip(*data[-truncate:])  # unpack to positional args --> unzip
 
     # ---------- FIGURE ----------
-    # plot raw data
+    # plot raw data (truncated)
     df = pd.DataFrame({"time": time, "pump": event})
 
-    # truncate data
-    # print("Truncating to %d entries" % truncate)
-    df = df[-truncate:]
-    # print(df)
-    ax = df.plot(x="time", y="pump", legend=False)
-    ax.set_ylabel("on/off")
-    plt.title("Pump activity")
-    plt.savefig("graphs/fig_pump.png", bbox_inches="tight")
-
     # ---------- FIGURE ----------
-    # plot durations when pump is on/off
-    on_off_df = create_durations_for_event_pair(data, pw.PUMP_ON, pw.PUMP_OFF, "on_duration")
-
-    # truncate data
-    on_off_df = on_off_df[-truncate:]
-    plot_durations(on_off_df)
-    plt.title("Pump ON/OFF durations")
-    plt.savefig("graphs/fig_pump_durations_on_off.png", bbox_inches="tight")
+    # plot durations when pump is on/off (truncated)
+    starts, ends = pairs["on_duration"]
+    on_off_df = durations_frame(times, starts[-truncate:], ends[-truncate:], "on_duration")
 
     # ---------- FIGURE ----------
-    off_on_df = create_durations_for_event_pair(data, pw.PUMP_OFF, pw.PUMP_ON, "off_duration")
-
-    # truncate data
-    off_on_df = off_on_df[-truncate:]
-    plot_durations(off_on_df)
-    plt.title("Pump OFF/ON durations")
-    plt.savefig("graphs/fig_pump_durations_off_on.png", bbox_inches="tight")
-
-    if show_graphs:
-        plt.show()
-    return
+    starts, ends = pairs["off_duration"]
+    off_on_df = durations_frame(times, starts[-truncate:], ends[-truncate:], "off_duration")
 
     # do not create these graphs
 
     # ---------- FIGURE ----------
     # drop upper/lower percentiles
-    on_durations = on_durations[
-        (on_durations >= np.percentile(on_durations, 10)) & (on_durations <= np.percentile(on_durations, 90))]
-    print("stripped percentile durations:", len(on_durations))
-    print("mean duration = ", np.mean(on_durations))
-    df = pd.DataFrame({"excl. upper/lower percentile pump duration": on_durations})
-    # print(df)
-    df.plot(kind="bar", legend=False)
+    # on_durations = on_durations[
+    #     (on_durations >= np.percentile(on_durations, 10)) & (on_durations <= np.percentile(on_durations, 90))]
+    # print("stripped percentile durations:", len(on_durations))
+    # print("mean duration = ", np.mean(on_durations))
+    # df = pd.DataFrame({"excl. upper/lower percentile pump duration": on_durations})
+    # df.plot(kind="bar", legend=False)
+
+    style = ("dark", None)
+    return [render.Job("graphs/fig_pump.png", draw_activity, (df,), style),
+            render.Job("graphs/fig_pump_durations_on_off.png", draw_durations, (on_off_df, "Pump ON/OFF durations"),
+                       style),
+            render.Job("graphs/fig_pump_durations_off_on.png", draw_durations, (off_on_df, "Pump OFF/ON durations"),
+                       style)]
+
+
+def build_graphs(filename, truncate, show_graphs=False, data=None, pairs=None, workers=None):
+    """
+    Generate graphs for pump data and save files as .PNG
+
+    :param show_graphs if true then show each graph interactively (as well as saving as PNG)
+    :param data: pump events already loaded (e.g. from a LocalStore). If None then the events are read from filename.
+    :param pairs: the ON/OFF and OFF/ON pairs already found (see update_cache). If None then they are found in data.
+    :param workers: max number of processes rendering the graphs in parallel (see render.render_all)
+    """
+    if data is None:
+        data, pairs = read_recent(filename, truncate)  # only the end of the file is plotted
+    print("Read %d entries" % len(data))
+    print(data.dtype.names)
+    if not len(data):
+        print("No pump events to plot")
+        return
 
-    if show_graphs:
-        plt.show()
+    print("Generating graphs...")
+    jobs = graph_jobs(data, truncate, pairs)
+
+    if not show_graphs:
+        matplotlib.use("Agg")  # allows figures to be generated on headless server
+    render.render_all(jobs, show_graphs, workers)
 
 
 def main():
@@ -219,22 +335,41 @@ def main():
     Supports multiple cmd-line args
     """
     parser = argparse.ArgumentParser(description='Analyses data from ThinkSpeak.com and generates graphs.')
-    parser.add_argument('filename', help='file to process')
+    parser.add_argument('filename', nargs="?", help='file to process')
     parser.add_argument('--show', dest='show', action='store_true', default=False,
                         help='show graphs (as well as saving)')
     parser.add_argument('--create', dest="create_data", action="store_true", default=False, help="create test data")
+    parser.add_argument('--samples', type=int, default=40, help="number of events to create (with --create)")
+    parser.add_argument('--seed', type=int, help="seed for the random test data (with --create)")
+    parser.add_argument('--store', help="read the events from a local store (database file) instead of a file")
+    parser.add_argument('--channel', default="pump", help="channel to read from the local store")
+    parser.add_argument('--days', type=float, help="only read the events of the last n days from the local store")
+    parser.add_argument('--workers', type=int, help="number of processes rendering the graphs (default 1 per CPU)")
+    parser.add_argument('--cache', nargs="?", const="",
+                        help="keep the parsed events and durations in a cache file (default FILENAME.cache.npz), "
+                             "so the next run only processes the new events")
     args = parser.parse_args()
 
+    if args.store:
+        build_graphs(args.store, 100, args.show, data=read_store(args.store, args.channel, args.days),
+                     workers=args.workers)
+        return
+    if not args.filename:
+        parser.error("filename is required unless --store is given")
+
     if args.create_data:
         print("Creating test data...")
-        data = pw.gen_random_samples(40)
-        with open(args.filename, "w", newline='') as f:
-            writer = csv.writer(f)
-            header = [["created_at", "entry_id", "field1"]]
-            writer.writerows(header)
-            writer.writerows(data)
-
-    build_graphs(args.filename, 100, args.show)
+        pump_samples.write_csv(args.filename, args.samples, seed=args.seed)
+
+    if args.cache is not None:
+        cache = analysis_cache.AnalysisCache(args.cache or analysis_cache.default_path(args.filename))
+        cache.update(args.filename, ["created_at", "field1"])
+        pairs = update_cache(cache)
+        cache.save()
+        build_graphs(args.filename, 100, args.show, data=cache.data, pairs=pairs, workers=args.workers)
+        return
+
+    build_graphs(args.filename, 100, args.show, workers=args.workers)
 
 
 if __name__ == "__main__":
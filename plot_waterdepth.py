@@ -1,92 +1,94 @@
 import argparse
-import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import matplotlib
-import dateutil.tz
 import numpy as np
 import pandas as pd
 
+import analysis_cache
+import render
+import thingspeak_csv
+
+ROLLING_WIN_SIZE = 50  # number of values in the rolling mean
+# number of samples in the rolling min (see drop_distance_from_rolling_min). Too small and it will get distorted by
+# periods of false readings. Too large and it will over-strip values.
+MIN_WIN_SIZE = 50
+
 
 def read_data(filename):
     """
     Read waterdepth data from .csv file
 
     :param filename: the log data
-    :return: a tuple of the form x,y where x and y are lists of time and depth values
+    :return: a tuple of the form x,y where x and y are arrays of time (datetime64, UTC) and depth values
     """
     print("Reading data from %s..." % filename)
-    with open(filename, "rt") as csvfile:
-        rdr = csv.reader(csvfile)
-        data = []
-        for row in rdr:
-            data.append((row[0], row[2]))
-
-    x, y = zip(*data)  # * operator to unpack to positional args --> unzip
-
-    # drop the 1st elements (header names)
-    x = list(x)[1:]
-    y = list(y)[1:]
+    data = thingspeak_csv.read(filename, ["created_at", "field1"])
+    return data["created_at"], data["field1"]
 
-    return x, y
 
-
-def build_graphs(data, show_graphs=False):
+def read_store(path, channel="waterdepth", days=None):
     """
-    Build graphs from log data
+    Read waterdepth data from a local store (see loggers.LocalStore)
 
-    :param data: a tuple of x,y data sets where x and y are lists of time and depth values
-    :param show_graphs: toggle the interactive display of the graphs (true) or only save the graphs as PNG files (false)
+    :param path: the database file
+    :param channel: the channel the water depths were logged to
+    :param days: only read the values of the last n days (uses the time index). None reads all values.
+    :return: a tuple of the form x,y where x and y are arrays of time and depth values (same format as read_data)
     """
-    """Generates graphs for data (of the form x,y). Saves files as .PNG"""
-    print("Generating graphs...")
-    x, y = data
+    import loggers
 
-    # drop the timezones (data contains a mix of values)
-    # x = list(map(lambda s: s.replace(" CET", "").replace(" CEST", ""), x))
+    start = datetime.utcnow() - timedelta(days=days) if days else None
+    store = loggers.LocalStore(path, channel)
+    try:
+        data = store.query_array(start=start)
+    finally:
+        store.close()
 
-    # x = list(map(lambda d: datetime.strptime(d, "%Y-%m-%d %H:%M:%S UTC").replace(tzinfo=timezone.utc), x))
-    x = list(map(
-        lambda d: pd.to_datetime(str(datetime.strptime(d, "%Y-%m-%d %H:%M:%S UTC"))).replace(
-            tzinfo=dateutil.tz.tzutc()),
-        x))
+    return data["created_at"].astype("M8[s]"), data["field1"]
 
-    y = np.array(list(map(float, y)))
 
-    # print(x)
-    # print(y)
+def derive_series(x, y, start=0):
+    """
+    Calculate the series plotted by build_graphs for the values from start on. The values before start are only used to
+    fill the rolling windows, so the series of new values can be appended to those already calculated.
+
+    :param x: array of times (datetime64, UTC)
+    :param y: array of depth values
+    :param start: index of the 1st new value
+    :return: dict of name -> array: rolling_mean (of each value from start), clean (indexes of the values kept by
+    drop_distance_from_rolling_min), and day/day_total/day_count (sum and number of the clean values of each day)
+    """
+    y = np.asarray(y, dtype=float)
+    overlap = max(0, start - max(ROLLING_WIN_SIZE, MIN_WIN_SIZE) + 1)
+    df = pd.DataFrame({"depth": y[overlap:]}, index=np.arange(overlap, len(y)))
 
-    # -----------------------------------
-    # ------------- figures -------------
-    # -----------------------------------
+    rolling_mean = df["depth"].rolling(window=ROLLING_WIN_SIZE).mean().to_numpy()[start - overlap:]
+    clean = drop_distance_from_rolling_min(df).index.to_numpy()
+    clean = clean[clean >= start]
+    days, day_index = np.unique(np.asarray(x, dtype="M8[s]")[clean].astype("M8[D]"), return_inverse=True)
+    return {"rolling_mean": rolling_mean, "clean": clean, "day": days,
+            "day_total": np.bincount(day_index, y[clean], len(days)),
+            "day_count": np.bincount(day_index, minlength=len(days))}
 
-    if not show_graphs:
-        matplotlib.use("Agg")  # allows figures to be generated on headless server
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    sns.set(style="darkgrid")
 
-    # from pandas.plotting import register_matplotlib_converters
-    # register_matplotlib_converters()
-
-    # ---------- FIGURE ----------
-    # plot raw data - vanilla matplotlib
-    plt.plot(x, y, label="raw")
+def graph_jobs(data, series=None):
+    """
+    The graphs of water depth data (see render.render_all)
 
-    # plot mean and std dev - using numpy
-    mean = np.mean(y)
-    std = np.std(y)
-    plt.errorbar(x, [mean] * len(x), std, label="std dev")
+    :param data: a tuple of x,y data sets where x and y are arrays of time (datetime64, UTC) and depth values
+    :param series: the derived series already calculated (see derive_series). If None then they are calculated.
+    The daily totals may be split over several entries for the same day.
+    :return: list of render.Job
+    """
+    x, y = data
+    if series is None:
+        series = derive_series(x, y)
 
-    # plot rolling mean - using pandas Series
-    win_size = 50
-    rolling_mean = pd.Series(y).rolling(window=win_size).mean()
-    plt.plot(x, rolling_mean, label="rolling (win=%d)" % win_size)
+    # drop the timezones (data contains a mix of values)
+    # x = list(map(lambda s: s.replace(" CET", "").replace(" CEST", ""), x))
 
-    # fig, ax = plt.subplots()#ystart, yend = ax.get_ylim()
-    # plt.yticks(np.arange(0, yend, 1))
-    plt.xticks(rotation='vertical')
-    init_plot("Water depth readings", "date", "depth")
-    plt.savefig("graphs/fig_sensor.png", bbox_inches='tight')
+    x = pd.DatetimeIndex(x).tz_localize("UTC")
+    y = np.asarray(y, dtype=float)
 
     # ---------- FIGURE ----------
     # avg per hour - using pandas DF
@@ -124,27 +126,77 @@ def build_graphs(data, show_graphs=False):
 
     # ---------- FIGURE ----------
     # drop values outside rolling min
-    df = pd.DataFrame({"time": x, "depth": y})
-    df.set_index("time", inplace=True)
-    df = drop_distance_from_rolling_min(df)
-    # print(df.to_string())
-    df.plot()
-    init_plot("Cleaned sensor values (rolling min +/-)", "date", "depth")
+    clean_df = pd.DataFrame({"time": x[series["clean"]], "depth": y[series["clean"]]})
+    clean_df.set_index("time", inplace=True)
+
+    # ---------- FIGURE ----------
+    # avg per day (of the clean values)
+    days, day_index = np.unique(series["day"], return_inverse=True)
+    days = pd.DatetimeIndex(days, name="time")
+    daily_mean = np.bincount(day_index, series["day_total"]) / np.bincount(day_index, series["day_count"])
+    daily_df = pd.DataFrame({"depth": daily_mean}, index=pd.MultiIndex.from_arrays([days.year, days.month, days.day]))
+
+    style = ("darkgrid", None)
+    return [render.Job("graphs/fig_sensor.png", draw_raw, (x, y, series["rolling_mean"]), style),
+            render.Job("graphs/fig_sensor_clean.png", draw_clean, (clean_df,), style),
+            render.Job("graphs/fig_avg_daily.png", draw_daily, (daily_df,), style)]
+
+
+def build_graphs(data, show_graphs=False, series=None, workers=None):
+    """
+    Build graphs from log data
+
+    :param data: a tuple of x,y data sets where x and y are arrays of time (datetime64, UTC) and depth values
+    :param show_graphs: toggle the interactive display of the graphs (true) or only save the graphs as PNG files (false)
+    :param series: the derived series already calculated (see derive_series). If None then they are calculated.
+    :param workers: max number of processes rendering the graphs in parallel (see render.render_all)
+    """
+    """Generates graphs for data (of the form x,y). Saves files as .PNG"""
+    print("Generating graphs...")
+    jobs = graph_jobs(data, series)
+
+    if not show_graphs:
+        matplotlib.use("Agg")  # allows figures to be generated on headless server
+    render.render_all(jobs, show_graphs, workers)
+
+
+def draw_raw(fig, x, y, rolling_mean):
+    """Draw the raw water depths, their mean/std dev, and rolling mean"""
+    ax = fig.add_subplot(111)
+
+    # plot raw data - vanilla matplotlib
+    ax.plot(x, y, label="raw")
+
+    # plot mean and std dev - using numpy
+    mean = np.mean(y)
+    std = np.std(y)
+    ax.errorbar(x, [mean] * len(x), std, label="std dev")
+
+    # plot rolling mean (see derive_series)
+    ax.plot(x, rolling_mean, label="rolling (win=%d)" % ROLLING_WIN_SIZE)
+
+    # ystart, yend = ax.get_ylim()
+    # ax.set_yticks(np.arange(0, yend, 1))
+    ax.tick_params(axis="x", labelrotation=90)
+    init_plot(ax, "Water depth readings", "date", "depth")
+
+
+def draw_clean(fig, df):
+    """Draw the water depths kept by drop_distance_from_rolling_min"""
+    ax = df.plot(ax=fig.add_subplot(111))
+    init_plot(ax, "Cleaned sensor values (rolling min +/-)", "date", "depth")
     ymax = df["depth"].max()
     ymin = df["depth"].min()
-    plt.ylim(max(0, (ymin - (ymin * 0.1))), ymax + (ymax * 0.1))
-    plt.savefig("graphs/fig_sensor_clean.png", bbox_inches='tight')
+    ax.set_ylim(max(0, (ymin - (ymin * 0.1))), ymax + (ymax * 0.1))
 
-    # ---------- FIGURE ----------
-    # avg per day - using pandas DF re-indexing (and pandas plot wrapper)
-    # df = pd.DataFrame({"time": x, "depth": y})
-    # df.set_index("time", inplace=True)
-    df = df.groupby([df.index.year, df.index.month, df.index.day]).aggregate(np.mean)
-    ax = df.plot(kind="bar")  # uses plot method of df
-    init_plot("Average water depth by day", "date", "depth")
+
+def draw_daily(fig, df):
+    """Draw the average water depth of each day"""
+    ax = df.plot(kind="bar", ax=fig.add_subplot(111))  # uses plot method of df
+    init_plot(ax, "Average water depth by day", "date", "depth")
     ymax = df["depth"].max()
     ymin = df["depth"].min()
-    plt.ylim(max(0, (ymin - (ymin * 0.1))), ymax + (ymax * 0.1))
+    ax.set_ylim(max(0, (ymin - (ymin * 0.1))), ymax + (ymax * 0.1))
 
     # hide some xlabels (otherwise gets too busy)
     spacing = 5
@@ -160,29 +212,21 @@ def build_graphs(data, show_graphs=False):
     ax.axhline(last_depth, color='r')
     ax.text(0, last_depth, "last = %.2fcm @ %s" % (last_depth, last_ts))
 
-    plt.savefig("graphs/fig_avg_daily.png", bbox_inches='tight')
-
-    # show graphs?
-    if show_graphs:
-        plt.show()
-
-    plt.close()
-
 
-def init_plot(title, xlabel, ylabel):
+def init_plot(ax, title, xlabel, ylabel):
     """
     Setup each plot with standard labels, title etc.
 
+    :param ax: the axes of the plot
     :param title: title to place at the top of the graph
     :param xlabel: x axis label
     :param ylabel: y axis label
     :return:
     """
-    import matplotlib.pyplot as plt
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.title(title)
-    plt.legend()
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.legend()
 
 
 def drop_1std_from_mean(df):
@@ -219,10 +263,9 @@ def drop_distance_from_rolling_min(df):
     :param df: dataframe containing the time and depth data
     :return: the filtered dataframe with dropped values removed
     """
-    min_win_size = 50   # Number of samples to include in sample. Too small and it will get distorted by periods of false readings. Too large and it will over-strip values.
     tolerance = 10      # Increase/decrease (cm) permitted compared to rolling minimum. Too small will prevent larger changes.
 
-    rolling_min = df.rolling(window=min_win_size).min()
+    rolling_min = df.rolling(window=MIN_WIN_SIZE).min()
 
     return df[
         df["depth"].between(rolling_min["depth"] - tolerance, rolling_min["depth"] + tolerance)]
@@ -231,10 +274,29 @@ def drop_distance_from_rolling_min(df):
 if __name__ == "__main__":
     # read command-line args
     parser = argparse.ArgumentParser(description='Analyses data from ThinkSpeak.com and generates graphs.')
-    parser.add_argument('filename', help='file to process')
+    parser.add_argument('filename', nargs="?", help='file to process')
     parser.add_argument('--show', dest='show', action='store_true', default=False,
                         help='show graphs (as well as saving)')
+    parser.add_argument('--store', help="read the values from a local store (database file) instead of a file")
+    parser.add_argument('--channel', default="waterdepth", help="channel to read from the local store")
+    parser.add_argument('--days', type=float, help="only read the values of the last n days from the local store")
+    parser.add_argument('--workers', type=int, help="number of processes rendering the graphs (default 1 per CPU)")
+    parser.add_argument('--cache', nargs="?", const="",
+                        help="keep the parsed values and derived series in a cache file (default FILENAME.cache.npz), "
+                             "so the next run only processes the new values")
 
     args = parser.parse_args()
 
-    build_graphs(read_data(args.filename), args.show)
+    if args.store:
+        build_graphs(read_store(args.store, args.channel, args.days), args.show, workers=args.workers)
+    elif args.filename and args.cache is not None:
+        cache = analysis_cache.AnalysisCache(args.cache or analysis_cache.default_path(args.filename))
+        start = cache.update(args.filename, ["created_at", "field1"])
+        for name, values in derive_series(cache.data["created_at"], cache.data["field1"], start).items():
+            cache.append(name, values)
+        cache.save()
+        build_graphs((cache.data["created_at"], cache.data["field1"]), args.show, cache.series, args.workers)
+    elif args.filename:
+        build_graphs(read_data(args.filename), args.show, workers=args.workers)
+    else:
+        parser.error("filename is required unless --store is given")
@@ -2,38 +2,49 @@ import argparse
 import itertools
 import math
 import matplotlib
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from numpy import genfromtxt
+import analysis_cache
+import render
+import thingspeak_csv
 
 
-def build_graphs(filename, show_graphs=False):
-    """Generates graphs for data (of the form x,y). Saves files as .PNG"""
-    print("Reading data from %s..." % filename)
+def read_store(path, channel="weather", days=None):
+    """
+    Read weather readings from a local store (see loggers.LocalStore)
 
-    def str2date(d):
-        return datetime.strptime(d.decode("utf-8"), "%Y-%m-%d %H:%M:%S UTC")
+    :param path: the database file
+    :param channel: the channel the weather readings were logged to
+    :param days: only read the readings of the last n days (uses the time index). None reads all readings.
+    :return: structured array with the same columns as a ThingSpeak export (created_at, entry_id, field1..4)
+    """
+    import loggers
 
-    data = genfromtxt(filename, delimiter=",", dtype=None, names=True, converters={0: str2date})
-    print(data.dtype.names)
+    start = datetime.utcnow() - timedelta(days=days) if days else None
+    store = loggers.LocalStore(path, channel)
+    try:
+        return store.query_array(start=start, num_fields=4)
+    finally:
+        store.close()
 
-    print("Generating graphs...")
 
-    # -----------------------------------
-    # ------------- figures -------------
-    # -----------------------------------
+def read_data(filename):
+    """
+    Read weather readings from a ThingSpeak export
+
+    :return: structured array (see thingspeak_csv)
+    """
+    print("Reading data from %s..." % filename)
+    return thingspeak_csv.read(filename, ["created_at", "field1", "field2", "field3", "field4"])
 
-    if not show_graphs:
-        matplotlib.use("Agg")  # allows figures to be generated on headless server
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    sns.set(style="darkgrid")
-    font = {'size': 6}
-    matplotlib.rc('font', **font)
 
-    # from pandas.plotting import register_matplotlib_converters
-    # register_matplotlib_converters()
+def graph_jobs(data):
+    """
+    The graphs of weather data (see render.render_all)
 
+    :param data: weather readings
+    :return: list of render.Job
+    """
     # tuples of title/data
     graph_data = [
         ("time", data["created_at"]),
@@ -42,16 +53,20 @@ def build_graphs(filename, show_graphs=False):
         ("pressure", data["field3"]),
         ("rainfall", data["field4"])
     ]
+    return [render.Job("graphs/fig_weather.png", draw_pairs, (graph_data,), ("darkgrid", {"font.size": 6}))]
+
 
+def draw_pairs(fig, graph_data):
+    """Draw a scatter graph of each pair of values, in a grid"""
     # generate all combinations of data pairs
-    # TODO does this duplicate data lists?
     pairs = list(itertools.combinations(graph_data, 2))
 
     # calculate grid of subplots
     subplots_cols = 3
     subplots_rows = math.ceil(len(pairs) / subplots_cols)
     print("Graph layout (%d, %d)" % (subplots_rows, subplots_cols))
-    _fig, axs = plt.subplots(subplots_rows, subplots_cols, figsize=(15, 8))
+    fig.set_size_inches(15, 8)
+    axs = fig.subplots(subplots_rows, subplots_cols)
 
     # iterate over each ax and plot the data pair
     for ax, (data_x, data_y) in zip(axs.flat, pairs):
@@ -63,19 +78,48 @@ def build_graphs(filename, show_graphs=False):
         ax.set_xlabel(label_x)
         ax.set_ylabel(label_y)
 
-    plt.savefig("graphs/fig_weather.png", bbox_inches='tight')
-    if show_graphs:
-        plt.show()
-    plt.close()
+
+def build_graphs(filename, show_graphs=False, data=None, workers=None):
+    """Generates graphs for data (of the form x,y). Saves files as .PNG"""
+    if data is None:
+        data = read_data(filename)
+    print(data.dtype.names)
+
+    print("Generating graphs...")
+
+    # -----------------------------------
+    # ------------- figures -------------
+    # -----------------------------------
+
+    if not show_graphs:
+        matplotlib.use("Agg")  # allows figures to be generated on headless server
+    render.render_all(graph_jobs(data), show_graphs, workers)
 
 
 if __name__ == "__main__":
     # read command-line args
     parser = argparse.ArgumentParser(description='Analyses data from ThinkSpeak.com and generates graphs.')
-    parser.add_argument('filename', help='file to process')
+    parser.add_argument('filename', nargs="?", help='file to process')
     parser.add_argument('--show', dest='show', action='store_true', default=False,
                         help='show graphs (as well as saving)')
+    parser.add_argument('--store', help="read the readings from a local store (database file) instead of a file")
+    parser.add_argument('--channel', default="weather", help="channel to read from the local store")
+    parser.add_argument('--days', type=float, help="only read the readings of the last n days from the local store")
+    parser.add_argument('--workers', type=int, help="number of processes rendering the graphs (default 1 per CPU)")
+    parser.add_argument('--cache', nargs="?", const="",
+                        help="keep the parsed readings in a cache file (default FILENAME.cache.npz), so the next run "
+                             "only parses the new readings")
 
     args = parser.parse_args()
 
-    build_graphs(args.filename, args.show)
+    if args.store:
+        build_graphs(args.store, args.show, data=read_store(args.store, args.channel, args.days), workers=args.workers)
+    elif args.filename and args.cache is not None:
+        cache = analysis_cache.AnalysisCache(args.cache or analysis_cache.default_path(args.filename))
+        cache.update(args.filename, ["created_at", "field1", "field2", "field3", "field4"])
+        cache.save()
+        build_graphs(args.filename, args.show, data=cache.data, workers=args.workers)
+    elif args.filename:
+        build_graphs(args.filename, args.show, workers=args.workers)
+    else:
+        parser.error("filename is required unless --store is given")
@@ -5,19 +5,29 @@ from pump_watcher import AbstractPump
 class RpiGpioPump(AbstractPump):
     """Pump monitor using the RPi.GPIO library"""
 
-    def __init__(self, pin):
-        super(RpiGpioPump, self).__init__(pin)
+    def __init__(self, pins, **kwargs):
+        """
+        Setup the pins and register the callback
+
+        :param pins: the GPIO pin connected to the pump (physical pin number), or a list of PumpInputs
+        :param kwargs: debounce settings passed to AbstractPump
+        """
+        super(RpiGpioPump, self).__init__(pins, **kwargs)
 
         # GPIO Mode (BOARD / BCM)
         RPi.GPIO.setmode(RPi.GPIO.BOARD)
 
-        # pull-down resistor to avoid false triggers
-        # RPi.GPIO.setup(on_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        RPi.GPIO.setup(pin, RPi.GPIO.IN)
-        RPi.GPIO.add_event_detect(pin, RPi.GPIO.BOTH, callback=self.event, bouncetime=500)
+        for pin in self.inputs:
+            # pull-down resistor to avoid false triggers
+            # RPi.GPIO.setup(on_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            RPi.GPIO.setup(pin, RPi.GPIO.IN)
+            # no bouncetime: edges are debounced by AbstractPump (bouncetime can drop the last edge of a burst)
+            # the callback is passed the pin that changed
+            RPi.GPIO.add_event_detect(pin, RPi.GPIO.BOTH, callback=self.event)
 
     def get_status(self, pin):
         return RPi.GPIO.input(pin)
 
     def cleanup(self):
+        super(RpiGpioPump, self).cleanup()
         RPi.GPIO.cleanup()
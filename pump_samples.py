@@ -0,0 +1,158 @@
+# Vectorized (numpy) generator of synthetic pump events, for stress-testing the plotting and duration code with large
+# data sets. Simulates the same pump behaviour (and lost readings) as pump_watcher.gen_random_samples.
+import datetime
+
+import numpy as np
+
+import pump_watcher as pw
+
+# a pump event: time (secs), ThingSpeak entry id, PUMP_ON/PUMP_OFF. Packed (13 bytes) for the binary format.
+DTYPE = np.dtype([("created_at", "<M8[s]"), ("entry_id", "<u4"), ("field1", "u1")])
+
+# probability each PUMP_ON/PUMP_OFF event is recorded (the others are lost)
+P_ON = 1 - 0.2  # see pump_watcher.gen_mainly_on
+P_OFF = 0.8  # see pump_watcher.gen_mainly_off
+
+MIN_OFF_TIME = 45 * 60  # pump is off for at least 45 mins...
+MAX_EXTRA_OFF_TIME = 100 * 60  # ...plus up to 100 mins
+MAX_ON_TIME = 10 * 60  # pump is on for up to 10 mins
+
+
+# number of on/off cycles simulated at a time (fixed, so the events for a seed do not depend on the chunk size)
+BLOCK_CYCLES = 65536
+
+
+def simulate_cycles(rng, p_on, p_off):
+    """
+    Simulate blocks of pump cycles. Each cycle is a PUMP_ON then a PUMP_OFF, each of which may be lost.
+
+    :param rng: numpy random Generator
+    :return: generator of tuples of the form (events, gaps): the recorded events (in time order), and the time (secs)
+    since the previous event
+    """
+    events = np.empty((BLOCK_CYCLES, 2), dtype=np.uint8)
+    events[:, 0] = pw.PUMP_ON
+    events[:, 1] = pw.PUMP_OFF
+    gaps = np.empty((BLOCK_CYCLES, 2), dtype=np.int64)
+    recorded = np.empty((BLOCK_CYCLES, 2), dtype=bool)
+    while True:
+        recorded[:, 0] = rng.random(BLOCK_CYCLES) < p_on
+        recorded[:, 1] = rng.random(BLOCK_CYCLES) < p_off
+        gaps[:, 0] = MIN_OFF_TIME + rng.integers(0, MAX_EXTRA_OFF_TIME, BLOCK_CYCLES, endpoint=True)
+        gaps[:, 1] = rng.integers(0, MAX_ON_TIME, BLOCK_CYCLES, endpoint=True)
+
+        # the clock only moves on when an event is recorded (as in gen_random_samples)
+        yield events[recorded], gaps[recorded]
+
+
+def generate_chunks(length, chunk_size=1000000, seed=None, start=None, p_on=P_ON, p_off=P_OFF):
+    """
+    Generate pump events in chunks (so data sets larger than memory can be streamed to a file)
+
+    :param length: total number of events
+    :param chunk_size: max number of events per chunk
+    :param seed: seed for the random number generator (the same seed gives the same events, whatever the chunk size)
+    :param start: time (UTC datetime) the events start from. Defaults to now.
+    :param p_on: probability a PUMP_ON event is recorded
+    :param p_off: probability a PUMP_OFF event is recorded
+    :return: generator of structured arrays (see DTYPE)
+    """
+    if p_on + p_off <= 0:
+        raise ValueError("Some events must be recorded")
+    if start is None:
+        start = datetime.datetime.utcnow()
+    ts = np.datetime64(start.replace(tzinfo=None, microsecond=0), "s").astype(np.int64)
+    cycles = simulate_cycles(np.random.default_rng(seed), p_on, p_off)
+
+    events = np.empty(0, dtype=np.uint8)
+    gaps = np.empty(0, dtype=np.int64)
+    entry_id = 1
+    while entry_id <= length:
+        n = min(chunk_size, length - entry_id + 1)
+        while len(events) < n:
+            more_events, more_gaps = next(cycles)
+            events = np.concatenate((events, more_events))
+            gaps = np.concatenate((gaps, more_gaps))
+
+        times = ts + np.cumsum(gaps[:n])
+        chunk = np.empty(n, dtype=DTYPE)
+        chunk["created_at"] = times.astype("M8[s]")
+        chunk["entry_id"] = np.arange(entry_id, entry_id + n)
+        chunk["field1"] = events[:n]
+        yield chunk
+
+        events, gaps = events[n:], gaps[n:]
+        ts = times[-1]
+        entry_id += n
+
+
+def generate(length, seed=None, start=None, p_on=P_ON, p_off=P_OFF):
+    """
+    Generate pump events
+
+    :param length: number of events
+    :return: structured array (see DTYPE). Other params as generate_chunks.
+    """
+    chunks = list(generate_chunks(length, length or 1, seed, start, p_on, p_off))
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=DTYPE)
+
+
+def to_thingspeak_rows(chunk):
+    """
+    Convert events to the format of a ThingSpeak CSV export
+
+    :param chunk: structured array of events
+    :return: array of strings, 1 per row (e.g. "2019-06-06 12:12:56 UTC,492,1")
+    """
+    dates = np.char.replace(np.datetime_as_string(chunk["created_at"], unit="s"), "T", " ")
+    rows = np.char.add(dates, " UTC,")
+    rows = np.char.add(rows, chunk["entry_id"].astype("U10"))
+    rows = np.char.add(rows, ",")
+    return np.char.add(rows, chunk["field1"].astype("U1"))
+
+
+def write_csv(filename, length, chunk_size=100000, seed=None, start=None):
+    """
+    Write pump events to a CSV file (same format as a ThingSpeak export), 1 chunk at a time
+
+    :param filename: the file to write
+    :param length: number of events
+    :param chunk_size: number of events generated (and held in memory) at a time
+    :param seed: seed for the random number generator
+    :param start: time (UTC datetime) the events start from. Defaults to now.
+    """
+    with open(filename, "w", newline="") as f:
+        f.write("created_at,entry_id,field1\n")
+        for chunk in generate_chunks(length, chunk_size, seed, start):
+            f.write("\n".join(to_thingspeak_rows(chunk)))
+            f.write("\n")
+
+
+def write_binary(filename, length, chunk_size=1000000, seed=None, start=None):
+    """
+    Write pump events to a compact binary file (.npy of packed 13-byte records), 1 chunk at a time
+
+    :param filename: the file to write
+    :param length: number of events
+    :param chunk_size: number of events generated (and held in memory) at a time
+    :param seed: seed for the random number generator
+    :param start: time (UTC datetime) the events start from. Defaults to now.
+    """
+    data = np.lib.format.open_memmap(filename, mode="w+", dtype=DTYPE, shape=(length,))
+    i = 0
+    for chunk in generate_chunks(length, chunk_size, seed, start):
+        data[i:i + len(chunk)] = chunk
+        i += len(chunk)
+    data.flush()
+    del data
+
+
+def read_binary(filename, mmap=True):
+    """
+    Read pump events written by write_binary
+
+    :param filename: the file to read
+    :param mmap: map the file into memory instead of reading it (only the pages used are read)
+    :return: structured array (see DTYPE)
+    """
+    return np.load(filename, mmap_mode="r" if mmap else None)
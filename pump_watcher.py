@@ -1,46 +1,247 @@
 #! /usr/bin/python3
 
+import alarm
 import argparse
+import array
+import collections
 import datetime
+import itertools
+import os
 import random
 import loggers
+import metrics
+import runtime
+import threading
 import time
 
 PUMP_ON = 1
 PUMP_OFF = 0
 
 
+class EventRing:
+    """
+    Fixed-size history of GPIO edges (monotonic time, wall time, pin, level), oldest entries overwritten first.
+    Backed by preallocated arrays so recording an edge in the GPIO callback does not allocate.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Preallocate the history
+
+        :param capacity: max number of edges kept
+        """
+        self.capacity = capacity
+        self.monotonic_ns = array.array("q", [0] * capacity)
+        self.wall_time = array.array("d", [0.0] * capacity)
+        self.pins = array.array("i", [0] * capacity)
+        self.levels = array.array("b", [0] * capacity)
+        self.sequence = itertools.count()  # next() is atomic, so concurrent callbacks get different slots
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, monotonic_ns, wall_time, pin, level):
+        """
+        Record an edge
+
+        :param monotonic_ns: time.monotonic_ns() when the edge was seen
+        :param wall_time: time.time() when the edge was seen
+        :param pin: the GPIO pin
+        :param level: the level read from the pin
+        """
+        n = next(self.sequence)
+        i = n % self.capacity
+        self.monotonic_ns[i] = monotonic_ns
+        self.wall_time[i] = wall_time
+        self.pins[i] = pin
+        self.levels[i] = level
+        self.count = max(self.count, n + 1)
+
+    def items(self):
+        """
+        The edges in the history
+
+        :return: list of tuples of the form (monotonic_ns, wall_time, pin, level), oldest first
+        """
+        count = self.count
+        start = max(0, count - self.capacity)
+        return [(self.monotonic_ns[n % self.capacity], self.wall_time[n % self.capacity],
+                 self.pins[n % self.capacity], self.levels[n % self.capacity]) for n in range(start, count)]
+
+
+# a monitored GPIO input: name (used in messages), pin, and the (ThingSpeak) field number its status is logged to
+PumpInput = collections.namedtuple("PumpInput", ["name", "pin", "field"])
+
+
+def parse_input(spec, field=1):
+    """
+    Parse an input given on the command-line
+
+    :param spec: string of the form name:pin[:field], or just the pin number
+    :param field: field number used if the spec does not give one
+    :return: the PumpInput
+    """
+    parts = spec.split(":")
+    if len(parts) == 1:
+        return PumpInput("pin%s" % parts[0], int(parts[0]), field)
+    if len(parts) > 3 or not parts[0]:
+        raise ValueError("Input %s is not of the form name:pin[:field]" % spec)
+    return PumpInput(parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else field)
+
+
 class AbstractPump:
-    """Monitor of a sump pump. Logs when pump is activated/de-activated"""
+    """
+    Monitor of a sump pump (and other on/off inputs, e.g. float switches). Logs when each input is
+    activated/de-activated. All the inputs share the same loggers: each event has 1 field per input, and only the
+    field of the input that changed is set (the others are None).
+
+    Edges are debounced in software (the same for every GPIO library): a burst of edges is coalesced into a single
+    transition once the pin has been quiet for settle_time secs. Each edge only pushes back the deadline of the pin;
+    a single timer per pin waits for it. The pin is then read again (confirm_reads times, without holding the lock)
+    and the transition is ignored as a glitch unless every read agrees.
+    """
 
-    def __init__(self, pin):
-        """Setup a pump watcher on the specific GPIO pin"""
+    def __init__(self, pins, history=1024, settle_time=0, confirm_reads=0, confirm_interval=0.005):
+        """
+        Setup a pump watcher on the specific GPIO pin(s)
+
+        :param pins: the GPIO pin connected to the pump, or a list of PumpInputs to monitor several inputs
+        :param history: number of GPIO edges to keep in the history
+        :param settle_time: time (in secs) the pin must be quiet before the new status is read. 0 reads (and logs)
+        the status immediately in the callback.
+        :param confirm_reads: number of extra reads that must agree with the settled status
+        :param confirm_interval: time (in secs) between the confirm reads
+        """
+        if isinstance(pins, int):
+            pins = [PumpInput("pump", pins, 1)]
+        if len({i.pin for i in pins}) != len(pins) or len({i.field for i in pins}) != len(pins):
+            raise ValueError("Each input needs its own pin and field")
 
         # list of loggers (to allow >1)
         self.loggers = []
 
-        # store the pin for use in the callback
-        self.pin = pin
+        # store the pins for use in the callback
+        self.inputs = collections.OrderedDict((i.pin, i) for i in pins)
+        self.pin = pins[0].pin  # pin used if the GPIO library does not say which pin changed
+        self.num_fields = max(i.field for i in pins)
 
         # used to prevent duplicate events (pull-down resistor does not fix it)
-        self.prev_status = None
+        self.prev_status = {pin: None for pin in self.inputs}
+
+        # every edge seen by the callback (incl. duplicates)
+        self.history = EventRing(history)
+
+        self.settle_time = settle_time
+        self.confirm_reads = confirm_reads
+        self.confirm_interval = confirm_interval
+        self.lock = threading.Lock()
+        self.timers = {}  # pin -> timer waiting for the pin to settle
+        self.deadlines = {}  # pin -> time (monotonic) the pin settles unless there is another edge
+        self.first_edges = {}  # pin -> time of the 1st edge of the burst waiting to settle
 
-    def event(self, *_args):
+        self.edges = 0  # callbacks received
+        self.transitions = 0  # changes of status logged
+        self.glitches = 0  # bursts where the confirm reads did not agree
+
+    @metrics.timed("pump_event_seconds")
+    def event(self, *args):
         """
         Callback to log an event change to the configured loggers.
-        Uses variable args because different GPIO libraries invoke with different parameters
+        Uses variable args because different GPIO libraries invoke with different parameters (the 1st arg is the pin
+        that changed, if known).
+        The time is captured before anything else, and passed to the loggers with the event (for a burst of edges,
+        the time of the 1st edge).
         """
-        status = self.get_status(self.pin)
-        print("%s: Status on pin %d --> %s" % (datetime.datetime.now(), self.pin, status))
-
-        if status == self.prev_status:
-            print("Status did not change. Skipping.")
-            return
+        now_ns = time.monotonic_ns()
+        now = time.time()
+        pin = args[0] if args and args[0] in self.inputs else self.pin
+        status = self.get_status(pin)
+        self.history.append(now_ns, now, pin, status)
+
+        with self.lock:
+            self.edges += 1
+            if self.settle_time > 0:
+                # restart the settle period (the pending timer, if any, is re-armed when it expires)
+                self.first_edges.setdefault(pin, (now_ns, now))
+                self.deadlines[pin] = time.monotonic() + self.settle_time
+                if pin not in self.timers:
+                    self.arm(pin, self.settle_time)
+                return
+        self.settle(pin, status, (now_ns, now))
+
+    def arm(self, pin, delay):
+        """Start the timer waiting for the pin to settle (called with the lock held)"""
+        timer = self.timers[pin] = threading.Timer(delay, self.settled, args=(pin,))
+        timer.daemon = True
+        timer.start()
+
+    def settled(self, pin):
+        """Timer thread. Settle the pin if it has been quiet for the settle time, otherwise wait until it has."""
+        with self.lock:
+            deadline = self.deadlines.get(pin)
+            if deadline is None:  # cleaned up
+                self.timers.pop(pin, None)
+                return
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                self.arm(pin, remaining)
+                return
+            del self.timers[pin]
+            first_edge = self.first_edges[pin]
+        self.settle(pin, self.get_status(pin), first_edge, deadline)
+
+    def settle(self, pin, status, first_edge, deadline=None):
+        """
+        Confirm the settled status and log it if it changed
 
+        :param pin: the pin that changed
+        :param status: the status read from the pin
+        :param first_edge: tuple (monotonic_ns, wall time) of the 1st edge of the burst
+        :param deadline: the deadline of the pin when it settled (None if not debounced)
+        """
+        name, _pin, field = self.inputs[pin]
+        confirmed = True
+        for _i in range(self.confirm_reads):
+            time.sleep(self.confirm_interval)
+            if self.get_status(pin) != status:
+                confirmed = False
+                break
+
+        with self.lock:
+            if deadline is not None:
+                if self.deadlines.get(pin) != deadline:
+                    return  # another edge (or cleanup) during the confirm reads: the pin settles again later
+                del self.deadlines[pin]
+                del self.first_edges[pin]
+
+            if not confirmed:
+                self.glitches += 1
+                metrics.inc("pump_glitches_total", input=name)
+                print("Status of %s (pin %d) did not settle. Ignoring glitch." % (name, pin))
+                return
+
+            if status == self.prev_status[pin]:
+                print("Status of %s (pin %d) did not change (%s). Skipping." % (name, pin, status))
+                return
+
+            now_ns, now = first_edge
+            fields = [None] * self.num_fields
+            fields[field - 1] = status
+            event = loggers.Event(fields, datetime.datetime.fromtimestamp(now, datetime.timezone.utc), now_ns)
+            self.prev_status[pin] = status
+            self.transitions += 1
+
+        # log without holding the lock, so the other pins (and timers) do not wait for the listeners
+        metrics.inc("pump_events_total", input=name, status=status)
+        print("%s: Status of %s (pin %d) --> %s" % (event.created_at, name, pin, status))
         for l in self.loggers:
             if l:  # ignore empty loggers
-                l.log([status])
-        self.prev_status = status
+                l.log(event)
+
+    def suppressed(self):
+        """Number of edges that did not result in a logged transition"""
+        return self.edges - self.transitions
 
     @staticmethod
     def get_status(_pin):
@@ -57,7 +258,13 @@ class AbstractPump:
         self.loggers.append(new_logger)
 
     def cleanup(self):
-        pass
+        """Stop waiting for the pin to settle"""
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+            self.deadlines.clear()
+            self.first_edges.clear()
 
 
 def gen_random_samples(length):
@@ -128,23 +335,63 @@ if __name__ == '__main__':
     # read command-line args
     parser = argparse.ArgumentParser(
         description="Monitor the on/off switching of a sump pump")
-    parser.add_argument("gpio_pin", help="GPIO pin connected to the pump", type=int)
+    parser.add_argument("inputs", nargs="+", metavar="input",
+                        help="GPIO pin connected to the pump. To monitor several inputs, give each one as "
+                             "name:pin[:field] (e.g. pump:22:1 float:24:2). Alarms watch the 1st input.")
     parser.add_argument("--thingspeak", dest="thing_speak_api",
                         help="API key to write new sensor readings to thingspeak.com channel")
+    parser.add_argument("--thingspeak-channel", dest="thing_speak_channel",
+                        help="ThingSpeak channel ID. If set, events are buffered and sent in bulk updates.")
     parser.add_argument("--healthchecks", dest="healthchecks_url",
                         help="healthchecks.io URL to ping when pump is activated")
     parser.add_argument("--gpio", help="GPIO library to use implementation", type=str, choices=["RPi.GPIO", "wiringpi"],
                         dest="gpio_lib", default=None)
+    parser.add_argument("--spool", help="directory where events are spooled until they have been logged")
+    parser.add_argument("--store", help="also record events in a local database file (see plot_pump.py --store)")
+    parser.add_argument("--timeout", help="max time (secs) to wait for each logger", type=float, default=10)
+    parser.add_argument("--heartbeat", type=float,
+                        help="also ping the healthchecks.io URL every n mins (shows the watcher is still running)")
+    parser.add_argument("--queue-size", dest="queue_size", help="max number of events waiting to be logged", type=int,
+                        default=100)
+    parser.add_argument("--max-cycles", dest="max_cycles", type=int,
+                        help="raise an alarm if the pump switches on more than this many times in --cycle-window")
+    parser.add_argument("--cycle-window", dest="cycle_window", type=float, default=60,
+                        help="time window (mins) used for --max-cycles")
+    parser.add_argument("--max-on-time", dest="max_on_time", type=float,
+                        help="raise an alarm if the pump stays on for longer than this (mins)")
+    parser.add_argument("--debounce", type=float, default=500,
+                        help="time (ms) the pin must be stable before a change of status is logged")
+    parser.add_argument("--confirm-reads", dest="confirm_reads", type=int, default=2,
+                        help="number of extra reads of the pin needed to confirm a change of status")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int,
+                        help="serve timing metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-file", dest="metrics_file", help="write timing metrics to this JSON file")
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float, default=60,
+                        help="time between writes of the metrics file (secs)")
     args = parser.parse_args()
     print(args)
+    try:
+        inputs = [parse_input(spec, i + 1) for i, spec in enumerate(args.inputs)]
+    except ValueError as e:
+        parser.error(str(e))
+    pump_field = inputs[0].field - 1
+
+    metrics.start(args.metrics_port, args.metrics_file, args.metrics_interval)
 
     # --- Setup where to log the data
     all_loggers = []
+    batching = None
 
     # add a logger to ThingSpeak if defined
     if args.thing_speak_api:
         print("Adding ThingSpeak logger (API key %s)" % args.thing_speak_api)
-        all_loggers.append(loggers.ThingSpeak(args.thing_speak_api))
+        if args.thing_speak_channel:
+            # flushed by the event loop (see below) rather than its own timer thread
+            batching = loggers.BatchingThingSpeak(args.thing_speak_api, args.thing_speak_channel, max_delay=None,
+                                                  timeout=args.timeout)
+            all_loggers.append(batching)
+        else:
+            all_loggers.append(loggers.ThingSpeak(args.thing_speak_api, timeout=args.timeout))
     else:
         print("Adding console logger")
         all_loggers.append(loggers.ConsoleLogger())
@@ -152,34 +399,89 @@ if __name__ == '__main__':
     # add a logger to HealthChecks.io if defined
     if args.healthchecks_url:
         print("Adding HealthChecks logger (URL %s)" % args.healthchecks_url)
-        all_loggers.append(loggers.HealthChecks(args.healthchecks_url))
-
-    print("Connecting to pin %s" % args.gpio_pin)
+        all_loggers.append(loggers.HealthChecks(args.healthchecks_url, timeout=args.timeout))
+
+    # keep events on disk until they are logged (survives network outages and restarts)
+    if args.spool:
+        print("Spooling events to %s" % args.spool)
+        all_loggers = [loggers.SpooledLogger(logger, os.path.join(args.spool, "%s.spool" % type(logger).__name__))
+                       for logger in all_loggers]
+
+    # keep a local history of the events (for analysis without exporting from ThingSpeak)
+    if args.store:
+        print("Recording events in %s" % args.store)
+        all_loggers.append(loggers.LocalStore(args.store, "pump"))
+
+    # --- Setup alarms (reported on the console, and to HealthChecks.io as a failure if defined)
+    alarm_clock = loggers.AlarmClock()
+
+    def raise_alarm(message):
+        print("ALARM: %s" % message)
+        if args.healthchecks_url:
+            try:
+                loggers.HealthChecks(args.healthchecks_url.rstrip("/") + "/fail", timeout=args.timeout).log([message])
+            except Exception as e:
+                print("Could not report alarm: %s" % e)
+
+    if args.max_cycles:
+        alarm_clock.add_alarm(alarm.EventRate(PUMP_ON, args.max_cycles, args.cycle_window * 60, pump_field),
+                              lambda: raise_alarm("pump switched on more than %d times in %s mins" % (
+                                  args.max_cycles, args.cycle_window)))
+    if args.max_on_time:
+        alarm_clock.add_alarm(alarm.StateDuration(PUMP_ON, args.max_on_time * 60, pump_field),
+                              lambda: raise_alarm("pump on for more than %s mins" % args.max_on_time))
+
+    for name, pin, field in inputs:
+        print("Connecting %s to pin %s (field %d)" % (name, pin, field))
 
     # --- Create the pump monitor
+    debounce = {"settle_time": args.debounce / 1000, "confirm_reads": args.confirm_reads}
     pump = None
     if args.gpio_lib:
         if args.gpio_lib == "RPi.GPIO":
             import pump_rpio_gpio
 
             print("Using RPi.GPIO library")
-            pump = pump_rpio_gpio.RpiGpioPump(args.gpio_pin)
+            pump = pump_rpio_gpio.RpiGpioPump(inputs, **debounce)
         elif args.gpio_lib == "wiringpi":
             import pump_wiringpi
 
             print("Using wiringpi library")
-            pump = pump_wiringpi.WiringPiPump(args.gpio_pin)
+            pump = pump_wiringpi.WiringPiPump(inputs, **debounce)
     else:
         print("GPIO disabled")
-        pump = AbstractPump(args.gpio_pin)
+        pump = AbstractPump(inputs, **debounce)
 
     # add all the loggers setup previously
-    for logger in all_loggers:
-        pump.add_listener(logger)
+    # events are handed to an event loop so the GPIO callback is not blocked by slow network calls, and sent to all
+    # the loggers at the same time so a slow/hung logger does not delay the others
+    # (each logger gets 4 attempts of up to --timeout secs, plus the 1+2+4 secs backoff between them - or the
+    # logger's min interval between requests if longer, e.g. 15 secs for ThingSpeak)
+    retries = 3
+    timeouts = [args.timeout * (retries + 1) + sum(loggers.retry_delay(logger, attempt) for attempt in range(retries))
+                for logger in all_loggers]
+    fan_out = loggers.FanOutLogger(all_loggers, timeout=timeouts, retries=retries)
+    event_loop = runtime.AsyncRuntime([fan_out, alarm_clock], maxsize=args.queue_size, retries=0)
+    pump.add_listener(event_loop)
+
+    # periodic jobs run on the same loop
+    event_loop.every(60, alarm_clock.poll)
+    if batching:
+        event_loop.every(60, batching.flush)
+    if args.heartbeat and args.healthchecks_url:
+        heartbeat = loggers.HealthChecks(args.healthchecks_url, timeout=args.timeout)
+        event_loop.every(args.heartbeat * 60, lambda: heartbeat.log(["heartbeat"]))
 
     try:
         print("Waiting for events...")
-        while True:
-            time.sleep(86400)  # sleep 1 day
+        event_loop.stop_on_signals()
+        event_loop.run()
+        print("Stopped")
     finally:
         pump.cleanup()
+        event_loop.close()
+        fan_out.close()
+        print("Events dropped: %d, failed: %d" % (event_loop.dropped, event_loop.failed))
+        print("Logger stats: %s" % fan_out.stats())
+        print("Connection stats: %s" % loggers.default_pool.stats())
+        metrics.disable()
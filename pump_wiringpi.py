@@ -1,3 +1,5 @@
+import functools
+
 import wiringpi
 import pump_watcher
 
@@ -5,17 +7,24 @@ import pump_watcher
 class WiringPiPump(pump_watcher.AbstractPump):
     """Pump monitor using the Wiring Pi GPIO library"""
 
-    def __init__(self, pin):
-        super(WiringPiPump, self).__init__(pin)
+    def __init__(self, pins, **kwargs):
+        """
+        Setup the pins and register the callback
+
+        :param pins: the GPIO pin connected to the pump (physical pin number), or a list of PumpInputs
+        :param kwargs: debounce settings passed to AbstractPump
+        """
+        super(WiringPiPump, self).__init__(pins, **kwargs)
 
         # wiringpi.wiringPiSetupGpio()
         wiringpi.wiringPiSetupPhys()
 
-        wiringpi.pinMode(pin, wiringpi.GPIO.INPUT)
-        wiringpi.pullUpDnControl(pin, wiringpi.GPIO.PUD_OFF)    # use external pull-down resistor
-        wiringpi.wiringPiISR(pin, wiringpi.GPIO.INT_EDGE_BOTH, self.event)
-
-        # set debounce_timeout_ms=500 ???
+        for pin in self.inputs:
+            wiringpi.pinMode(pin, wiringpi.GPIO.INPUT)
+            wiringpi.pullUpDnControl(pin, wiringpi.GPIO.PUD_OFF)    # use external pull-down resistor
+            # edges are debounced by AbstractPump
+            # the ISR is not told which pin changed, so bind the pin to the callback
+            wiringpi.wiringPiISR(pin, wiringpi.GPIO.INT_EDGE_BOTH, functools.partial(self.event, pin))
 
     def get_status(self, pin):
         return wiringpi.digitalRead(pin)
@@ -0,0 +1,99 @@
+# Render the graphs in parallel. Each graph is drawn by a job on its own matplotlib Figure (object-oriented API, no
+# pyplot global state), so the jobs can run in a pool of worker processes and write their PNGs concurrently.
+# The data each job needs is passed to it (already parsed), so the workers never re-read the CSV files.
+import argparse
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# a graph: the PNG file to write, a function draw(fig, *args) that draws on the figure, the args (picklable), and the
+# seaborn style (e.g. "dark") and rc settings (dict or None) of the graph, as a tuple of the form (style, rc)
+Job = collections.namedtuple("Job", ["filename", "draw", "args", "style"])
+
+
+def render(job, show=False):
+    """
+    Draw a graph and save it as a PNG
+
+    :param job: the Job
+    :param show: draw on a pyplot figure (so it can be shown) instead of an off-screen figure
+    :return: the file written
+    """
+    import seaborn as sns
+    style, rc = job.style
+    sns.set(style=style, rc=rc)
+
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        fig = Figure()
+        FigureCanvasAgg(fig)
+
+    job.draw(fig, *job.args)
+    fig.savefig(job.filename, bbox_inches="tight")
+    return job.filename
+
+
+def render_all(jobs, show=False, workers=None):
+    """
+    Render graphs, in parallel if there is more than 1
+
+    :param jobs: list of Jobs
+    :param show: render the graphs 1 at a time in this process, then show them interactively (as well as saving)
+    :param workers: max number of worker processes. None uses 1 per CPU. 1 renders in this process.
+    :return: list of the files written
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if show or workers <= 1:
+        files = [render(job, show) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(render, job) for job in jobs]
+            files = [future.result() for future in futures]
+
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return files
+
+
+def main():
+    """
+    Render all the graphs (pump, water depth and weather) in 1 pool of worker processes
+    """
+    import matplotlib
+    import plot_pump
+    import plot_waterdepth
+    import plot_weather
+
+    parser = argparse.ArgumentParser(description="Generates all the graphs from ThingSpeak exports, in parallel.")
+    parser.add_argument("--pump", help="pump events file")
+    parser.add_argument("--waterdepth", help="water depth file")
+    parser.add_argument("--weather", help="weather file")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default 1 per CPU)")
+    args = parser.parse_args()
+    if not (args.pump or args.waterdepth or args.weather):
+        parser.error("at least 1 of --pump, --waterdepth and --weather is required")
+
+    matplotlib.use("Agg")  # allows figures to be generated on headless server
+    jobs = []
+    if args.pump:
+        data, pairs = plot_pump.read_recent(args.pump, 100)
+        jobs += plot_pump.graph_jobs(data, 100, pairs)
+    if args.waterdepth:
+        jobs += plot_waterdepth.graph_jobs(plot_waterdepth.read_data(args.waterdepth))
+    if args.weather:
+        jobs += plot_weather.graph_jobs(plot_weather.read_data(args.weather))
+
+    start = time.perf_counter()
+    for filename in render_all(jobs, workers=args.workers):
+        print("Saved %s" % filename)
+    print("Rendered %d graphs in %.1f secs" % (len(jobs), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
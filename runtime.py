@@ -0,0 +1,123 @@
+import asyncio
+import signal
+
+import metrics
+from loggers import Event, log_with_retry
+
+
+class AsyncRuntime:
+    """
+    Event loop (asyncio) that runs a watcher as a single event-driven process.
+    GPIO callbacks (called on the GPIO library's threads) hand their events to the loop. Each logger has its own queue,
+    so a slow logger only delays its own events. Blocking loggers are run in a thread so they do not block the loop.
+    Periodic jobs (alarm checks, bulk flushes, health pings) are scheduled on the same loop.
+    """
+
+    _STOP = object()
+
+    def __init__(self, loggers, maxsize=100, retries=3, backoff=1.0):
+        """
+        Setup the loop (it does not run until run() is called)
+
+        :param loggers: single logger or a list of loggers to send the events to
+        :param maxsize: max number of events waiting for each logger. Further events are dropped.
+        :param retries: max number of times to retry each logger if it fails
+        :param backoff: time (in secs) to wait before the 1st retry. Doubled for each retry.
+        """
+        if type(loggers) is not list:
+            loggers = [loggers]
+        self.loggers = loggers
+        self.retries = retries
+        self.backoff = backoff
+        self.jobs = []  # list of (interval, fn)
+        self.dropped = 0  # events lost because a queue was full
+        self.failed = 0  # events that could not be logged (after retries)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)  # queues/events created below belong to this loop (Python < 3.10)
+        self.queues = [asyncio.Queue(maxsize) for _l in loggers]
+        self.stopping = asyncio.Event()
+
+    def log(self, event):
+        """
+        Hand an event to the loop without waiting. Safe to call from any thread (e.g. a GPIO callback).
+
+        :param event: the event. Stamped with the current time (unless it is already an Event).
+        """
+        if not isinstance(event, Event):
+            event = Event(event)
+        self.loop.call_soon_threadsafe(self.enqueue, event)
+
+    def enqueue(self, event):
+        """Loop callback. Add the event to the queue of each logger."""
+        for logger, queue in zip(self.loggers, self.queues):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                metrics.inc("queue_dropped_total")
+                print("Queue for %s full. Dropped event %s (%d dropped)" % (type(logger).__name__, event,
+                                                                           self.dropped))
+        metrics.set_gauge("queue_size", max(queue.qsize() for queue in self.queues))
+
+    def every(self, interval, fn):
+        """
+        Schedule a job to run every interval secs while the loop is running (in a thread, as it may block)
+
+        :param interval: time (in secs) between runs
+        :param fn: the job (a function without arguments)
+        """
+        self.jobs.append((interval, fn))
+
+    async def drain(self, logger, queue):
+        """Task. Send the queued events to 1 logger (in order) until stopped."""
+        while True:
+            event = await queue.get()
+            if event is self._STOP:
+                return
+            ok = await self.loop.run_in_executor(None, log_with_retry, logger, event, self.retries, self.backoff)
+            if not ok:
+                self.failed += 1
+
+    async def periodically(self, interval, fn):
+        """Task. Run a job every interval secs (missed runs are skipped, not queued up)."""
+        next_run = self.loop.time() + interval
+        while True:
+            await asyncio.sleep(max(0.0, next_run - self.loop.time()))
+            try:
+                await self.loop.run_in_executor(None, fn)
+            except Exception as e:
+                print("Job %s failed: %s" % (getattr(fn, "__name__", fn), e))
+            while next_run <= self.loop.time():
+                next_run += interval
+
+    async def main(self):
+        """Run the loggers and jobs until stopped, then log the queued events"""
+        drains = [asyncio.ensure_future(self.drain(logger, queue)) for logger, queue in zip(self.loggers, self.queues)]
+        jobs = [asyncio.ensure_future(self.periodically(interval, fn)) for interval, fn in self.jobs]
+
+        await self.stopping.wait()
+
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        for queue in self.queues:
+            await queue.put(self._STOP)
+        await asyncio.gather(*drains)
+
+    def run(self):
+        """Run the loop until stop() is called"""
+        self.loop.run_until_complete(self.main())
+
+    def stop(self):
+        """Stop the loop once the queued events have been logged. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def stop_on_signals(self, signals=(signal.SIGINT, signal.SIGTERM, signal.SIGHUP)):
+        """Stop the loop (gracefully) when the process receives one of the signals"""
+        for signum in signals:
+            self.loop.add_signal_handler(signum, self.stop)
+
+    def close(self):
+        """Close the loop (after run() has returned)"""
+        self.loop.close()
@@ -0,0 +1,150 @@
+import bisect
+import heapq
+import itertools
+import math
+
+# scale factor to estimate the std dev from the median absolute deviation (for normally distributed samples)
+MAD_TO_STDEV = 1.4826
+
+
+class SampleFilter:
+    """
+    Online outlier filter for sensor samples.
+    Samples are added one at a time. The filter keeps a small sorted buffer (for the median/MAD) and a running
+    mean/variance (Welford's algorithm), so no statistic needs to rebuild or rescan the list of samples.
+    """
+
+    def __init__(self, k=1, spread="stdev"):
+        """
+        Setup an empty filter
+
+        :param k: samples further than k * spread from the median are outliers
+        :param spread: measure of spread used to reject outliers: "stdev" (sample std dev) or "mad" (scaled MAD)
+        """
+        if spread not in ("stdev", "mad"):
+            raise ValueError("Unknown spread %s" % spread)
+        self.k = k
+        self.spread = spread
+        self.samples = []  # kept sorted
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, x):
+        """
+        Add a sample to the filter
+
+        :param x: the sample
+        """
+        bisect.insort(self.samples, x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def median(self):
+        """Median of the samples"""
+        n = self.count
+        mid = n // 2
+        if n % 2:
+            return self.samples[mid]
+        return (self.samples[mid - 1] + self.samples[mid]) / 2
+
+    def stdev(self):
+        """Sample standard deviation (needs at least 2 samples)"""
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def mad(self):
+        """Median absolute deviation from the median"""
+        median = self.median()
+        split = bisect.bisect_left(self.samples, median)
+
+        # deviations either side of the median are already sorted, so merge them instead of sorting
+        below = (median - x for x in reversed(self.samples[:split]))
+        above = (x - median for x in self.samples[split:])
+        deviations = list(itertools.islice(heapq.merge(below, above), self.count // 2 + 1))
+
+        mid = self.count // 2
+        if self.count % 2:
+            return deviations[mid]
+        return (deviations[mid - 1] + deviations[mid]) / 2
+
+    def bounds(self):
+        """
+        Range of values that are not outliers
+
+        :return: tuple of the form (low, high). Values must be strictly inside the range.
+        """
+        if self.spread == "mad":
+            spread = MAD_TO_STDEV * self.mad()
+        else:
+            spread = self.stdev()
+        median = self.median()
+        return median - self.k * spread, median + self.k * spread
+
+    def is_outlier(self, x):
+        """Check if a value falls outside median +/- k * spread"""
+        low, high = self.bounds()
+        return not low < x < high
+
+    def clean(self):
+        """The samples (sorted) excluding outliers"""
+        low, high = self.bounds()
+        return self.samples[bisect.bisect_right(self.samples, low):bisect.bisect_left(self.samples, high)]
+
+    def clean_mean(self):
+        """
+        Arithmetic mean of the samples excluding outliers.
+        If every sample is an outlier (e.g. all samples are identical) then the median is returned.
+        """
+        clean = self.clean()
+        if not clean:
+            return self.median()
+        return math.fsum(clean) / len(clean)
+
+    def is_stable(self, tolerance):
+        """
+        Check if the median is known to within +/- tolerance (with 95% confidence).
+        The spread is estimated from the MAD so a few outliers do not delay convergence.
+
+        :param tolerance: the permitted error
+        :return: true if the median has converged, otherwise false
+        """
+        # the std error of the median is 1.2533 * std dev / sqrt(n)
+        half_width = 1.96 * 1.2533 * MAD_TO_STDEV * self.mad() / math.sqrt(self.count)
+        return half_width <= tolerance
+
+
+def clean_mean_batch(samples, k=1, spread="stdev"):
+    """
+    Batch (numpy) version of SampleFilter.clean_mean. Used to reprocess historical raw samples.
+
+    :param samples: list of samples for 1 reading, or 2-d array with 1 reading per row (pad short rows with NaN)
+    :param k: samples further than k * spread from the median are outliers
+    :param spread: measure of spread used to reject outliers: "stdev" (sample std dev) or "mad" (scaled MAD)
+    :return: the mean excluding outliers (a single value, or an array with 1 value per row)
+    """
+    import numpy as np
+
+    data = np.asarray(samples, dtype=float)
+    rows = np.atleast_2d(data)
+
+    median = np.nanmedian(rows, axis=1, keepdims=True)
+    if spread == "mad":
+        spread = MAD_TO_STDEV * np.nanmedian(np.abs(rows - median), axis=1, keepdims=True)
+    elif spread == "stdev":
+        spread = np.nanstd(rows, axis=1, ddof=1, keepdims=True)
+    else:
+        raise ValueError("Unknown spread %s" % spread)
+
+    mask = (rows > median - k * spread) & (rows < median + k * spread)  # NaN padding is never included
+    counts = mask.sum(axis=1)
+    sums = np.where(mask, rows, 0).sum(axis=1)
+    means = np.where(counts > 0, sums / np.maximum(counts, 1), median[:, 0])
+
+    if data.ndim < 2:
+        return means[0]
+    return means
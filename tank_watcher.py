@@ -1,119 +1,556 @@
 #! /usr/bin/python3
 
-import statistics
+import functools
+import json
+import os
+import signal
+import threading
 import time
 import loggers as ts
+import metrics
+from sample_filter import SampleFilter
 import argparse
 
 
 # SENSOR_HEIGHT = 205  # height of the sensor above an empty tank
 
 
+class PollingEchoTimer:
+    """Time the echo pulse by polling the echo pin. Burns a CPU core while waiting, so only used as a fallback."""
+
+    def __init__(self, gpio, gpio_echo, timeout):
+        """
+        Setup a polling timer on the echo pin
+
+        :param gpio: the GPIO library
+        :param gpio_echo: the pin connected to the sensor echo
+        :param timeout: max time (in secs) to wait for the echo pulse
+        """
+        self.gpio = gpio
+        self.gpio_echo = gpio_echo
+        self.timeout_ns = int(timeout * 1e9)
+
+    def arm(self):
+        """Prepare to time the next pulse. Nothing to do when polling."""
+        pass
+
+    def wait(self):
+        """
+        Wait for the echo pulse and measure its duration
+
+        :return: the duration of the pulse (in secs), or None if the pulse did not complete within the timeout
+        """
+        deadline = time.monotonic_ns() + self.timeout_ns
+        start_time = stop_time = time.monotonic_ns()
+
+        # save start time (after start of echo pulse)
+        while self.gpio.input(self.gpio_echo) == 0:
+            start_time = time.monotonic_ns()
+            if start_time > deadline:
+                return None
+
+        # save time of arrival
+        while self.gpio.input(self.gpio_echo) == 1:
+            stop_time = time.monotonic_ns()
+            if stop_time > deadline:
+                return None
+
+        return (stop_time - start_time) / 1e9
+
+    def cleanup(self):
+        pass
+
+
+class EdgeEchoTimer:
+    """
+    Time the echo pulse from the timestamps of the rising/falling edges (via GPIO edge callbacks).
+    The callback is registered for both edges, so it reads the level of the pin to tell them apart: timing starts on a
+    rising edge and stops on the next falling edge (a stray falling edge before the pulse is ignored).
+    """
+
+    def __init__(self, gpio, gpio_echo, timeout):
+        """
+        Setup edge detection on the echo pin
+
+        :param gpio: the GPIO library
+        :param gpio_echo: the pin connected to the sensor echo
+        :param timeout: max time (in secs) to wait for the echo pulse
+        """
+        self.gpio = gpio
+        self.gpio_echo = gpio_echo
+        self.timeout = timeout
+        self.rising = None
+        self.falling = None
+        self.done = threading.Event()
+        gpio.add_event_detect(gpio_echo, gpio.BOTH, callback=self.edge)
+
+    def edge(self, *_args):
+        """Callback invoked by the GPIO library on each edge. Only records the timestamp of the rising/falling edge."""
+        timestamp = time.monotonic_ns()
+        if self.done.is_set():
+            return
+        if self.gpio.input(self.gpio_echo):
+            self.rising = timestamp
+        elif self.rising is not None:
+            self.falling = timestamp
+            self.done.set()
+
+    def arm(self):
+        """Prepare to time the next pulse. Must be called before the sensor is triggered."""
+        self.done.clear()
+        self.rising = None
+        self.falling = None
+
+    def wait(self):
+        """
+        Wait for the echo pulse and measure its duration
+
+        :return: the duration of the pulse (in secs), or None if the pulse did not complete within the timeout
+        """
+        if not self.done.wait(self.timeout):
+            return None
+        return (self.falling - self.rising) / 1e9
+
+    def cleanup(self):
+        self.gpio.remove_event_detect(self.gpio_echo)
+
+
+ECHO_TIMERS = {"edge": EdgeEchoTimer, "poll": PollingEchoTimer}
+
+
 class Hcsr04Sensor:
-    def __init__(self, gpio_trigger, gpio_echo):
+    def __init__(self, gpio_trigger, gpio_echo, gpio=None, echo_timer=EdgeEchoTimer, timeout=0.1, settle_time=3):
+        """
+        Setup a HC-SR04 sensor
+
+        :param gpio_trigger: the pin connected to the sensor trigger
+        :param gpio_echo: the pin connected to the sensor echo
+        :param gpio: the GPIO library to use (defaults to RPi.GPIO)
+        :param echo_timer: the class used to time the echo pulse (EdgeEchoTimer or PollingEchoTimer)
+        :param timeout: max time (in secs) to wait for an echo
+        :param settle_time: time (in secs) to wait before each measurement
+        """
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
+        self.settle_time = settle_time
+
         # GPIO Pins connected to sensor
         self.gpio_trigger = gpio_trigger
         self.gpio_echo = gpio_echo
 
         # GPIO Mode (BOARD / BCM)
-        GPIO.setmode(GPIO.BCM)
+        gpio.setmode(gpio.BCM)
 
         # set GPIO direction (IN / OUT)
-        GPIO.setup(self.gpio_trigger, GPIO.OUT)
-        GPIO.setup(self.gpio_echo, GPIO.IN)
+        gpio.setup(self.gpio_trigger, gpio.OUT)
+        gpio.setup(self.gpio_echo, gpio.IN)
+
+        self.echo_timer = echo_timer(gpio, gpio_echo, timeout)
 
+    @metrics.timed("sensor_distance_seconds")
     def distance(self):
+        """
+        Measure the distance to the water (after waiting for the sensor to settle)
+
+        :return: the distance (in cm), or None if no echo was received
+        """
         # return random.random() * 5 + 30
 
-        time.sleep(3)
+        time.sleep(self.settle_time)
+        return self.ping()
+
+    def ping(self):
+        """
+        Trigger the sensor immediately and measure the distance to the water
+
+        :return: the distance (in cm), or None if no echo was received
+        """
+        self.echo_timer.arm()
 
         # set Trigger to HIGH
-        GPIO.output(self.gpio_trigger, True)
+        self.gpio.output(self.gpio_trigger, True)
 
         # set Trigger after 0.01ms to LOW
         time.sleep(0.00001)
-        GPIO.output(self.gpio_trigger, False)
-
-        StartTime = time.time()
-        StopTime = time.time()
-
-        # save StartTime (after start of echo pulse)
-        while GPIO.input(self.gpio_echo) == 0:
-            StartTime = time.time()
+        self.gpio.output(self.gpio_trigger, False)
 
-        # save time of arrival
-        while GPIO.input(self.gpio_echo) == 1:
-            StopTime = time.time()
+        time_elapsed = self.echo_timer.wait()
+        if time_elapsed is None:
+            print("No echo received")
+            metrics.inc("sensor_lost_echoes_total")
+            return None
+        metrics.set_gauge("sensor_echo_seconds", time_elapsed)
 
-        # time difference between start and arrival
-        TimeElapsed = StopTime - StartTime
         # multiply with the sonic speed (34300 cm/s)
         # and divide by 2, because there and back
-        distance = (TimeElapsed * 34300) / 2
+        distance = (time_elapsed * 34300) / 2
 
         return distance
 
+    def cleanup(self):
+        self.echo_timer.cleanup()
+        self.gpio.cleanup()
+
+
+def take_samples(sensor, max_samples=20, min_samples=5, tolerance=None):
+    """
+    Read the sensor repeatedly. If a tolerance is given, stop as soon as the reading is stable.
+
+    :param sensor: the sensor to read
+    :param max_samples: max number of times to read the sensor
+    :param min_samples: min number of samples before checking if the reading is stable
+    :param tolerance: stop once the median is known to within +/- tolerance (in cm). None takes max_samples readings.
+    :return: SampleFilter containing the distances measured (lost echoes are dropped)
+    """
+    samples = SampleFilter()
+    for _i in range(0, max_samples):
+        distance = sensor.distance()
+        if distance is None:  # lost echo
+            continue
+        samples.add(distance)
+        print("Measured Distance = %f cm" % distance)
+
+        if tolerance is not None and len(samples) >= max(min_samples, 2) and samples.is_stable(tolerance):
+            print("-- reading stable after %d samples" % len(samples))
+            break
+
+    return samples
 
-def log_water_depth(sensor, loggers, sensor_height):
+
+@metrics.timed("log_water_depth_seconds")
+def log_water_depth(sensor, loggers, sensor_height, max_samples=20, min_samples=5, tolerance=None):
     """
     Read sensor multiple times to get a stable reading (calculate mean) and log to the logger store.
-    Readings are taken 20 times. Outliers > median +/- 1 std dev are discarded.
+    Readings are taken 20 times (or until the reading is stable if a tolerance is given).
+    Outliers > median +/- 1 std dev are discarded.
     Arithmetic mean of the remaining samples is calculated to 2 decimal places.
 
     :param sensor: the sensor to read
     :param loggers: single logger or a list of loggers to record the reading
     :param sensor_height: height of the sensor above the tank
+    :param max_samples: max number of times to read the sensor
+    :param min_samples: min number of samples before checking if the reading is stable
+    :param tolerance: stop sampling once the median is known to within +/- tolerance (in cm)
+    :return: the number of samples used
     """
 
     if type(loggers) is not list:
         loggers = [loggers]
 
-    num_measures = 20
-    samples = []
-    for i in range(0, num_measures):
-        samples.append(sensor.distance())
-        print("Measured Distance = %f cm" % samples[i])
+    samples = take_samples(sensor, max_samples, min_samples, tolerance)
+
+    if len(samples) < 2:
+        print("Skipping reading (only %d samples)" % len(samples))
+        return len(samples)
+
+    water_depth = calc_water_depth(samples, sensor_height)
+    metrics.set_gauge("samples_used", len(samples))
+    if water_depth is not None:
+        print("Logging water depth = %s cm" % water_depth)
+        metrics.set_gauge("water_depth_cm", water_depth)
+        for l in loggers:
+            l.log([water_depth])
+
+    return len(samples)
 
+
+def calc_water_depth(samples, sensor_height):
+    """
+    Calculate the water depth from the sensor samples. Outliers > median +/- 1 std dev are discarded.
+
+    :param samples: SampleFilter containing the distances measured
+    :param sensor_height: height of the sensor above the tank
+    :return: the water depth (to 2 decimal places), or None if the depth is -ve
+    """
     # remove outliers
-    stdev = statistics.stdev(samples)
-    print("-- stdev = %f" % stdev)
-    median = statistics.median(samples)
-    print("-- median = %f" % median)
-    clean_data = [x for x in samples if x > median - 1 * stdev]
-    clean_data = [x for x in clean_data if x < median + 1 * stdev]
-    print("-- len samples = %d; len clean_data = %d" % (len(samples), len(clean_data)))
+    print("-- stdev = %f" % samples.stdev())
+    print("-- median = %f" % samples.median())
+    print("-- len samples = %d; len clean_data = %d" % (len(samples), len(samples.clean())))
 
     # calculate mean measurement
-    print("Avg. measurement (incl. outliers) = %.2f cm" % statistics.mean(samples))
-    clean_measure = statistics.mean(clean_data)
+    print("Avg. measurement (incl. outliers) = %.2f cm" % samples.mean)
+    clean_measure = samples.clean_mean()
     print("Avg. measurement (excl. outliers) = %.2f cm" % clean_measure)
     water_depth = round(sensor_height - clean_measure, 2)  # log to 2 decimal places
 
-    if water_depth >= 0:
-        print("Logging water depth = %s cm" % water_depth)
-        for l in loggers:
-            l.log([water_depth])
-    else:
+    if water_depth < 0:
         print("Skipping -ve water depth (%s cm)" % water_depth)
+        return None
+    return water_depth
+
+
+class Tank:
+    """A tank monitored by its own sensor"""
+
+    def __init__(self, name, sensor, sensor_height, loggers=None, field=None):
+        """
+        Setup a tank
+
+        :param name: name of the tank (used in messages)
+        :param sensor: the sensor measuring the tank
+        :param sensor_height: height of the sensor above the empty tank
+        :param loggers: list of loggers to record readings for this tank only
+        :param field: field number (1-based) used to record this tank in a channel shared by all tanks
+        """
+        self.name = name
+        self.sensor = sensor
+        self.sensor_height = sensor_height
+        self.loggers = loggers if loggers else []
+        self.field = field
+
+
+def sample_sensors(sensors, max_samples=20, min_samples=5, tolerance=None, settle_time=3, ping_gap=0.06,
+                   clock=time.monotonic, sleep=time.sleep):
+    """
+    Read several sensors at the same time.
+    Each round pings every sensor once (interleaved, with at least ping_gap between pings to avoid acoustic
+    crosstalk), then waits for the sensors to settle. The total time is about the same as sampling a single sensor.
+    Sensors stop being pinged once their reading is stable.
+
+    :param sensors: list of sensors to read (each must support ping())
+    :param max_samples: max number of times to read each sensor
+    :param min_samples: min number of samples before checking if the reading is stable
+    :param tolerance: stop sampling a sensor once its median is known to within +/- tolerance (in cm)
+    :param settle_time: min time (in secs) between 2 pings of the same sensor
+    :param ping_gap: min time (in secs) between 2 pings of any sensor
+    :param clock: function returning the current time (in secs)
+    :param sleep: function used to wait
+    :return: list of SampleFilters (one per sensor) containing the distances measured
+    """
+    samples = [SampleFilter() for _s in sensors]
+    active = list(range(len(sensors)))
+    last_ping = None
+    wait = settle_time
+
+    for _i in range(0, max_samples):
+        if not active:
+            break
+
+        sleep(wait)
+        round_start = clock()
+
+        for s in list(active):
+            if last_ping is not None:
+                sleep(max(0, last_ping + ping_gap - clock()))
+            last_ping = clock()
+
+            distance = sensors[s].ping()
+            if distance is None:  # lost echo
+                continue
+            samples[s].add(distance)
+            print("Sensor %d: Measured Distance = %f cm" % (s, distance))
+
+            if tolerance is not None and len(samples[s]) >= max(min_samples, 2) and samples[s].is_stable(tolerance):
+                print("-- sensor %d stable after %d samples" % (s, len(samples[s])))
+                active.remove(s)
+
+        # pinging the sensors counts towards the settle time of the next round
+        wait = max(0, settle_time - (clock() - round_start))
+
+    return samples
+
+
+def log_tanks(tanks, loggers, max_samples=20, min_samples=5, tolerance=None, ping_gap=0.06):
+    """
+    Read the water depth of several tanks at the same time and log to the logger stores.
+    Each reading is logged to the tank's own loggers. Tanks with a field are also logged together as a single event
+    to the shared loggers.
+
+    :param tanks: list of tanks to read
+    :param loggers: single logger or a list of loggers shared by all tanks
+    :param max_samples: max number of times to read each sensor
+    :param min_samples: min number of samples before checking if the reading is stable
+    :param tolerance: stop sampling a sensor once its median is known to within +/- tolerance (in cm)
+    :param ping_gap: min time (in secs) between 2 pings of any sensor
+    :return: list with the number of samples used for each tank
+    """
+    if type(loggers) is not list:
+        loggers = [loggers]
+
+    settle_time = max((getattr(t.sensor, "settle_time", 0) for t in tanks), default=0)
+    all_samples = sample_sensors([t.sensor for t in tanks], max_samples, min_samples, tolerance, settle_time,
+                                 ping_gap)
+
+    shared_event = []
+    for tank, samples in zip(tanks, all_samples):
+        if len(samples) < 2:
+            print("Skipping %s (only %d samples)" % (tank.name, len(samples)))
+            continue
+
+        print("Tank %s:" % tank.name)
+        water_depth = calc_water_depth(samples, tank.sensor_height)
+        if water_depth is None:
+            continue
+
+        print("Logging water depth for %s = %s cm" % (tank.name, water_depth))
+        for l in tank.loggers:
+            l.log([water_depth])
+
+        if tank.field:
+            shared_event.extend([None] * (tank.field - len(shared_event)))
+            shared_event[tank.field - 1] = water_depth
+
+    if shared_event:
+        for l in loggers:
+            l.log(shared_event)
+
+    return [len(samples) for samples in all_samples]
+
+
+def load_tanks(filename, gpio, echo_timer=EdgeEchoTimer, create_logger=ts.ThingSpeak):
+    """
+    Setup the tanks described in a JSON config file of the form:
+
+    {
+        "thingspeak": "API key of a channel shared by all tanks (optional)",
+        "tanks": [
+            {"name": "north", "trigger": 23, "echo": 24, "sensor_height": 205, "field": 1},
+            {"name": "south", "trigger": 17, "echo": 27, "sensor_height": 180, "thingspeak": "API key"}
+        ]
+    }
+
+    :param filename: the config file
+    :param gpio: the GPIO library
+    :param echo_timer: the class used to time the echo pulses
+    :param create_logger: function to create a logger for a ThingSpeak API key
+    :return: tuple of the form (tanks, shared loggers)
+    :raises ValueError: if the config has no tanks
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    if not config.get("tanks"):
+        raise ValueError("No tanks in %s" % filename)
+
+    tanks = []
+    for i, tank in enumerate(config["tanks"]):
+        sensor = Hcsr04Sensor(tank["trigger"], tank["echo"], gpio, echo_timer=echo_timer)
+        tank_loggers = [create_logger(tank["thingspeak"])] if "thingspeak" in tank else []
+        tanks.append(Tank(tank.get("name", str(i + 1)), sensor, tank["sensor_height"], tank_loggers,
+                          tank.get("field")))
+
+    shared_loggers = [create_logger(config["thingspeak"])] if "thingspeak" in config else []
+    return tanks, shared_loggers
+
+
+def run_daemon(read, interval, stop_event, clock=time.monotonic):
+    """
+    Take a reading every interval seconds until stop_event is set.
+    Readings are scheduled on the monotonic clock relative to the previous scheduled time (not the time the previous
+    reading finished) so the schedule does not drift. If a reading overruns, the missed slots are skipped.
+
+    :param read: function called to take (and log) a reading
+    :param interval: time (in secs) between readings
+    :param stop_event: threading.Event used to stop the daemon
+    :param clock: function returning the current time (in secs)
+    :return: the number of readings taken
+    """
+    readings = 0
+    next_run = clock()
+    while not stop_event.is_set():
+        try:
+            read()
+        except Exception as e:  # keep running (e.g. if the network is down)
+            print("Reading failed: %s" % e)
+        readings += 1
+
+        next_run += interval
+        now = clock()
+        if now > next_run:
+            missed = int((now - next_run) // interval) + 1
+            print("Reading overran. Skipping %d slot(s)" % missed)
+            next_run += missed * interval
+        stop_event.wait(next_run - now)
+
+    return readings
 
 
 if __name__ == '__main__':
     # read command-line args
     parser = argparse.ArgumentParser(
         description="Monitor water depth in a rainwater tank using a HC-SR04 ultrasound sensor")
-    parser.add_argument("thing_speak_api", help="API key to write new sensor readings to thingspeak.com channel")
-    parser.add_argument("sensor_height", help="Height of the sensor above an empty tank", type=float)
+    parser.add_argument("thing_speak_api", nargs="?",
+                        help="API key to write new sensor readings to thingspeak.com channel")
+    parser.add_argument("sensor_height", nargs="?", help="Height of the sensor above an empty tank", type=float)
+    parser.add_argument("--config", help="JSON file describing several tanks to monitor (instead of a single tank)")
+    parser.add_argument("--echo", help="method used to time the echo pulse", choices=sorted(ECHO_TIMERS.keys()),
+                        dest="echo_timer", default="edge")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="stop sampling once the reading is stable to within +/- tolerance (cm)")
+    parser.add_argument("--min-samples", dest="min_samples", type=int, default=5,
+                        help="min number of samples to take before checking the tolerance")
+    parser.add_argument("--max-samples", dest="max_samples", type=int, default=20,
+                        help="max number of samples to take")
+    parser.add_argument("--spool", help="directory where readings are spooled until they have been logged")
+    parser.add_argument("--store", help="also record readings in a local database file (see plot_waterdepth.py --store)")
+    parser.add_argument("--daemon", action="store_true", default=False,
+                        help="keep running and take a reading every --interval secs (instead of a single reading)")
+    parser.add_argument("--interval", type=float, default=300, help="time between readings in daemon mode (secs)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int,
+                        help="serve timing metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-file", dest="metrics_file", help="write timing metrics to this JSON file")
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float, default=60,
+                        help="time between writes of the metrics file (secs)")
     args = parser.parse_args()
     print(args)
+    if not args.config and (args.thing_speak_api is None or args.sensor_height is None):
+        parser.error("thing_speak_api and sensor_height are required (unless using --config)")
+
+    import RPi.GPIO as GPIO
+
+    metrics.start(args.metrics_port, args.metrics_file, args.metrics_interval)
+    spools = []
+    store = ts.LocalStore(args.store, "waterdepth") if args.store else None
+
+    def create_logger(api_key):
+        """Create a ThingSpeak logger (spooled to disk if --spool is set)"""
+        logger = ts.ThingSpeak(api_key)
+        if args.spool:
+            logger = ts.SpooledLogger(logger, os.path.join(args.spool, "thingspeak-%s.spool" % api_key))
+            spools.append(logger)
+        return logger
 
     try:
-        import RPi.GPIO as GPIO
+        if args.config:
+            try:
+                tanks, shared_loggers = load_tanks(args.config, GPIO, ECHO_TIMERS[args.echo_timer], create_logger)
+            except ValueError as e:
+                parser.error(str(e))
+            print("Monitoring %d tanks" % len(tanks))
+            if store:
+                shared_loggers.append(store)
+            take_reading = functools.partial(log_tanks, tanks, ts.FanOutLogger(shared_loggers), args.max_samples,
+                                             args.min_samples, args.tolerance)
+        else:
+            hcsr04_sensor = Hcsr04Sensor(23, 24, GPIO, echo_timer=ECHO_TIMERS[args.echo_timer])
+            # log to ThingSpeak and the local store at the same time
+            depth_loggers = ts.FanOutLogger([create_logger(args.thing_speak_api)] + ([store] if store else []))
+            take_reading = functools.partial(log_water_depth, hcsr04_sensor, depth_loggers, args.sensor_height,
+                                             args.max_samples, args.min_samples, args.tolerance)
+
+        if args.daemon:
+            stop = threading.Event()
+
+            def shutdown(signum, _frame):
+                print("Received signal %d. Stopping." % signum)
+                stop.set()
 
-        hcsr04_sensor = Hcsr04Sensor(23, 24)
-        thing_speak = ts.ThingSpeak(args.thing_speak_api)
+            signal.signal(signal.SIGTERM, shutdown)
+            signal.signal(signal.SIGHUP, shutdown)
 
-        log_water_depth(hcsr04_sensor, thing_speak, args.sensor_height)
+            print("Taking a reading every %s secs" % args.interval)
+            run_daemon(take_reading, args.interval, stop)
+        else:
+            take_reading()
 
     except KeyboardInterrupt:
         print("Measurement stopped by User")
+    finally:
         GPIO.cleanup()
+        for spool in spools:
+            # give the backlog a chance to be sent (the rest is sent on the next run)
+            spool.flush(timeout=30)
+            spool.close()
+        if store:
+            store.close()
+        metrics.disable()
@@ -1,6 +1,9 @@
-from mock import Mock
+from mock import Mock, patch
+import pump_watcher as pw
 import loggers
 from functools import partial
+import threading
+import time
 import alarm
 
 
@@ -58,3 +61,287 @@ def test_is_event_less():
     alarm_clock.log(8)
     alarm_clock.log(7)
     assert print_alarm.call_count == 3
+
+
+def check_alarm(trigger, events):
+    """Log the events to an alarm clock with the trigger, and return the number of times the alarm fired"""
+    alarm_clock = loggers.AlarmClock()
+    print_alarm = Mock()
+    alarm_clock.add_alarm(trigger, print_alarm)
+    for event in events:
+        alarm_clock.log(event)
+    return print_alarm.call_count
+
+
+def test_incremental_triggers():
+    """Test the incremental triggers fire like the original functions"""
+    events = [8, 9, 10, 12, 7, 11, 10, 3]
+    for trigger, function in [
+        (alarm.EventLogged(10), partial(alarm.is_event_logged, 10)),
+        (alarm.LastEventGreater(10), partial(alarm.is_last_event_greater, 10)),
+        (alarm.LastEventLess(10), partial(alarm.is_last_event_less, 10))
+    ]:
+        assert check_alarm(trigger, events) == check_alarm(function, events)
+
+
+def test_event_count():
+    assert check_alarm(alarm.EventCount(1, 3), [1, 0, 1, 0, 0, 1, 0, 1]) == 3
+
+
+def test_distinct_events():
+    assert check_alarm(alarm.DistinctEvents(3), [1, 1, 2, 2, 1, 3, 3]) == 2
+
+
+def test_ring_buffer():
+    """Test only recent events are kept, but incremental triggers still see every event"""
+    alarm_clock = loggers.AlarmClock(capacity=3)
+    print_alarm = Mock()
+    alarm_clock.add_alarm(alarm.EventLogged(1), print_alarm)
+
+    for event in range(1, 11):
+        alarm_clock.log(event)
+    assert list(alarm_clock.events) == [8, 9, 10]
+    assert print_alarm.call_count == 10
+
+
+def test_threshold_rules_once_per_crossing():
+    """Test a value sitting near a threshold only fires once per crossing"""
+    rules = alarm.ThresholdRules()
+    high, low = Mock(), Mock()
+    rules.add_above(10, high, hysteresis=2)
+    rules.add_below(5, low, hysteresis=1)
+
+    for value in [9, 11, 10.5, 11, 9, 11, 12]:  # never drops below 10 - 2 --> not re-armed
+        rules.log(value)
+    assert high.call_count == 1
+
+    for value in [7, 11]:  # drops below 8 --> re-armed
+        rules.log(value)
+    assert high.call_count == 2
+
+    for value in [4, 5.5, 4, 6.5, 4]:
+        rules.log(value)
+    assert low.call_count == 2
+    assert high.call_count == 2
+
+
+def test_threshold_rules_first_value():
+    """Test the rules are checked against the first value"""
+    rules = alarm.ThresholdRules()
+    high, low = Mock(), Mock()
+    rules.add_above(10, high)
+    rules.add_below(5, low)
+
+    assert rules.update(11) == 1
+    assert rules.update(12) == 0
+    assert high.call_count == 1
+    assert not low.called
+
+
+def test_threshold_rules_like_functions():
+    """Test rules without hysteresis fire on each crossing of the threshold"""
+    rules = alarm.ThresholdRules()
+    high = Mock()
+    rules.add_above(10, high)
+    for value in [9, 10, 11, 12, 10, 11, 9, 11, 8, 11]:
+        rules.log(value)
+    assert high.call_count == 3
+
+
+def test_threshold_rules_cooldown():
+    """Test a rule does not fire again until the cooldown has passed"""
+    now = [0]
+    rules = alarm.ThresholdRules(clock=lambda: now[0])
+    high = Mock()
+    rules.add_above(10, high, cooldown=60)
+
+    for t, value in [(0, 11), (10, 9), (20, 11), (30, 9), (90, 11)]:
+        now[0] = t
+        rules.log(value)
+    assert high.call_count == 2
+
+
+def test_threshold_rules_fields():
+    """Test rules can be used as a logger of lists of fields"""
+    rules = alarm.ThresholdRules(field=1)
+    high = Mock()
+    rules.add_above(10, high)
+    rules.log([1, 11])
+    rules.log([None, None])
+    rules.log([1, 12])
+    assert high.call_count == 1
+
+
+def test_threshold_rules_indexed():
+    """Test each value only touches the rules whose boundaries it crosses"""
+    rules = alarm.ThresholdRules()
+    for threshold in range(0, 1000, 10):
+        rules.add_above(threshold, Mock(), hysteresis=2)
+        rules.add_below(threshold, Mock(), hysteresis=2)
+
+    rules.log(505)
+    evaluated = rules.evaluated
+    for value in [506, 504, 507, 503, 505]:  # no boundaries crossed
+        rules.log(value)
+    assert rules.evaluated == evaluated
+
+    rules.log(513)  # crosses 510 (above) and 512 (re-arm of below 510)
+    assert rules.evaluated == evaluated + 2
+
+
+def test_threshold_rules_alarm_clock():
+    """Test the rules can be used as a trigger in an AlarmClock"""
+    rules = alarm.ThresholdRules()
+    rules.add_above(10, Mock())
+    assert check_alarm(rules, [9, 11, 12, 9, 11]) == 2
+
+
+class FakeClock:
+    """Clock that only moves when set by the test"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_event_rate():
+    """Test too many PUMP_ON events within the window"""
+    clock = FakeClock()
+    alarm_clock = loggers.AlarmClock()
+    too_many = Mock()
+    alarm_clock.add_alarm(alarm.EventRate(1, 3, 60 * 60, clock=clock), too_many)
+
+    # 3 cycles in an hour is OK
+    for t in [0, 20, 40]:
+        clock.now = t * 60
+        alarm_clock.log([1])
+        clock.now += 60
+        alarm_clock.log([0])
+    assert not too_many.called
+
+    # 4th cycle within the hour
+    clock.now = 50 * 60
+    alarm_clock.log([1])
+    assert too_many.call_count == 1
+
+    # 1st cycle drops out of the window
+    clock.now = 75 * 60
+    alarm_clock.log([1])
+    assert too_many.call_count == 2
+    clock.now = 101 * 60
+    alarm_clock.log([1])
+    assert too_many.call_count == 2
+
+
+def test_state_duration():
+    """Test the pump staying on too long is detected on the next event, or when polled"""
+    clock = FakeClock()
+    alarm_clock = loggers.AlarmClock()
+    too_long = Mock()
+    alarm_clock.add_alarm(alarm.StateDuration(1, 30 * 60, clock=clock), too_long)
+
+    # on for 10 mins
+    alarm_clock.log([1])
+    clock.now = 10 * 60
+    alarm_clock.log([0])
+    alarm_clock.poll()
+    assert not too_long.called
+
+    # on for 40 mins, detected by polling (only once)
+    clock.now = 100 * 60
+    alarm_clock.log([1])
+    clock.now = 120 * 60
+    alarm_clock.poll()
+    assert not too_long.called
+    clock.now = 131 * 60
+    alarm_clock.poll()
+    alarm_clock.poll()
+    clock.now = 140 * 60
+    alarm_clock.log([0])
+    assert too_long.call_count == 1
+
+    # on for 35 mins, detected when the pump switches off
+    clock.now = 200 * 60
+    alarm_clock.log([1])
+    alarm_clock.log([1])  # duplicate does not reset the start
+    clock.now = 235 * 60
+    alarm_clock.log([0])
+    assert too_long.call_count == 2
+
+
+
+def test_state_duration_other_inputs():
+    """Test events from other inputs (field not set) do not reset the duration"""
+    clock = FakeClock()
+    alarm_clock = loggers.AlarmClock()
+    too_long = Mock()
+    alarm_clock.add_alarm(alarm.StateDuration(1, 30 * 60, field=1, clock=clock), too_long)
+
+    alarm_clock.log([None, 1])
+    clock.now = 20 * 60
+    alarm_clock.log([1, None])  # float switch
+    clock.now = 31 * 60
+    alarm_clock.poll()
+    assert too_long.call_count == 1
+
+
+def test_alarm_clock_serialized():
+    """Test log and poll (called from different threads) never run the triggers at the same time"""
+    class SlowTrigger:
+        def __init__(self):
+            self.running = 0
+            self.overlaps = 0
+
+        def check(self):
+            self.running += 1
+            if self.running > 1:
+                self.overlaps += 1
+            time.sleep(0.001)
+            self.running -= 1
+            return False
+
+        def update(self, _event):
+            return self.check()
+
+        def poll(self):
+            return self.check()
+
+    trigger = SlowTrigger()
+    alarm_clock = loggers.AlarmClock()
+    alarm_clock.add_alarm(trigger, Mock())
+    threads = [threading.Thread(target=lambda: [alarm_clock.log([1]) for _i in range(50)]),
+               threading.Thread(target=lambda: [alarm_clock.poll() for _i in range(50)])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert trigger.overlaps == 0
+
+
+def test_alarm_clock_alarm_without_lock():
+    """Test an alarm can log back into the alarm clock (alarms are called after the lock is released)"""
+    alarm_clock = loggers.AlarmClock()
+    alarm_clock.add_alarm(Mock(spec=["update"], update=lambda event: event == 10), lambda: alarm_clock.log(["alarm"]))
+    thread = threading.Thread(target=alarm_clock.log, args=(10,), daemon=True)
+    thread.start()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert list(alarm_clock.events) == [10, ["alarm"]]
+
+
+def test_pump_listener():
+    """Test the windowed triggers work with pump events"""
+    clock = FakeClock()
+    pump = pw.AbstractPump(9)
+    alarm_clock = loggers.AlarmClock()
+    too_many = Mock()
+    alarm_clock.add_alarm(alarm.EventRate(pw.PUMP_ON, 1, 60, clock=clock), too_many)
+    pump.add_listener(alarm_clock)
+
+    with patch("pump_watcher.AbstractPump.get_status", side_effect=[1, 0, 1]):
+        for t in [0, 10, 20]:
+            clock.now = t
+            pump.event()
+    assert too_many.call_count == 1
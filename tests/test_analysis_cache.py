@@ -0,0 +1,105 @@
+import datetime
+
+import numpy as np
+import plot_pump
+import plot_waterdepth
+import pump_samples
+import pytest
+from analysis_cache import AnalysisCache
+
+START = datetime.datetime(2019, 6, 6, 12, 0, 0)
+HEADER = "created_at,entry_id,field1\n"
+
+
+def write_rows(filename, rows, mode="w"):
+    with open(filename, mode) as f:
+        if mode == "w":
+            f.write(HEADER)
+        f.write("".join(row + "\n" for row in rows))
+
+
+@pytest.fixture
+def export(tmp_path):
+    rows = pump_samples.to_thingspeak_rows(pump_samples.generate(1000, seed=1, start=START))
+    return str(tmp_path / "pump.csv"), str(tmp_path / "pump.cache.npz"), list(rows)
+
+
+def test_update(export):
+    filename, path, rows = export
+    write_rows(filename, rows[:600])
+    cache = AnalysisCache(path)
+    assert cache.update(filename, ["created_at", "field1"]) == 0
+    assert cache.data.dtype.names == ("created_at", "entry_id", "field1")
+    assert len(cache.data) == 600
+    cache.append("x", np.arange(3))
+    cache.save()
+
+    write_rows(filename, rows[600:], "a")
+    cache = AnalysisCache(path)
+    assert len(cache.data) == 600 and list(cache.series["x"]) == [0, 1, 2]
+    assert cache.update(filename, ["created_at", "field1"]) == 600
+    assert list(cache.data["entry_id"]) == list(range(1, 1001))
+    assert cache.update(filename, ["created_at", "field1"]) == 1000  # nothing new
+    assert len(cache.data) == 1000
+
+
+def test_rebuild(export):
+    """Test the cache is rebuilt if the export no longer matches it"""
+    filename, path, rows = export
+    write_rows(filename, rows[:600])
+    cache = AnalysisCache(path)
+    cache.update(filename)
+    cache.append("x", np.arange(3))
+
+    write_rows(filename, rows[100:])  # old rows removed
+    assert cache.update(filename) == 0
+    assert cache.data["entry_id"][0] == 101
+    assert cache.series == {}
+    assert cache.update(filename, ["created_at"]) == 0  # different columns
+
+
+def test_unreadable(export, capsys):
+    filename, path, rows = export
+    with open(path, "w") as f:
+        f.write("not a cache")
+    cache = AnalysisCache(path)
+    assert "unreadable" in capsys.readouterr().out
+    write_rows(filename, rows)
+    assert cache.update(filename) == 0
+
+
+def test_waterdepth_series():
+    """Test the series derived from new values only match those derived from all the values"""
+    rng = np.random.default_rng(1)
+    x = np.datetime64("2019-06-06T12:00:00") + np.cumsum(rng.integers(600, 7200, 3000)).astype("m8[s]")
+    y = rng.normal(100, 5, 3000)
+    y[rng.random(3000) < 0.05] += 50  # false readings
+
+    expected = plot_waterdepth.derive_series(x, y)
+    series = {}
+    for start, end in ((0, 20), (20, 1000), (1000, 1001), (1001, 3000)):
+        for name, values in plot_waterdepth.derive_series(x[:end], y[:end], start).items():
+            series[name] = np.concatenate((series[name], values)) if name in series else values
+
+    assert series["rolling_mean"] == pytest.approx(expected["rolling_mean"], nan_ok=True)
+    assert list(series["clean"]) == list(expected["clean"])
+    assert list(np.unique(series["day"])) == list(expected["day"])
+    assert sum(series["day_total"]) == pytest.approx(sum(expected["day_total"]))
+    assert sum(series["day_count"]) == sum(expected["day_count"])
+
+
+def test_pump_durations(export):
+    """Test the durations found in the new events only match those found in all the events"""
+    filename, path, rows = export
+    write_rows(filename, [])
+    cache = AnalysisCache(path)
+    for end in (1, 2, 10, 11, 500, 1000):
+        write_rows(filename, rows[:end])
+        cache.update(filename, ["created_at", "field1"])
+        pairs = plot_pump.update_cache(cache)
+
+        times, states = plot_pump.event_columns(cache.data)
+        for col, event1, event2 in plot_pump.DURATIONS:
+            expected = plot_pump.find_durations(times, states, event1, event2)
+            assert list(pairs[col][0]) == list(expected[0])
+            assert list(pairs[col][1]) == list(expected[1])
@@ -0,0 +1,478 @@
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import loggers
+import pytest
+from mock import patch
+
+
+class DummyLogger:
+    """Logger that records events. Can be made slow or made to fail."""
+
+    def __init__(self, delay=0, failures=0):
+        self.events = []
+        self.delay = delay
+        self.failures = failures
+        self.attempts = 0
+
+    def log(self, event):
+        self.attempts += 1
+        time.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise IOError("network down")
+        self.events.append(event)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Records the requests received by the stand-in ThingSpeak server"""
+
+    protocol_version = "HTTP/1.1"  # keep connections alive
+
+    def do_GET(self):
+        self.server.requests.append((self.path, None))
+        self.reply()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.path, json.loads(body)))
+        self.reply()
+
+    def reply(self):
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+        if self.server.drop_connections:
+            self.close_connection = True  # without telling the client
+
+    def log_message(self, *_args):
+        pass
+
+
+@pytest.fixture
+def thingspeak_server():
+    """Local HTTP server standing in for the ThingSpeak API"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.requests = []
+    server.status = 202
+    server.body = b""
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_batching_logger(server, **kwargs):
+    return loggers.BatchingThingSpeak("myapi", 1234, url="http://127.0.0.1:%d" % server.server_port, **kwargs)
+
+
+def test_batching_thing_speak(thingspeak_server):
+    """Test events are sent in a single bulk update with their capture times"""
+    channel = make_batching_logger(thingspeak_server, batch_size=3, max_delay=None)
+    t = datetime.datetime(2019, 6, 6, 12, 12, 56, tzinfo=datetime.timezone.utc)
+
+    channel.log(loggers.Event([1], t))
+    channel.log(loggers.Event([0], t + datetime.timedelta(seconds=40)))
+    assert thingspeak_server.requests == []
+
+    channel.log(loggers.Event([None, 5], t + datetime.timedelta(seconds=90)))
+    assert thingspeak_server.requests == [("/channels/1234/bulk_update.json", {
+        "write_api_key": "myapi",
+        "updates": [
+            {"created_at": "2019-06-06 12:12:56 +0000", "field1": 1},
+            {"created_at": "2019-06-06 12:13:36 +0000", "field1": 0},
+            {"created_at": "2019-06-06 12:14:26 +0000", "field2": 5}
+        ]})]
+
+
+def test_batching_thing_speak_close(thingspeak_server):
+    """Test remaining events are sent on close"""
+    channel = make_batching_logger(thingspeak_server, batch_size=10)
+    channel.log([1])
+    channel.log([0])
+    channel.close()
+
+    assert len(thingspeak_server.requests) == 1
+    _path, body = thingspeak_server.requests[0]
+    assert [u["field1"] for u in body["updates"]] == [1, 0]
+    assert channel.flush() is None
+
+
+def test_batching_thing_speak_timezone(thingspeak_server):
+    """Test capture times in another timezone are sent in UTC"""
+    channel = make_batching_logger(thingspeak_server, max_delay=None)
+    t = datetime.datetime(2019, 6, 6, 14, 12, 56, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    channel.log(loggers.Event([1], t))
+    assert channel.updates == [{"created_at": "2019-06-06 12:12:56 +0000", "field1": 1}]
+
+
+def test_batching_thing_speak_close_failure(thingspeak_server):
+    """Test close does not raise if the remaining events cannot be sent"""
+    channel = make_batching_logger(thingspeak_server, max_delay=None)
+    thingspeak_server.status = 500
+    channel.log([1])
+    channel.close()
+    assert len(channel.updates) == 1
+
+
+def test_batching_thing_speak_timer(thingspeak_server):
+    """Test buffered events are sent after max_delay"""
+    channel = make_batching_logger(thingspeak_server, batch_size=10, max_delay=0.05)
+    channel.log([1])
+    time.sleep(0.5)
+    assert len(thingspeak_server.requests) == 1
+    channel.close()
+
+
+def test_batching_thing_speak_failure(thingspeak_server):
+    """Test events are kept if the bulk update fails"""
+    channel = make_batching_logger(thingspeak_server, batch_size=10, max_delay=None)
+    thingspeak_server.status = 500
+    channel.log([1])
+    with pytest.raises(IOError):
+        channel.flush()
+
+    thingspeak_server.status = 202
+    channel.log([0])
+    channel.flush()
+    _path, body = thingspeak_server.requests[-1]
+    assert [u["field1"] for u in body["updates"]] == [1, 0]
+
+
+def test_batching_thing_speak_full_buffer_failure(thingspeak_server):
+    """Test log does not raise once the event is buffered (a retry would buffer it again)"""
+    channel = make_batching_logger(thingspeak_server, batch_size=1, max_delay=None)
+    thingspeak_server.status = 500
+    assert loggers.log_with_retry(channel, [1], retries=3, backoff=0.001)
+    assert len(channel.updates) == 1
+    assert channel.failed_flushes == 1
+
+    thingspeak_server.status = 202
+    channel.log([0])
+    _path, body = thingspeak_server.requests[-1]
+    assert [u["field1"] for u in body["updates"]] == [1, 0]
+
+
+def test_batching_thing_speak_max_batch_size(thingspeak_server):
+    """Test a large buffer is sent in requests of at most MAX_BATCH_SIZE, and only the unsent events are kept"""
+    channel = make_batching_logger(thingspeak_server, max_delay=None)
+    # events buffered during an outage
+    channel.updates = [channel.make_update([i]) for i in range(2000)]
+    channel.flush()
+    assert [len(body["updates"]) for _path, body in thingspeak_server.requests] == [960, 960, 80]
+
+    # 2nd request fails
+    channel.updates = [channel.make_update([i]) for i in range(2000)]
+    with patch.object(channel, "send", side_effect=[None, IOError("rate limited")]):
+        with pytest.raises(IOError):
+            channel.flush()
+    assert [u["field1"] for u in channel.updates] == list(range(960, 2000))
+
+
+def test_batching_thing_speak_max_buffered(thingspeak_server):
+    """Test the oldest events are dropped when ThingSpeak cannot be reached for too long"""
+    channel = make_batching_logger(thingspeak_server, batch_size=2, max_delay=None, max_buffered=5)
+    thingspeak_server.status = 500
+    for i in range(8):
+        channel.log([i])
+    assert [u["field1"] for u in channel.updates] == [3, 4, 5, 6, 7]
+    assert channel.dropped == 3
+
+
+def test_retry_honours_min_interval():
+    """Test a logger is not retried sooner than its min interval (e.g. ThingSpeak rate limit)"""
+    logger = DummyLogger(failures=1)
+    logger.MIN_INTERVAL = 0.2
+    start = time.monotonic()
+    assert loggers.log_with_retry(logger, [1], retries=1, backoff=0.001)
+    assert time.monotonic() - start >= 0.2
+
+    assert loggers.retry_delay(DummyLogger(), 2) == 4
+    assert loggers.retry_delay(loggers.ThingSpeak("myapi"), 2) == 15
+
+
+def test_spooled_logger(tmp_path):
+    """Test spooled events are sent in order with their capture times, and the spool is emptied"""
+    logger = DummyLogger()
+    path = str(tmp_path / "test.spool")
+    spool = loggers.SpooledLogger(logger, path)
+    t = datetime.datetime(2019, 6, 6, 12, 12, 56, tzinfo=datetime.timezone.utc)
+    for i in range(5):
+        spool.log(loggers.Event([i, None, 2.5], t + datetime.timedelta(seconds=i)))
+
+    assert spool.flush(timeout=5)
+    spool.close()
+    assert logger.events == [[i, None, 2.5] for i in range(5)]
+    assert [type(f) for f in logger.events[0]] == [int, type(None), float]
+    assert [e.created_at for e in logger.events] == [t + datetime.timedelta(seconds=i) for i in range(5)]
+    assert os.path.getsize(path) == 0
+
+
+def test_spooled_logger_outage(tmp_path):
+    """Test events are kept while the logger fails, then sent in order"""
+    logger = DummyLogger(failures=3)
+    spool = loggers.SpooledLogger(logger, str(tmp_path / "test.spool"), retry_interval=0.01)
+    for i in range(4):
+        spool.log([i])
+
+    assert spool.flush(timeout=5)
+    spool.close()
+    assert logger.events == [[0], [1], [2], [3]]
+    assert logger.attempts == 7
+
+
+def test_spooled_logger_restart(tmp_path):
+    """Test unsent events survive a restart, and only the unsent events are sent"""
+    path = str(tmp_path / "test.spool")
+    logger = DummyLogger()
+    spool = loggers.SpooledLogger(logger, path)
+    spool.log([1])
+    assert spool.flush(timeout=5)
+
+    # network goes down
+    logger.failures = 1000
+    spool.retry_interval = 60
+    spool.log([2])
+    spool.log([3])
+    spool.close()
+
+    # simulate a crash while writing the next record
+    with open(path, "ab") as f:
+        f.write(b"torn")
+
+    logger = DummyLogger()
+    spool = loggers.SpooledLogger(logger, path)
+    assert spool.flush(timeout=5)
+    spool.close()
+    assert logger.events == [[2], [3]]
+
+
+def test_thing_speak_rejected(thingspeak_server):
+    """Test an update rejected by ThingSpeak (200 with body "0", e.g. rate limited) is a failure"""
+    channel = loggers.ThingSpeak("myapi", url="http://127.0.0.1:%d" % thingspeak_server.server_port)
+    thingspeak_server.status = 200
+    thingspeak_server.body = b"0"
+    with pytest.raises(IOError):
+        channel.log([1])
+
+    thingspeak_server.body = b"42"
+    channel.log([1])
+    assert len(thingspeak_server.requests) == 2
+
+
+def test_spooled_logger_paced(tmp_path):
+    """Test the backlog is not sent faster than the logger accepts"""
+    logger = DummyLogger()
+    logger.times = []
+    logger.log = lambda event: (logger.times.append(time.monotonic()), logger.events.append(event))
+    spool = loggers.SpooledLogger(logger, str(tmp_path / "test.spool"), send_interval=0.1)
+    for i in range(4):
+        spool.log([i])
+
+    assert spool.flush(timeout=5)
+    spool.close()
+    assert logger.events == [[0], [1], [2], [3]]
+    assert min(b - a for a, b in zip(logger.times, logger.times[1:])) >= 0.1
+
+
+def test_spooled_logger_bulk_update(tmp_path, thingspeak_server):
+    """Test the backlog is replayed in bulk updates (not 1 request per event)"""
+    channel = make_batching_logger(thingspeak_server, max_delay=None)
+    path = str(tmp_path / "test.spool")
+    t = datetime.datetime(2019, 6, 6, 12, 12, 56, tzinfo=datetime.timezone.utc)
+
+    # events spooled while the network was down
+    spool = loggers.SpooledLogger(DummyLogger(failures=1000), path, retry_interval=60)
+    for i in range(100):
+        spool.log(loggers.Event([i], t + datetime.timedelta(seconds=i)))
+    spool.close()
+
+    spool = loggers.SpooledLogger(channel, path, send_interval=0.05)
+    assert spool.flush(timeout=5)
+    spool.close()
+    assert len(thingspeak_server.requests) == 1
+    _path, body = thingspeak_server.requests[0]
+    assert [u["field1"] for u in body["updates"]] == list(range(100))
+    assert body["updates"][1]["created_at"] == "2019-06-06 12:12:57 +0000"
+
+
+def test_spooled_logger_too_many_fields(tmp_path):
+    spool = loggers.SpooledLogger(DummyLogger(), str(tmp_path / "test.spool"))
+    with pytest.raises(ValueError):
+        spool.log(list(range(9)))
+    spool.close()
+
+
+def test_connection_pool(thingspeak_server):
+    """Test requests to the same host re-use the same connection"""
+    pool = loggers.ConnectionPool()
+    url = "http://127.0.0.1:%d/ping/abc" % thingspeak_server.server_port
+    health_checks = loggers.HealthChecks(url, pool=pool)
+    for i in range(3):
+        health_checks.log([i])
+    channel = make_batching_logger(thingspeak_server, max_delay=None, pool=pool)
+    channel.log([1])
+    channel.flush()
+
+    paths = [path for path, _body in thingspeak_server.requests]
+    assert paths == ["/ping/abc"] * 3 + ["/channels/1234/bulk_update.json"]
+    stats = pool.stats()
+    assert stats["connections"] == 1
+    assert stats["requests"] == 4
+    assert stats["avg_connect_time"] > 0
+    assert stats["avg_request_time"] > 0
+    pool.close()
+
+
+def test_connection_pool_reconnect(thingspeak_server):
+    """Test a new connection is opened if the host closed the kept-alive connection"""
+    thingspeak_server.drop_connections = True
+    pool = loggers.ConnectionPool()
+    health_checks = loggers.HealthChecks("http://127.0.0.1:%d/ping" % thingspeak_server.server_port, pool=pool)
+    for i in range(3):
+        health_checks.log([i])
+        time.sleep(0.05)  # let the server close the connection
+
+    assert len(thingspeak_server.requests) == 3
+    assert pool.stats()["connections"] == 3
+    assert pool.stats()["reconnects"] == 2
+    pool.close()
+
+
+def test_connection_pool_error(thingspeak_server):
+    """Test error status codes are raised"""
+    thingspeak_server.status = 404
+    health_checks = loggers.HealthChecks("http://127.0.0.1:%d/ping" % thingspeak_server.server_port,
+                                         pool=loggers.ConnectionPool())
+    with pytest.raises(IOError):
+        health_checks.log([1])
+
+
+def test_local_store(tmp_path):
+    """Test events are stored per channel and read back in time order"""
+    path = str(tmp_path / "history.db")
+    pump = loggers.LocalStore(path, "pump")
+    depth = loggers.LocalStore(path, "waterdepth")
+    base = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    for i in range(10):
+        event = loggers.Event([i % 2])
+        event.created_at = base + datetime.timedelta(minutes=i)
+        pump.log(event)
+    depth.log([123.4])
+
+    rows = pump.query()
+    assert len(rows) == 10
+    assert rows[0] == (datetime.datetime(2020, 1, 1), 1, 0)
+    assert [row[1] for row in rows] == list(range(1, 11))
+
+    # range queries include the start and exclude the end
+    rows = pump.query(start=datetime.datetime(2020, 1, 1, 0, 3), end=datetime.datetime(2020, 1, 1, 0, 6))
+    assert [row[1] for row in rows] == [4, 5, 6]
+
+    assert [row[2] for row in pump.query("waterdepth")] == [123.4]
+    pump.close()
+    depth.close()
+
+    # entry ids carry on after a restart
+    pump = loggers.LocalStore(path, "pump")
+    pump.log([1])
+    assert pump.query()[-1][1] == 11
+    assert pump.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    pump.close()
+
+
+def test_local_store_array(tmp_path):
+    """Test the store can be read in the same format as a ThingSpeak export"""
+    store = loggers.LocalStore(str(tmp_path / "history.db"), "weather")
+    store.log([20.5, 80, None, 0])
+    store.log([21.5, 75, 1015, 2])
+
+    data = store.query_array(num_fields=4)
+    assert data.dtype.names == ("created_at", "entry_id", "field1", "field2", "field3", "field4")
+    assert list(data["field1"]) == [20.5, 21.5]
+    assert list(data["entry_id"]) == [1, 2]
+    assert isinstance(data["created_at"][0], datetime.datetime)
+    assert data["field3"][0] != data["field3"][0]  # missing values are NaN
+
+    with pytest.raises(ValueError):
+        store.log(list(range(9)))
+    store.close()
+
+
+class HungLogger:
+    """Logger that blocks until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.events = []
+
+    def log(self, event):
+        self.release.wait()
+        self.events.append(event)
+
+
+def test_fan_out_logger_parallel():
+    """Test loggers are called at the same time (not one after the other)"""
+    l1, l2 = DummyLogger(delay=0.2), DummyLogger(delay=0.2)
+    fan_out = loggers.FanOutLogger([l1, l2])
+    start = time.monotonic()
+    fan_out.log([1])
+    assert time.monotonic() - start < 0.35
+
+    assert l1.events == [[1]]
+    assert l2.events == [[1]]
+    stats = fan_out.stats()
+    assert [s["calls"] for s in stats] == [1, 1]
+    assert stats[0]["avg_time"] == pytest.approx(0.2, abs=0.1)
+
+
+def test_fan_out_logger_failure():
+    """Test a failing logger does not stop the others"""
+    failing, ok = DummyLogger(failures=1), DummyLogger()
+    fan_out = loggers.FanOutLogger([failing, ok])
+    with pytest.raises(IOError):
+        fan_out.log([1])
+    assert ok.events == [[1]]
+
+    # retried loggers succeed
+    failing.failures = 1
+    loggers.FanOutLogger([failing, ok], retries=1, backoff=0).log([2])
+    assert failing.events == [[2]]
+    assert ok.events == [[1], [2]]
+
+
+def test_fan_out_logger_timeout():
+    """Test a hung logger does not block the others, and is skipped until it recovers"""
+    hung, ok = HungLogger(), DummyLogger()
+    fan_out = loggers.FanOutLogger([hung, ok], timeout=[0.1, 5])
+    start = time.monotonic()
+    with pytest.raises(IOError):
+        fan_out.log([1])
+    assert time.monotonic() - start < 1
+    assert ok.events == [[1]]
+
+    # still busy with the 1st event
+    with pytest.raises(IOError):
+        fan_out.log([2])
+    assert ok.events == [[1], [2]]
+    stats = fan_out.stats()
+    assert stats[0]["timeouts"] == 1
+    assert stats[0]["skipped"] == 1
+
+    hung.release.set()
+    time.sleep(0.1)
+    fan_out.log([3])
+    assert hung.events == [[1], [3]]
+
+
+def test_fan_out_logger_timeouts():
+    """Test 1 timeout is needed per logger"""
+    with pytest.raises(ValueError):
+        loggers.FanOutLogger([DummyLogger(), DummyLogger()], timeout=[1])
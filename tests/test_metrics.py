@@ -0,0 +1,124 @@
+import json
+import urllib.request
+
+import metrics
+import pytest
+import tank_watcher
+import pump_watcher as pw
+from fake_gpio import FakeGPIO
+
+
+@pytest.fixture
+def registry():
+    """Enable metrics for the test only"""
+    yield metrics.enable()
+    metrics.disable()
+
+
+def test_disabled():
+    """Test nothing is recorded when metrics are disabled"""
+    assert metrics.registry is None
+    metrics.inc("events_total")
+    metrics.set_gauge("queue_size", 1)
+    with metrics.timer("ping_seconds"):
+        pass
+    assert metrics.timer("ping_seconds") is metrics.NULL_TIMER
+
+
+def test_counters_and_gauges(registry):
+    metrics.inc("events_total")
+    metrics.inc("events_total", 2)
+    metrics.inc("events_total", status=1)
+    metrics.set_gauge("queue_size", 5)
+    metrics.set_gauge("queue_size", 3)
+
+    assert registry.counter("events_total").value == 3
+    assert registry.counter("events_total", status=1).value == 1
+    assert registry.gauge("queue_size").value == 3
+
+    with pytest.raises(ValueError):
+        registry.gauge("events_total")
+
+
+def test_histogram_percentiles():
+    """Test percentiles are accurate to within the bucket precision"""
+    histogram = metrics.Histogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)  # 1ms - 1s
+
+    assert histogram.count == 1000
+    assert histogram.sum == pytest.approx(500.5)
+    assert histogram.max == 1
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=0.02)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=0.02)
+    assert histogram.percentile(100) == 1
+    assert metrics.Histogram().percentile(50) == 0
+
+
+def test_histogram_buckets():
+    """Test bucket indexes are contiguous and each bucket value falls in its own bucket"""
+    indexes = [metrics.Histogram.bucket(v) for v in range(100000)]
+    assert indexes == sorted(indexes)
+    assert set(indexes) == set(range(indexes[-1] + 1))
+    for index in range(indexes[-1]):
+        assert metrics.Histogram.bucket(int(metrics.Histogram.bucket_value(index))) == index
+
+
+def test_timed(registry):
+    @metrics.timed("work_seconds", job="test")
+    def work():
+        """Some work"""
+        return 42
+
+    assert work() == 42
+    assert work.__doc__ == "Some work"
+    assert registry.histogram("work_seconds", job="test").count == 1
+
+
+def test_hot_paths(registry):
+    """Test the sensor and pump are instrumented"""
+    gpio = FakeGPIO()
+    gpio.attach_sensor(23, 24, None)
+    sensor = tank_watcher.Hcsr04Sensor(23, 24, gpio, settle_time=0, timeout=0.01)
+    sensor.distance()
+    assert registry.counter("sensor_lost_echoes_total").value == 1
+    assert registry.histogram("sensor_distance_seconds").count == 1
+
+    pump = pw.AbstractPump(1)
+    pump.event()
+    pump.event()  # no change
+    assert registry.counter("pump_events_total", input="pump", status=-1).value == 1
+    assert registry.histogram("pump_event_seconds").count == 2
+
+
+def test_metrics_endpoint(registry):
+    metrics.inc("events_total", status=1)
+    with metrics.timer("ping_seconds"):
+        pass
+    port = registry.serve(0)
+
+    text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port).read().decode("utf-8")
+    assert "# TYPE events_total counter" in text
+    assert 'events_total{status="1"} 1' in text
+    assert "# TYPE ping_seconds summary" in text
+    assert 'ping_seconds{quantile="0.5"}' in text
+    assert "ping_seconds_count 1" in text
+
+    with pytest.raises(IOError):
+        urllib.request.urlopen("http://127.0.0.1:%d/other" % port)
+
+
+def test_snapshot_file(tmp_path):
+    path = str(tmp_path / "metrics.json")
+    registry = metrics.start(path=path, interval=0.05)
+    metrics.inc("events_total")
+    with metrics.timer("ping_seconds"):
+        pass
+    metrics.disable()  # writes the final snapshot
+
+    with open(path) as f:
+        snapshot = json.load(f)
+    assert snapshot["events_total"] == 1
+    assert snapshot["ping_seconds"]["count"] == 1
+    assert registry.snapshot_thread is None
+    assert metrics.start() is None
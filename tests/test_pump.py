@@ -1,8 +1,14 @@
+import numpy as np
 import plot_pump as pp
+import pump_samples
 import pump_watcher as pw
 import pytest
+import random
+import threading
+import time
 from datetime import datetime
 import mock
+from fake_gpio import FakeGPIO
 
 
 @pytest.fixture
@@ -161,10 +167,57 @@ def test_durations_missing_on(setup):
     data = setup
     data2 = data[-9:]
     test = pp.create_durations_for_event_pair(data2, pw.PUMP_ON, pw.PUMP_OFF, "test_on_duration")
-    print(test)
-
-
-#    assert test.empty
+    assert test.empty
+
+
+def test_durations_empty():
+    """Test with no events at all, or only events for other inputs"""
+    assert pp.create_durations_for_event_pair([], pw.PUMP_ON, pw.PUMP_OFF, "values").empty
+    data = np.array([("2019-06-06T12:00:00", 1, np.nan)], dtype=[("created_at", "M8[s]"), ("entry_id", "i8"),
+                                                                ("field1", "f8")])
+    assert pp.create_durations_for_event_pair(data, pw.PUMP_ON, pw.PUMP_OFF, "values").empty
+
+
+def step_through_durations(data, event1, event2):
+    """Pair up the events 1 at a time (as plot_pump used to)"""
+    durations = []
+    i = 0
+    while True:
+        starts = [n for n in range(i, len(data)) if data[n][2] == event1]
+        if not starts:
+            return durations
+        ends = [n for n in range(starts[0] + 1, len(data)) if data[n][2] == event2]
+        if not ends:
+            return durations
+        duration = (data[ends[0]][0] - data[starts[0]][0]) / np.timedelta64(1, "s")
+        if duration:
+            durations.append(duration)
+        i = ends[0]
+
+
+def test_durations_match_stepping_through():
+    """Test the vectorized pairing against pairing 1 event at a time, with lost ON and OFF events"""
+    data = pump_samples.generate(2000, seed=1, p_on=0.6, p_off=0.6)
+    for event1, event2 in ((pw.PUMP_ON, pw.PUMP_OFF), (pw.PUMP_OFF, pw.PUMP_ON)):
+        test = pp.create_durations_for_event_pair(data, event1, event2, "values")["values"].tolist()
+        assert test == step_through_durations(data.tolist(), event1, event2)
+
+
+def test_durations_structured_array(setup):
+    """Test with a structured array (as read from a ThingSpeak export) of datetime64 times"""
+    data = np.array(setup, dtype=pump_samples.DTYPE)
+    test = pp.create_durations_for_event_pair(data, pw.PUMP_ON, pw.PUMP_OFF, "values")
+    assert test["values"].tolist() == [40.0, 63.0, 59.0, 64.0, 64.0, 63.0, 63.0, 63.0, 63.0, 64.0, 58.0, 64.0]
+    assert test.index[0] == datetime(2019, 6, 6, 12, 12, 56)
+
+
+def test_durations_skip_other_inputs():
+    """Test events for other inputs (NaN) are skipped, and zero durations are dropped"""
+    data = [(datetime(2019, 6, 6, 12, 0, 0), 1, 1), (datetime(2019, 6, 6, 12, 0, 30), 2, np.nan),
+            (datetime(2019, 6, 6, 12, 1, 0), 3, 0), (datetime(2019, 6, 6, 12, 2, 0), 4, 1),
+            (datetime(2019, 6, 6, 12, 2, 0), 5, 0)]
+    test = pp.create_durations_for_event_pair(data, pw.PUMP_ON, pw.PUMP_OFF, "values")["values"].tolist()
+    assert test == [60.0]
 
 
 def test_data_generation():
@@ -217,3 +270,248 @@ def test_callbacks(mock_get_status):
     assert test_logger2.events == [[0]]
     assert len(test_logger3.events) == 1
     assert test_logger3.events == [[0]]
+
+
+@mock.patch("pump_watcher.AbstractPump.get_status")
+def test_event_timestamps(mock_get_status):
+    """Test loggers receive the time the callback was invoked (wall clock and monotonic)"""
+    pump = pw.AbstractPump(9)
+    mock_get_status.side_effect = [1, 1, 0]
+    events = []
+    pump.add_listener(mock.Mock(log=events.append))
+
+    with mock.patch("time.monotonic_ns", side_effect=[1000, 2000, 1500000]), \
+            mock.patch("time.time", side_effect=[1560000000.25, 1560000001.0, 1560000002.5]):
+        pump.event()
+        pump.event()  # duplicate
+        pump.event()
+
+    assert events == [[1], [0]]
+    assert str(events[0].created_at) == "2019-06-08 13:20:00.250000+00:00"
+    assert events[1].monotonic_ns - events[0].monotonic_ns == 1499000
+
+    # the history keeps every edge (incl. the duplicate)
+    assert pump.history.items() == [(1000, 1560000000.25, 9, 1), (2000, 1560000001.0, 9, 1),
+                                    (1500000, 1560000002.5, 9, 0)]
+
+
+def test_event_ring():
+    """Test the oldest edges are overwritten once the history is full"""
+    ring = pw.EventRing(3)
+    assert len(ring) == 0
+    assert ring.items() == []
+    for i in range(5):
+        ring.append(i, i / 10, 9, i % 2)
+
+    assert len(ring) == 3
+    assert ring.items() == [(2, 0.2, 9, 0), (3, 0.3, 9, 1), (4, 0.4, 9, 0)]
+
+
+class FakeGpioPump(pw.AbstractPump):
+    """Pump monitor connected to a fake GPIO pin (edge storm harness)"""
+
+    def __init__(self, gpio, pins, **kwargs):
+        super(FakeGpioPump, self).__init__(pins, **kwargs)
+        self.gpio = gpio
+        self.events = []
+        for pin in self.inputs:
+            gpio.setup(pin, gpio.IN)
+            gpio.add_event_detect(pin, gpio.BOTH, callback=self.event)
+        self.add_listener(mock.Mock(log=self.events.append))
+
+    def get_status(self, pin):
+        return self.gpio.input(pin)
+
+
+def run_edge_storms(pump, gpio, rng):
+    """Switch the pump on, off, then send a burst of spurious edges. Return the number of edges."""
+    edges = 0
+    for level in (1, 0, 0):
+        edges += gpio.bounce(pump.pin, level, bounces=rng.randint(4, 12), rng=rng)
+        time.sleep(pump.settle_time * 3 + 0.05)
+    return edges
+
+
+def test_debounce_edge_storm():
+    """Test bursts of edges are coalesced into 1 transition each (and spurious bursts are ignored)"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, 22, settle_time=0.1, confirm_reads=2, confirm_interval=0.001)
+    edges = run_edge_storms(pump, gpio, random.Random(1))
+
+    assert pump.events == [[1], [0]]
+    assert pump.edges == edges
+    assert pump.transitions == 2
+    assert pump.suppressed() == edges - 2
+    assert len(pump.history) == edges
+
+    # without debounce, every edge is a change of status
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, 22)
+    edges = run_edge_storms(pump, gpio, random.Random(1))
+    assert len(pump.events) > edges // 2
+    assert pump.transitions == len(pump.events)
+
+
+def test_debounce_timestamp():
+    """Test a debounced transition keeps the time of the 1st edge"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, 22, settle_time=0.1)
+    start = time.monotonic_ns()
+    gpio.bounce(22, 1, bounces=5, max_gap=0.01)
+    time.sleep(0.3)
+
+    assert pump.events == [[1]]
+    assert pump.events[0].monotonic_ns - start < 5000000  # well before the pin settled
+
+
+def test_debounce_single_timer():
+    """Test a burst of edges re-arms 1 timer per pin (rather than starting a timer thread per edge)"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, 22, settle_time=0.1)
+    with mock.patch("threading.Timer", wraps=threading.Timer) as timer:
+        gpio.bounce(22, 1, bounces=50, max_gap=0.001)
+        time.sleep(0.3)
+
+    assert pump.events == [[1]]
+    assert pump.edges == 51
+    assert timer.call_count <= 3
+
+
+def test_debounce_confirm_without_lock():
+    """Test the confirm reads do not hold the lock (edges on other pins are not blocked)"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, [pw.PumpInput("pump", 22, 1), pw.PumpInput("float", 24, 2)], confirm_reads=2,
+                        confirm_interval=0.2)
+    gpio.levels[22] = 1
+    thread = threading.Thread(target=pump.event, args=(22,))
+    thread.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    with pump.lock:
+        assert time.monotonic() - start < 0.1
+    thread.join()
+    assert pump.events == [[1, None]]
+
+
+def test_listeners_called_without_lock():
+    """Test a slow listener does not hold the lock (edges on other pins are not blocked)"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, [pw.PumpInput("pump", 22, 1), pw.PumpInput("float", 24, 2)])
+    pump.add_listener(mock.Mock(log=lambda _event: time.sleep(0.2)))
+    gpio.levels[22] = 1
+    thread = threading.Thread(target=pump.event, args=(22,))
+    thread.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    with pump.lock:
+        assert time.monotonic() - start < 0.1
+    thread.join()
+    assert pump.events == [[1, None]]
+
+
+@mock.patch("pump_watcher.AbstractPump.get_status")
+def test_debounce_glitch(mock_get_status):
+    """Test a change of status is ignored unless the confirm reads agree"""
+    pump = pw.AbstractPump(9, confirm_reads=2, confirm_interval=0)
+    events = []
+    pump.add_listener(mock.Mock(log=events.append))
+
+    mock_get_status.side_effect = [1, 1, 0, 1, 1, 1]
+    pump.event()  # glitch
+    pump.event()
+    assert events == [[1]]
+    assert pump.glitches == 1
+
+
+def test_debounce_cleanup():
+    """Test a pending transition is dropped by cleanup"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, 22, settle_time=0.1)
+    gpio.bounce(22, 1, bounces=3)
+    pump.cleanup()
+    time.sleep(0.2)
+    assert pump.events == []
+
+
+def test_parse_input():
+    assert pw.parse_input("22") == pw.PumpInput("pin22", 22, 1)
+    assert pw.parse_input("22", 3) == pw.PumpInput("pin22", 22, 3)
+    assert pw.parse_input("float:24") == pw.PumpInput("float", 24, 1)
+    assert pw.parse_input("float:24:2") == pw.PumpInput("float", 24, 2)
+    for spec in ("float", ":24", "float:24:2:1", "float:x"):
+        with pytest.raises(ValueError):
+            pw.parse_input(spec)
+
+
+def test_multiple_inputs():
+    """Test each input is logged to its own field by the same loggers"""
+    gpio = FakeGPIO()
+    pump = pw.AbstractPump([pw.PumpInput("pump", 22, 1), pw.PumpInput("overflow", 26, 3)])
+    pump.get_status = gpio.input
+    events = []
+    pump.add_listener(mock.Mock(log=events.append))
+
+    gpio.levels[22] = 1
+    pump.event(22)
+    gpio.levels[26] = 1
+    pump.event(26)
+    pump.event(26)  # no change
+    gpio.levels[22] = 0
+    pump.event(22)
+    pump.event()  # pin not given --> the 1st input
+
+    assert events == [[1, None, None], [None, None, 1], [0, None, None]]
+    assert [pin for _ns, _t, pin, _level in pump.history.items()] == [22, 26, 26, 22, 22]
+
+
+def test_multiple_inputs_debounce():
+    """Test bursts on different pins are debounced independently"""
+    gpio = FakeGPIO()
+    pump = FakeGpioPump(gpio, [pw.PumpInput("pump", 22, 1), pw.PumpInput("float", 24, 2)], settle_time=0.1)
+    gpio.bounce(22, 1, bounces=5)
+    gpio.bounce(24, 1, bounces=3)
+    time.sleep(0.3)
+    assert len(pump.events) == 2
+    assert [1, None] in pump.events
+    assert [None, 1] in pump.events
+
+
+def test_inputs_must_differ():
+    with pytest.raises(ValueError):
+        pw.AbstractPump([pw.PumpInput("pump", 22, 1), pw.PumpInput("float", 22, 2)])
+    with pytest.raises(ValueError):
+        pw.AbstractPump([pw.PumpInput("pump", 22, 1), pw.PumpInput("float", 24, 1)])
+
+
+@pytest.mark.parametrize("truncate", [1, 5, 40])
+@pytest.mark.parametrize("p_on", [0.8, 0.3])
+def test_read_recent(tmp_path, truncate, p_on):
+    """Test the durations read from the end of a file match the last durations of the whole file"""
+    filename = str(tmp_path / "pump.csv")
+    rows = pump_samples.to_thingspeak_rows(pump_samples.generate(2000, seed=truncate, p_on=p_on))
+    with open(filename, "w") as f:
+        f.write("created_at,entry_id,field1\n" + "\n".join(rows) + "\n")
+    data = pp.read_data(filename)
+
+    recent, pairs = pp.read_recent(filename, truncate)
+    assert len(recent) < len(data)
+    assert list(recent["entry_id"][-truncate:]) == list(data["entry_id"][-truncate:])
+
+    times, states = pp.event_columns(data)
+    for col, event1, event2 in pp.DURATIONS:
+        expected = pp.durations_frame(times, *pp.find_durations(times, states, event1, event2), col)[-truncate:]
+        starts, ends = pairs[col]
+        test = pp.durations_frame(recent["created_at"], starts[-truncate:], ends[-truncate:], col)
+        assert test.equals(expected)
+
+
+def test_read_recent_whole_file(tmp_path):
+    """Test all the durations are found when the file is shorter than needed"""
+    filename = str(tmp_path / "pump.csv")
+    pump_samples.write_csv(filename, 30, seed=1)
+    data, pairs = pp.read_recent(filename, 100)
+    assert len(data) == 30
+
+    times, states = pp.event_columns(data)
+    for col, event1, event2 in pp.DURATIONS:
+        assert [list(a) for a in pairs[col]] == [list(a) for a in pp.find_durations(times, states, event1, event2)]
@@ -0,0 +1,68 @@
+import datetime
+
+import numpy as np
+import pump_samples as ps
+import pump_watcher as pw
+import pytest
+import thingspeak_csv
+
+START = datetime.datetime(2019, 6, 6, 12, 0, 0)
+
+
+def test_generate():
+    data = ps.generate(1000, seed=1, start=START)
+    assert len(data) == 1000
+    assert list(data["entry_id"]) == list(range(1, 1001))
+    assert set(data["field1"]) == {pw.PUMP_ON, pw.PUMP_OFF}
+    assert data["created_at"][0] >= np.datetime64(START)
+
+    # time moves on by at least 45 mins before the pump switches on, and at most 10 mins before it switches off
+    gaps = np.diff(data["created_at"]).astype(int)
+    assert (gaps[data["field1"][1:] == pw.PUMP_ON] >= 45 * 60).all()
+    assert (gaps[data["field1"][1:] == pw.PUMP_OFF] <= 10 * 60).all()
+
+
+def test_generate_seed():
+    """Test the same seed gives the same events (whatever the chunk size)"""
+    data = ps.generate(5000, seed=42, start=START)
+    assert (ps.generate(5000, seed=42, start=START) == data).all()
+    assert (np.concatenate(list(ps.generate_chunks(5000, 333, seed=42, start=START))) == data).all()
+    assert not (ps.generate(5000, seed=43, start=START) == data).all()
+
+
+def test_lost_readings():
+    """Test readings are lost with the same probabilities as gen_random_samples"""
+    data = ps.generate(100000, seed=1, start=START)
+    repeats = data["field1"][1:] == data["field1"][:-1]  # a lost reading leaves 2 of the same event in a row
+    # the next event is the same if the opposite event is lost (0.2) then the same one recorded (0.8), and so on
+    assert repeats.mean() == pytest.approx(0.2 * 0.8 / (1 - 0.2 * 0.2), abs=0.01)
+    assert (data["field1"] == pw.PUMP_ON).mean() == pytest.approx(0.5, abs=0.01)
+
+    only_on = ps.generate(100, seed=1, start=START, p_off=0)
+    assert (only_on["field1"] == pw.PUMP_ON).all()
+    with pytest.raises(ValueError):
+        ps.generate(1, p_on=0, p_off=0)
+
+
+def test_write_csv(tmp_path):
+    """Test the CSV file can be read like a ThingSpeak export"""
+    filename = str(tmp_path / "pump.csv")
+    ps.write_csv(filename, 250, chunk_size=100, seed=1, start=START)
+
+    data = thingspeak_csv.read(filename)
+    expected = ps.generate(250, seed=1, start=START)
+    assert len(data) == 250
+    assert list(data["entry_id"]) == list(expected["entry_id"])
+    assert list(data["field1"]) == list(expected["field1"])
+    assert list(data["created_at"]) == list(expected["created_at"])
+
+
+def test_write_binary(tmp_path):
+    filename = str(tmp_path / "pump.npy")
+    ps.write_binary(filename, 2500, chunk_size=1000, seed=1, start=START)
+
+    data = ps.read_binary(filename)
+    assert data.dtype == ps.DTYPE
+    assert data.dtype.itemsize == 13
+    assert (data == ps.generate(2500, seed=1, start=START)).all()
+    assert (ps.read_binary(filename, mmap=False) == data).all()
@@ -0,0 +1,45 @@
+import os
+import pickle
+
+import numpy as np
+import plot_pump
+import plot_waterdepth
+import plot_weather
+import pump_samples
+import render
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def draw_line(fig, values):
+    ax = fig.add_subplot(111)
+    ax.plot(values)
+
+
+def is_png(filename):
+    with open(filename, "rb") as f:
+        return f.read(8) == b"\x89PNG\r\n\x1a\n"
+
+
+def test_render_all(tmp_path):
+    jobs = [render.Job(str(tmp_path / ("fig%d.png" % i)), draw_line, (np.arange(i + 2),), ("dark", None))
+            for i in range(3)]
+    assert render.render_all(jobs, workers=2) == [job.filename for job in jobs]
+    assert all(is_png(job.filename) for job in jobs)
+
+    os.remove(jobs[0].filename)
+    assert render.render_all(jobs[:1], workers=1) == [jobs[0].filename]
+    assert is_png(jobs[0].filename)
+
+
+def test_graph_jobs(tmp_path):
+    """Test each script's graphs can be sent to a worker process and rendered there"""
+    jobs = plot_pump.graph_jobs(pump_samples.generate(500, seed=1), 100)
+    jobs += plot_waterdepth.graph_jobs(plot_waterdepth.read_data(os.path.join(ROOT, "waterdepth.csv")))
+    jobs += plot_weather.graph_jobs(plot_weather.read_data(os.path.join(ROOT, "weather.csv")))
+    assert len(jobs) == 7
+
+    jobs = [job._replace(filename=str(tmp_path / os.path.basename(job.filename))) for job in jobs]
+    pickle.dumps(jobs)
+    for filename in render.render_all(jobs):
+        assert is_png(filename)
@@ -0,0 +1,115 @@
+import datetime
+import threading
+import time
+
+import loggers
+import pump_watcher as pw
+import runtime
+from mock import patch
+from test_loggers import DummyLogger, HungLogger
+
+
+def start(event_loop):
+    """Run the loop on a background thread (as the GPIO callbacks need a thread of their own)"""
+    thread = threading.Thread(target=event_loop.run, daemon=True)
+    thread.start()
+    return thread
+
+
+def stop(event_loop, thread):
+    event_loop.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    event_loop.close()
+
+
+def test_runtime_logs_events():
+    """Test events logged from other threads reach every logger (in order)"""
+    l1, l2 = DummyLogger(), DummyLogger()
+    event_loop = runtime.AsyncRuntime([l1, l2])
+    thread = start(event_loop)
+    for i in range(5):
+        event_loop.log([i])
+    stop(event_loop, thread)  # queued events are logged before stopping
+
+    assert l1.events == [[0], [1], [2], [3], [4]]
+    assert l2.events == l1.events
+    assert isinstance(l1.events[0], loggers.Event)
+
+
+def test_runtime_events_are_timestamped():
+    """Test events are stamped when handed to the loop (not when logged)"""
+    logger = DummyLogger(delay=0.1)
+    event_loop = runtime.AsyncRuntime(logger)
+    thread = start(event_loop)
+    before = datetime.datetime.now(datetime.timezone.utc)
+    event_loop.log([1])
+    event_loop.log([0])
+    stop(event_loop, thread)
+
+    assert logger.events == [[1], [0]]
+    assert logger.events[1].created_at - before < datetime.timedelta(seconds=0.1)
+
+
+def test_runtime_pump_callback():
+    """Test the pump callback returns without waiting for the loggers"""
+    slow = DummyLogger(delay=0.2)
+    event_loop = runtime.AsyncRuntime(slow)
+    pump = pw.AbstractPump(9)
+    pump.add_listener(event_loop)
+    thread = start(event_loop)
+
+    begin = time.monotonic()
+    with patch("pump_watcher.AbstractPump.get_status", side_effect=[1, 0]):
+        pump.event()
+        pump.event()
+    assert time.monotonic() - begin < 0.1
+
+    stop(event_loop, thread)
+    assert slow.events == [[1], [0]]
+
+
+def test_runtime_hung_logger():
+    """Test a hung logger does not delay the others"""
+    hung, ok = HungLogger(), DummyLogger()
+    event_loop = runtime.AsyncRuntime([hung, ok])
+    thread = start(event_loop)
+    event_loop.log([1])
+    event_loop.log([2])
+    time.sleep(0.2)
+    assert ok.events == [[1], [2]]
+
+    hung.release.set()
+    stop(event_loop, thread)
+    assert hung.events == [[1], [2]]
+
+
+def test_runtime_failures():
+    """Test failed loggers are retried, and events dropped when a queue is full"""
+    failing = DummyLogger(failures=2)
+    event_loop = runtime.AsyncRuntime(failing, maxsize=1, retries=1, backoff=0)
+    event_loop.log([1])
+    event_loop.log([2])  # queue full (the loop is not running yet)
+    thread = start(event_loop)
+    stop(event_loop, thread)
+
+    assert event_loop.dropped == 1
+    assert event_loop.failed == 1
+    assert failing.attempts == 2
+
+
+def test_runtime_jobs():
+    """Test periodic jobs run on the loop (and a failing job keeps being scheduled)"""
+    runs = []
+
+    def job():
+        runs.append(time.monotonic())
+        raise IOError("flush failed")
+
+    event_loop = runtime.AsyncRuntime([])
+    event_loop.every(0.05, job)
+    thread = start(event_loop)
+    time.sleep(0.3)
+    stop(event_loop, thread)
+
+    assert 3 <= len(runs) <= 7
@@ -0,0 +1,83 @@
+import random
+import statistics
+
+import numpy as np
+import pytest
+from sample_filter import SampleFilter, clean_mean_batch
+
+QUIET = [37.8113, 37.1223, 37.3066, 37.9734, 37.045, 37.5932, 37.4391, 37.6167, 37.0225, 37.8271,
+         37.806, 37.3737, 37.777, 37.8919, 37.0741, 37.636, 37.2062, 37.4314, 37.7108, 37.6957]
+NOISY = [38.1165, 37.3386, 38.8385, 39.9032, 37.8083, 37.3966, 39.888, 38.1475, 38.0824, 38.8795,
+         39.8011, 38.748, 38.253, 39.9832, 37.7506, 37.0587, 37.5136, 37.3538, 38.8457, 38.0296]
+
+
+def reference_clean_mean(samples):
+    """The original list-based filter (mean excluding values outside median +/- 1 std dev)"""
+    stdev = statistics.stdev(samples)
+    median = statistics.median(samples)
+    clean_data = [x for x in samples if median - stdev < x < median + stdev]
+    return statistics.mean(clean_data)
+
+
+def build_filter(samples, **kwargs):
+    sample_filter = SampleFilter(**kwargs)
+    for x in samples:
+        sample_filter.add(x)
+    return sample_filter
+
+
+@pytest.mark.parametrize("samples", [QUIET, NOISY, QUIET[:7], NOISY[:2], [1.0, 2.0, 50.0, 3.0]])
+def test_matches_original_filter(samples):
+    """Test the streaming filter gives the same result as the original list-based filter"""
+    sample_filter = build_filter(samples)
+
+    assert len(sample_filter) == len(samples)
+    assert sample_filter.median() == statistics.median(samples)
+    assert sample_filter.mean == pytest.approx(statistics.mean(samples))
+    assert sample_filter.stdev() == pytest.approx(statistics.stdev(samples))
+    assert sample_filter.clean_mean() == pytest.approx(reference_clean_mean(samples))
+
+
+def test_matches_original_filter_random():
+    """Test the streaming filter with random readings (including outliers)"""
+    rnd = random.Random(42)
+    for _i in range(100):
+        samples = [rnd.gauss(100, 2) for _j in range(rnd.randint(2, 30))]
+        samples += [rnd.uniform(0, 400) for _j in range(rnd.randint(0, 3))]
+        assert build_filter(samples).clean_mean() == pytest.approx(reference_clean_mean(samples))
+
+
+def test_mad():
+    samples = [1, 1, 2, 2, 4, 6, 9]
+    assert build_filter(samples).mad() == 1
+    assert build_filter(samples + [10]).mad() == statistics.median(
+        [abs(x - statistics.median(samples + [10])) for x in samples + [10]])
+
+
+def test_mad_rejection():
+    """Test MAD-based rejection ignores a large outlier that inflates the std dev"""
+    samples = [10.0, 10.2, 9.9, 10.1, 9.8, 10.0, 80.0]
+    sample_filter = build_filter(samples, spread="mad", k=3)
+    assert sample_filter.is_outlier(80.0)
+    assert not sample_filter.is_outlier(10.1)
+    assert sample_filter.clean_mean() == pytest.approx(statistics.mean(samples[:-1]))
+
+
+def test_identical_samples():
+    """Test all outliers (std dev is 0) falls back to the median"""
+    assert build_filter([5.0, 5.0, 5.0]).clean_mean() == 5.0
+
+
+def test_batch_matches_streaming():
+    """Test the numpy batch path gives the same results as the streaming filter"""
+    assert clean_mean_batch(QUIET) == pytest.approx(build_filter(QUIET).clean_mean())
+
+    # 1 reading per row, short rows padded with NaN
+    padded = QUIET[:10] + [np.nan] * 10
+    batch = clean_mean_batch([QUIET, NOISY, padded])
+    assert batch == pytest.approx([build_filter(QUIET).clean_mean(), build_filter(NOISY).clean_mean(),
+                                   build_filter(QUIET[:10]).clean_mean()])
+
+    samples = [10.0, 10.2, 9.9, 10.1, 9.8, 10.0, 80.0]
+    assert clean_mean_batch(samples, k=3, spread="mad") == pytest.approx(
+        build_filter(samples, k=3, spread="mad").clean_mean())
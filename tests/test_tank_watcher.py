@@ -1,7 +1,14 @@
+import datetime
+import json
+import statistics
+import threading
+import time
+
 import pytest
 import tank_watcher
 import loggers as ts
 from mock import Mock
+from fake_gpio import FakeGPIO
 
 
 class DummySensor:
@@ -32,6 +39,9 @@ class DummySensor:
             self.reset_iterator()
             return self.distance()
 
+    def ping(self):
+        return self.distance()
+
     def set_noisy(self, noise):
         self.noisy = noise
         self.reset_iterator()
@@ -115,12 +125,26 @@ def test_thing_speak_multiple():
         ["hello", "goodbye"]) == "https://api.thingspeak.com/update?api_key=myapi&field1=hello&field2=goodbye"
 
 
+def test_thing_speak_missing_fields():
+    """Test the ThingSpeak channel class (fields set to None are not sent)"""
+    channel = ts.ThingSpeak("myapi", test_mode=True)
+    assert channel.log([None, "goodbye"]) == "https://api.thingspeak.com/update?api_key=myapi&field2=goodbye"
+
+
 def test_thing_speak_empty():
     """Test the ThingSpeak channel class (empty event)"""
     channel = ts.ThingSpeak("myapi", test_mode=True)
     assert channel.log([]) == "https://api.thingspeak.com/update?api_key=myapi"
 
 
+def test_thing_speak_timestamped():
+    """Test the ThingSpeak channel class (an Event is sent with the time it was captured)"""
+    channel = ts.ThingSpeak("myapi", test_mode=True)
+    event = ts.Event([1], datetime.datetime(2019, 6, 6, 12, 12, 56, 500000, tzinfo=datetime.timezone.utc))
+    assert channel.log(event) == \
+        "https://api.thingspeak.com/update?api_key=myapi&field1=1&created_at=2019-06-06T12:12:56Z"
+
+
 def test_multiple_loggers(setup):
     sensor, logger = setup
     l1 = Mock(logger)
@@ -143,3 +167,261 @@ def test_negative(setup):
     # Lowering the sensor results in a -ve reading. Should not be logged (i.e. call_count remains unchanged)
     tank_watcher.log_water_depth(sensor, logger, 37.63)
     assert logger.log.call_count == 1
+
+
+@pytest.fixture
+def fake_gpio():
+    gpio = FakeGPIO()
+    gpio.attach_sensor(23, 24, 100)
+    return gpio
+
+
+@pytest.mark.parametrize("echo_timer", [tank_watcher.EdgeEchoTimer, tank_watcher.PollingEchoTimer])
+def test_echo_timer(fake_gpio, echo_timer):
+    """Test the echo pulse is timed correctly by each echo timer"""
+    sensor = tank_watcher.Hcsr04Sensor(23, 24, fake_gpio, echo_timer=echo_timer, timeout=1, settle_time=0)
+
+    # use the median of a few pings - the fake echo is timed by sleeping threads, so single pings can be late
+    assert statistics.median(sensor.distance() for _i in range(5)) == pytest.approx(100, rel=0.2)
+
+    fake_gpio.set_distance(23, 300)
+    assert statistics.median(sensor.distance() for _i in range(5)) == pytest.approx(300, rel=0.2)
+
+
+@pytest.mark.parametrize("echo_timer", [tank_watcher.EdgeEchoTimer, tank_watcher.PollingEchoTimer])
+def test_echo_timeout(fake_gpio, echo_timer):
+    """Test a lost echo is reported as None (instead of hanging)"""
+    sensor = tank_watcher.Hcsr04Sensor(23, 24, fake_gpio, echo_timer=echo_timer, timeout=0.05, settle_time=0)
+    fake_gpio.set_distance(23, None)
+
+    assert sensor.distance() is None
+
+
+def test_echo_timer_edge_direction():
+    """Test the edge echo timer starts on a rising edge (a stray falling edge is ignored) and stops on the falling edge"""
+    gpio = FakeGPIO()
+    gpio.setup(24, gpio.IN)
+    timer = tank_watcher.EdgeEchoTimer(gpio, 24, timeout=0.05)
+    timer.arm()
+
+    gpio.levels[24] = gpio.LOW
+    timer.edge(24)  # falling edge left over from before the pulse
+    assert not timer.done.is_set()
+
+    gpio.levels[24] = gpio.HIGH
+    timer.edge(24)
+    time.sleep(0.01)
+    gpio.levels[24] = gpio.LOW
+    timer.edge(24)
+    gpio.levels[24] = gpio.HIGH
+    timer.edge(24)  # next pulse
+
+    assert 0.01 <= timer.wait() < 0.1
+
+
+def test_lost_echoes(setup):
+    """Test lost echoes are dropped from the samples"""
+    sensor, logger = setup
+    readings = iter([None, None] + sensor.quiet_readings)
+    sensor.distance = lambda: next(readings, None)
+
+    tank_watcher.log_water_depth(sensor, logger, 205)
+    assert logger.get_last_reading() == [167.43]  # mean of the first 18 readings
+
+
+def test_adaptive_sampling(setup):
+    """Test sampling stops early once the reading is stable"""
+    sensor, logger = setup
+
+    assert tank_watcher.log_water_depth(sensor, logger, 205, tolerance=0.5) == 5
+    assert tank_watcher.log_water_depth(sensor, logger, 205, min_samples=8, tolerance=0.5) == 8
+
+    # tolerance cannot be met --> use max samples
+    assert tank_watcher.log_water_depth(sensor, logger, 205, max_samples=12, tolerance=0.001) == 12
+
+    # no tolerance --> fixed number of samples (default behaviour)
+    assert tank_watcher.log_water_depth(sensor, logger, 205) == 20
+
+
+def test_adaptive_sampling_noisy(setup):
+    """Test noisy readings need more samples than quiet readings"""
+    sensor, logger = setup
+    quiet = tank_watcher.log_water_depth(sensor, logger, 205, tolerance=0.3)
+
+    sensor.set_noisy(True)
+    noisy = tank_watcher.log_water_depth(sensor, logger, 205, tolerance=0.3)
+    assert noisy > quiet
+
+
+class FakeClock:
+    """Clock that only moves when advanced by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStopEvent:
+    """Stop event that records the waits and stops the daemon after a number of readings"""
+
+    def __init__(self, clock, readings):
+        self.clock = clock
+        self.readings = readings
+        self.waits = []
+
+    def is_set(self):
+        return len(self.waits) >= self.readings
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+
+
+def test_daemon_schedule():
+    """Test readings are scheduled at fixed intervals, correcting for the time taken by each reading"""
+    clock = FakeClock()
+    stop = FakeStopEvent(clock, 3)
+    durations = iter([10, 20, 5])
+
+    def read():
+        clock.now += next(durations)
+
+    assert tank_watcher.run_daemon(read, 60, stop, clock) == 3
+    assert stop.waits == [50, 40, 55]
+    assert clock.now == 1000 + 3 * 60
+
+
+def test_daemon_overrun():
+    """Test slots are skipped if a reading takes longer than the interval (and errors do not stop the daemon)"""
+    clock = FakeClock()
+    stop = FakeStopEvent(clock, 2)
+    durations = iter([130, 5])
+
+    def read():
+        clock.now += next(durations)
+        if clock.now > 1200:
+            raise IOError("network down")
+
+    assert tank_watcher.run_daemon(read, 60, stop, clock) == 2
+    assert stop.waits == [50, 55]
+    assert clock.now == 1000 + 4 * 60
+
+
+def test_daemon_stop():
+    """Test the daemon stops when the stop event is set"""
+    stop = threading.Event()
+    readings = []
+
+    def read():
+        readings.append(1)
+        if len(readings) == 3:
+            stop.set()
+
+    assert tank_watcher.run_daemon(read, 0.01, stop) == 3
+
+
+def test_multiple_tanks(setup):
+    """Test several tanks are read together and logged to their own loggers and fields of a shared channel"""
+    sensor1, _store = setup
+    sensor2 = DummySensor()
+    sensor2.set_noisy(True)
+    sensor3 = DummySensor()
+    store1, store2, store3, shared = DummyStore(), DummyStore(), DummyStore(), DummyStore()
+
+    tanks = [tank_watcher.Tank("north", sensor1, 205, [store1], field=1),
+             tank_watcher.Tank("south", sensor2, 205, [store2]),
+             tank_watcher.Tank("east", sensor3, 210, [store3], field=3)]
+    assert tank_watcher.log_tanks(tanks, shared, ping_gap=0) == [20, 20, 20]
+
+    # same readings as a single sensor
+    assert store1.get_logged_readings() == [[167.36]]
+    assert store2.get_logged_readings() == [[166.93]]
+    assert store3.get_logged_readings() == [[172.36]]
+    assert shared.get_logged_readings() == [[167.36, None, 172.36]]
+
+
+def test_multiple_tanks_interleaved():
+    """Test pings are interleaved across sensors so the total time is close to a single sensor"""
+    clock = FakeClock()
+    pings = []
+
+    def sleep(secs):
+        clock.now += secs
+
+    class TimedSensor(DummySensor):
+        def __init__(self, name):
+            super().__init__()
+            self.name = name
+
+        def ping(self):
+            pings.append((clock.now, self.name))
+            clock.now += 0.02  # time to receive the echo
+            return self.distance()
+
+    sensors = [TimedSensor(i) for i in range(3)]
+    samples = tank_watcher.sample_sensors(sensors, max_samples=10, settle_time=3, ping_gap=0.06, clock=clock,
+                                          sleep=sleep)
+
+    assert [len(s) for s in samples] == [10, 10, 10]
+    assert [name for _t, name in pings[:6]] == [0, 1, 2, 0, 1, 2]
+
+    # at least ping_gap between any 2 pings, at least settle_time between pings of the same sensor
+    times = [t for t, _name in pings]
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.06 - 1e-9
+    for i in range(3):
+        times = [t for t, name in pings if name == i]
+        assert min(b - a for a, b in zip(times, times[1:])) >= 3 - 1e-9
+
+    # a single sensor takes 10 * 3 secs
+    assert clock.now - 1000 < 10 * 3 + 1
+
+
+def test_multiple_tanks_adaptive():
+    """Test stable sensors drop out of the rotation"""
+    quiet = DummySensor()
+    noisy = DummySensor()
+    noisy.set_noisy(True)
+    samples = tank_watcher.sample_sensors([quiet, noisy], tolerance=0.3, settle_time=0, ping_gap=0)
+    assert len(samples[0]) == 11
+    assert len(samples[1]) == 20
+
+
+def test_load_tanks(fake_gpio, tmp_path):
+    """Test tanks are setup from a config file"""
+    config = tmp_path / "tanks.json"
+    config.write_text(json.dumps({
+        "thingspeak": "shared",
+        "tanks": [
+            {"name": "north", "trigger": 23, "echo": 24, "sensor_height": 205, "field": 1},
+            {"trigger": 17, "echo": 27, "sensor_height": 180, "thingspeak": "south"}
+        ]}))
+
+    tanks, shared_loggers = tank_watcher.load_tanks(str(config), fake_gpio)
+    assert [t.name for t in tanks] == ["north", "2"]
+    assert [t.field for t in tanks] == [1, None]
+    assert [t.sensor.gpio_echo for t in tanks] == [24, 27]
+    assert [len(t.loggers) for t in tanks] == [0, 1]
+    assert tanks[1].loggers[0].api_key == "south"
+    assert shared_loggers[0].api_key == "shared"
+
+
+def test_load_tanks_empty(fake_gpio, tmp_path):
+    """Test a config without tanks is rejected"""
+    config = tmp_path / "tanks.json"
+    config.write_text(json.dumps({"thingspeak": "shared", "tanks": []}))
+    with pytest.raises(ValueError):
+        tank_watcher.load_tanks(str(config), fake_gpio)
+
+
+def test_fan_out_loggers(setup):
+    """Test the water depth can be logged to several loggers at the same time"""
+    sensor, logger = setup
+    l1 = Mock(logger)
+    l2 = Mock(logger)
+
+    tank_watcher.log_water_depth(sensor, ts.FanOutLogger([l1, l2]), 205)
+
+    l1.log.assert_called_once_with([167.36])
+    l2.log.assert_called_once_with([167.36])
@@ -0,0 +1,90 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+import thingspeak_csv as tc
+
+CSV = """created_at,entry_id,field1,field2
+2019-02-09 00:11:16 UTC,1,6,72
+2019-02-09 01:00:16 UTC,2,,75
+2019-03-01 23:59:59 UTC,3,7.5,
+2020-02-29 23:59:59 UTC,4,8,80
+"""
+
+
+@pytest.fixture
+def export(tmp_path):
+    filename = str(tmp_path / "export.csv")
+    with open(filename, "w") as f:
+        f.write(CSV)
+    return filename
+
+
+def test_parse_dates():
+    dates = ["2019-06-06 12:12:56 UTC", "2020-02-29 23:59:59 UTC", "1999-12-31 00:00:00 UTC"]
+    expected = [np.datetime64(datetime.strptime(d, tc.DATE_FORMAT)) for d in dates]
+    assert list(tc.parse_dates(dates)) == expected
+    assert list(tc.parse_dates([d.encode() for d in dates])) == expected
+    assert tc.parse_dates(dates).dtype == np.dtype("M8[s]")
+    assert len(tc.parse_dates([])) == 0
+
+
+def test_parse_dates_bad_format():
+    with pytest.raises(ValueError):
+        tc.parse_dates(["2019-06-06T12:12:56"])
+    with pytest.raises(ValueError):
+        tc.parse_dates(["2019-02-29 23:59:59 UTC"])
+
+
+def test_read(export):
+    data = tc.read(export)
+    assert data.dtype.names == ("created_at", "entry_id", "field1", "field2")
+    assert data["created_at"][0] == np.datetime64("2019-02-09T00:11:16")
+    assert list(data["entry_id"]) == [1, 2, 3, 4]
+    assert np.isnan(data["field1"][1]) and np.isnan(data["field2"][2])  # missing values
+    assert data["field1"][2] == 7.5
+
+
+def test_read_columns(export):
+    data = tc.read(export, ["field2", "created_at"])
+    assert data.dtype.names == ("created_at", "field2")  # file order
+    assert data["field2"][3] == 80
+    with pytest.raises(ValueError):
+        tc.read(export, ["created_at", "field3"])
+
+
+def test_read_chunks(export):
+    chunks = list(tc.read_chunks(export, chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    data = tc.read(export)
+    for name in data.dtype.names:
+        np.testing.assert_array_equal(np.concatenate(chunks)[name], data[name])
+
+
+def test_read_empty(tmp_path):
+    filename = str(tmp_path / "empty.csv")
+    with open(filename, "w") as f:
+        f.write("created_at,entry_id,field1\n")
+    data = tc.read(filename)
+    assert len(data) == 0
+    assert data.dtype == tc.dtype(["created_at", "entry_id", "field1"])
+
+
+def test_read_tail(export):
+    data, complete = tc.read_tail(export, 2, ["created_at", "entry_id"])
+    assert list(data["entry_id"]) == [3, 4] and not complete
+    assert data.dtype.names == ("created_at", "entry_id")
+
+    data, complete = tc.read_tail(export, 4)
+    assert list(data["entry_id"]) == [1, 2, 3, 4] and complete
+    assert tc.read_tail(export, 10)[1]
+    assert len(tc.read_tail(export, 0)[0]) == 0
+
+
+def test_read_tail_no_newline(tmp_path):
+    """Test the last row is read when the file does not end with a newline"""
+    filename = str(tmp_path / "export.csv")
+    with open(filename, "w") as f:
+        f.write(CSV.rstrip("\n"))
+    data, complete = tc.read_tail(filename, 1)
+    assert list(data["entry_id"]) == [4] and not complete
@@ -0,0 +1,173 @@
+# Fast loader for ThingSpeak CSV exports (created_at,entry_id,field1,...), shared by the plot scripts.
+# The CSV is tokenized by pandas (in C), a chunk at a time, and the dates are parsed as a whole column by numpy
+# instead of calling strptime on every row.
+import io
+import mmap
+import os
+
+import numpy as np
+import pandas as pd
+
+# format of created_at in a ThingSpeak export, e.g. "2019-06-06 12:12:56 UTC"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+DATE_LENGTH = len("2019-06-06 12:12:56 UTC")
+
+
+def parse_dates(dates):
+    """
+    Convert ThingSpeak dates (see DATE_FORMAT) to datetime64
+
+    :param dates: array (or list) of strings or bytes
+    :return: datetime64[s] array (UTC, without a timezone)
+    """
+    dates = np.asarray(dates).astype("S%d" % DATE_LENGTH)
+    if not len(dates):
+        return np.empty(0, dtype="M8[s]")
+
+    # "2019-06-06 12:12:56 UTC" -> "2019-06-06T12:12:56", which numpy parses as ISO 8601
+    chars = dates.view("S1").reshape(len(dates), DATE_LENGTH)
+    if not ((chars[:, 10] == b" ") & (chars[:, 19] == b" ")).all():
+        raise ValueError("Dates must be of the form %s" % DATE_FORMAT)
+    chars[:, 10] = b"T"
+    return chars[:, :19].copy().view("S19").ravel().astype("M8[s]")
+
+
+def read_header(filename):
+    """
+    :return: list of the column names in a CSV file
+    """
+    with open(filename, "rt") as f:
+        return f.readline().strip().split(",")
+
+
+def dtype(columns):
+    """
+    Types of the columns of a ThingSpeak export: created_at is a datetime64, entry_id an int, and the fields are floats
+    (so missing values can be NaN)
+
+    :param columns: list of column names
+    :return: numpy dtype of a structured array with these columns
+    """
+    types = {"created_at": "M8[s]", "entry_id": "i8"}
+    return np.dtype([(name, types.get(name, "f8")) for name in columns])
+
+
+def select_columns(header, columns=None):
+    """
+    :param header: list of the names of all the columns in the file
+    :param columns: list of column names. None selects all the columns.
+    :return: list of the selected column names, in file order
+    """
+    if columns is None:
+        return header
+    missing = set(columns) - set(header)
+    if missing:
+        raise ValueError("No column(s) %s in %s" % (", ".join(sorted(missing)), ",".join(header)))
+    return [name for name in header if name in columns]
+
+
+def parse_chunks(f, header, columns, chunk_size=100000):
+    """
+    Parse the rows of a ThingSpeak CSV export (without the header), a chunk at a time
+
+    :param f: binary file object, positioned at the start of a row
+    :param header: list of the names of all the columns in the file
+    :param columns: list of the names of the columns to keep
+    :param chunk_size: max number of rows per chunk
+    :return: generator of structured arrays (see dtype)
+    """
+    types = dtype(columns)
+    csv_types = {name: "f8" for name in columns}
+    csv_types.update({"created_at": "S%d" % DATE_LENGTH, "entry_id": "i8"})
+    for df in pd.read_csv(f, header=None, names=header, usecols=columns,
+                          dtype={name: csv_types[name] for name in columns}, chunksize=chunk_size, engine="c"):
+        chunk = np.empty(len(df), dtype=types)
+        for name in columns:
+            values = df[name].to_numpy()
+            chunk[name] = parse_dates(values) if name == "created_at" else values
+        yield chunk
+
+
+def read_chunks(filename, columns=None, chunk_size=100000):
+    """
+    Read a ThingSpeak CSV export, a chunk at a time
+
+    :param filename: the CSV file
+    :param columns: list of the names of the columns to read (others are skipped). None reads all columns.
+    :param chunk_size: max number of rows per chunk
+    :return: generator of structured arrays (see dtype). Columns are in file order.
+    """
+    header = read_header(filename)
+    columns = select_columns(header, columns)
+    with open(filename, "rb") as f:
+        f.readline()
+        for chunk in parse_chunks(f, header, columns, chunk_size):
+            yield chunk
+
+
+def read(filename, columns=None, chunk_size=100000):
+    """
+    Read a ThingSpeak CSV export
+
+    :return: structured array (see dtype). Params as read_chunks.
+    """
+    chunks = list(read_chunks(filename, columns, chunk_size))
+    if not chunks:
+        return np.empty(0, dtype=dtype(select_columns(read_header(filename), columns)))
+    return np.concatenate(chunks)
+
+
+def read_from(filename, offset=0, columns=None, chunk_size=100000):
+    """
+    Read the rows after a byte offset, e.g. only the rows appended to an export since it was last read
+
+    :param filename: the CSV file
+    :param offset: position in the file of the 1st row to read (from a previous call). 0 reads all the rows.
+    :param columns: list of the names of the columns to read. None reads all columns.
+    :param chunk_size: max number of rows parsed at a time
+    :return: tuple of the form (data, offset): structured array (see dtype) and the position of the end of the file
+    (the offset to read from next time)
+    """
+    header = read_header(filename)
+    columns = select_columns(header, columns)
+    with open(filename, "rb") as f:
+        f.readline()
+        f.seek(max(offset, f.tell()))
+        rows = f.read()
+        end = f.tell()
+
+    chunks = list(parse_chunks(io.BytesIO(rows), header, columns, chunk_size)) if rows.strip() else []
+    data = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype(columns))
+    return data, end
+
+
+def read_tail(filename, rows, columns=None):
+    """
+    Read only the last rows of an export. The (memory-mapped) file is searched back from the end for the start of the
+    rows, so the time taken depends on the number of rows read, not the size of the file.
+
+    :param filename: the CSV file
+    :param rows: number of rows to read
+    :param columns: list of the names of the columns to read. None reads all columns.
+    :return: tuple of the form (data, complete): structured array (see dtype), and True if it holds all the rows in the
+    file
+    """
+    header = read_header(filename)
+    columns = select_columns(header, columns)
+    with open(filename, "rb") as f:
+        header_end = len(f.readline())
+        size = os.fstat(f.fileno()).st_size
+        if size <= header_end or rows <= 0:
+            return np.empty(0, dtype=dtype(columns)), size <= header_end
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = size - 1 if mm[size - 1:size] == b"\n" else size
+            for _i in range(rows):
+                start = mm.rfind(b"\n", header_end - 1, start)
+                if start <= header_end - 1:
+                    break
+            complete = start <= header_end - 1
+            text = mm[max(start + 1, header_end):size]
+
+    chunks = list(parse_chunks(io.BytesIO(text), header, columns))
+    data = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype(columns))
+    return data, complete